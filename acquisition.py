@@ -0,0 +1,271 @@
+"""Sampling all sensors in a dedicated acquisition process.
+
+Bit-banging shares the GIL with everything else in the process: a sampler
+thread preempted while PD_SCK is high for more than 60 us powers the chip
+down and corrupts the sample, and the more the logging, HTTP and storage
+threads run, the more read timing jitters.  An AcquisitionProcess runs the
+samplers of all sensors in a forked child process instead, optionally pinned
+to one CPU and scheduled SCHED_FIFO, and publishes the samples into
+SharedSampleRings in a multiprocessing.shared_memory block.
+
+In the main process a SharedSampler per sensor stands in for the Sampler:
+WeightSensor reads its ring exactly like a local one -- no pickling, no
+pipes -- and the SharedSampler feeds new samples to the estimators.  The
+child also publishes the read error, reset, retry and rejection counts of
+every sensor in the block, and the SharedSampler adds them to the metrics
+of the main process.
+
+The child is forked, so it inherits the GPIO backend.  Start it before other
+threads are running and after closing the HX711 drivers of the main process
+(see WeightSensor.start_sampling), which must not read the chips from then on.
+"""
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from hx711 import HX711, REJECT_REASONS, CorruptSampleError, ReadTimeoutError
+from metrics import REGISTRY, REJECTED
+from sampler import READ_ERRORS, RESETS, Sampler, SampleRing, DEFAULT_CAPACITY
+from utils import logger
+
+# Counters of every sensor the child publishes after the rings: those of its
+# Sampler, then HX711.retries and HX711.rejected by reason.
+COUNTERS = ('read_errors', 'resets', 'retries') + REJECT_REASONS
+
+_context = multiprocessing.get_context('fork')
+
+
+class SharedSampleRing(SampleRing):
+    """SampleRing whose count, timestamps and values live in a shared buffer,
+    at `offset`; it takes nbytes(capacity) bytes.
+
+    Timestamps are time.monotonic(), which is the same clock in every process.
+    """
+
+    def __init__(self, capacity, buffer, offset=0):
+        if capacity < 2:
+            raise ValueError("SampleRing capacity must be >= 2")
+        self.capacity = capacity
+        self._count = np.ndarray(1, np.int64, buffer, offset)
+        self.timestamps = np.ndarray(capacity, np.float64, buffer, offset + 8)
+        self.values = np.ndarray(capacity, np.int32, buffer, offset + 8 + 8 * capacity)
+
+    @staticmethod
+    def nbytes(capacity):
+        # Padded so that the next ring in the buffer stays 8-byte aligned.
+        return 8 + 8 * capacity + (4 * capacity + 7) // 8 * 8
+
+    @property
+    def count(self):
+        return int(self._count[0])
+
+    @count.setter
+    def count(self, value):
+        self._count[0] = value
+
+
+def set_scheduling(cpu=None, priority=None):
+    """Pin the calling thread, and the threads it starts afterwards, to cpu and
+    schedule them SCHED_FIFO at priority (1-99).  Both need privileges that
+    may be missing; failures are logged and sampling goes on without them."""
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Could not pin acquisition to CPU {cpu}: {e}")
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Could not set real-time priority {priority}: {e}")
+
+
+class AcquisitionProcess:
+    """Child process sampling every sensor of sensor_configs ({sensor_id: (DT, SCK)})
+    with a Sampler thread each, into self.rings {sensor_id: SharedSampleRing}.
+
+    gains: {sensor_id: gain}, default 128.  max_retries, max_slew and
+    read_timeout are passed to hx711.HX711.  cpu and priority are passed to
+    set_scheduling() in the child.  The samplers poll DOUT with short sleeps
+    rather than spin, so a SCHED_FIFO child leaves the CPU to others between
+    conversions; edge detection is not used, its callback thread is not
+    forked along.
+    """
+
+    # Seconds between updates of the counters in the shared block.
+    COUNTER_INTERVAL = 0.5
+
+    def __init__(self, sensor_configs, capacity=DEFAULT_CAPACITY, gpio=None,
+                 gains=None, max_retries=3, max_slew=None, read_timeout=1.0,
+                 cpu=None, priority=None):
+        self.sensor_configs = dict(sensor_configs)
+        self.capacity = capacity
+        self.gpio = gpio
+        self.gains = gains or {}
+        self.max_retries = max_retries
+        self.max_slew = max_slew
+        self.read_timeout = read_timeout
+        self.cpu = cpu
+        self.priority = priority
+
+        size = SharedSampleRing.nbytes(capacity)
+        sensors = len(self.sensor_configs)
+        self._memory = shared_memory.SharedMemory(create=True,
+                                                  size=(size + 8 * len(COUNTERS)) * sensors)
+        self.rings = {sensor_id: SharedSampleRing(capacity, self._memory.buf, i * size)
+                      for i, sensor_id in enumerate(self.sensor_configs)}
+        counters = np.ndarray((sensors, len(COUNTERS)), np.int64, self._memory.buf, size * sensors)
+        self.counters = {sensor_id: counters[i] for i, sensor_id in enumerate(self.sensor_configs)}
+        self._by_dout = {dout: sensor_id for sensor_id, (dout, _) in self.sensor_configs.items()}
+        # The main process holds the only write end: its closing, or the main
+        # process exiting, tells the child to stop.
+        self._stop_reader, self._stop_writer = _context.Pipe(duplex=False)
+        self._process = None
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process is not None else None
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        self._process = _context.Process(target=self._run, name='acquisition', daemon=True)
+        self._process.start()
+        logger.info(f"Acquisition process {self._process.pid} started for sensors "
+                    f"{', '.join(str(sensor_id) for sensor_id in self.sensor_configs)}")
+
+    def stop(self, timeout=2.0):
+        if self._process is None:
+            return
+        self._stop_writer.close()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            logger.warning("Acquisition process did not stop, terminating it")
+            self._process.terminate()
+            self._process.join(timeout)
+        logger.info("Acquisition process stopped")
+
+    def close(self):
+        """Stop the process and remove the shared memory block.  Rings already
+        handed out stay readable until this process exits."""
+        self.stop()
+        self._memory.unlink()
+
+    def sampler(self, hx, estimators=()):
+        """SharedSampler following the ring of the sensor on hx.DOUT."""
+        sensor_id = self._by_dout[hx.DOUT]
+        return SharedSampler(self, hx, self.rings[sensor_id], estimators=estimators,
+                             stale_after=self.read_timeout or 1.0,
+                             counters=self.counters[sensor_id])
+
+    def _run(self):
+        # Ctrl-C reaches the whole process group; the main process stops us.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._stop_writer.close()
+        set_scheduling(self.cpu, self.priority)
+        samplers = {}
+        try:
+            for sensor_id, (dout, sck) in self.sensor_configs.items():
+                try:
+                    hx = HX711(dout, sck, gain=self.gains.get(sensor_id, 128), gpio=self.gpio,
+                               ready_mode='poll', max_retries=self.max_retries,
+                               max_slew=self.max_slew, read_timeout=self.read_timeout,
+                               sensor_id=sensor_id)
+                except (ReadTimeoutError, CorruptSampleError) as e:
+                    # Its ring stays empty, so the main process sees it degraded.
+                    logger.error(f"Sensor {sensor_id} not sampled: {e}")
+                    continue
+                samplers[sensor_id] = Sampler(hx, ring=self.rings[sensor_id])
+            for sampler in samplers.values():
+                sampler.start()
+            while not self._stop_reader.poll(self.COUNTER_INTERVAL):
+                self._publish_counters(samplers)
+        finally:
+            for sampler in samplers.values():
+                sampler.stop()
+                sampler.hx.close()
+            self._publish_counters(samplers)
+
+    def _publish_counters(self, samplers):
+        for sensor_id, sampler in samplers.items():
+            hx = sampler.hx
+            self.counters[sensor_id][:] = ([sampler.read_errors, sampler.resets, hx.retries]
+                                           + [hx.rejected[reason] for reason in REJECT_REASONS])
+
+
+class SharedSampler(Sampler):
+    """Sampler for a sensor sampled by an AcquisitionProcess.  It never reads
+    the HX711: it follows the shared ring and passes new samples to the
+    estimators, and stops when the acquisition process is gone.  The sensor
+    is degraded while no sample arrived for stale_after seconds; resetting it
+    is up to the sampler in the acquisition process.  counters: the row of
+    AcquisitionProcess.counters of the sensor, followed into read_errors,
+    resets, hx.retries, hx.rejected and the metrics."""
+
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, acquisition, hx, ring, name=None, estimators=(), stale_after=1.0,
+                 counters=None):
+        super().__init__(hx, name=name or f"shared-sampler-{hx.DOUT}", estimators=estimators,
+                         ring=ring)
+        self.acquisition = acquisition
+        self.stale_after = stale_after
+        self.counters = counters
+        self._counted = [0] * len(COUNTERS)
+
+    def _sample(self):
+        seen = self.ring.count
+        last_sample = time.monotonic()
+        while not self._stop_event.wait(self.POLL_INTERVAL):
+            if self.counters is not None:
+                self._follow_counters()
+            if not self.acquisition.is_alive():
+                logger.error(f"Acquisition process is not running, no samples for DOUT={self.hx.DOUT}")
+                self.degraded = True
+                return
+            count = self.ring.count
+            if count == seen:
+                if not self.degraded and time.monotonic() - last_sample > self.stale_after:
+                    self.degraded = True
+                    logger.error(f"Sensor on DOUT={self.hx.DOUT} degraded: no samples for "
+                                 f"{self.stale_after:g} s")
+                continue
+            last_sample = time.monotonic()
+            if self.degraded:
+                self.degraded = False
+                logger.info(f"Sensor on DOUT={self.hx.DOUT} recovered")
+            if self.estimators:
+                timestamps, values = self.ring.read(seen, count)
+                # Ring timestamps are monotonic clock readings, estimators get wall time.
+                timestamps = timestamps + (time.time() - time.monotonic())
+                for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+                    for estimator in self.estimators:
+                        estimator.update(value, timestamp)
+            seen = count
+
+    def _follow_counters(self):
+        counts = self.counters.tolist()
+        if counts == self._counted:
+            return
+        deltas = [new - old for new, old in zip(counts, self._counted)]
+        self._counted = counts
+        self.read_errors, self.resets, self.hx.retries = counts[:3]
+        for reason, count in zip(REJECT_REASONS, counts[3:]):
+            self.hx.rejected[reason] = count
+        if REGISTRY.enabled:
+            sensor = self.hx.sensor_id
+            read_errors, resets, retries = deltas[:3]
+            if read_errors:
+                READ_ERRORS.labels(sensor).inc(read_errors)
+            if resets:
+                RESETS.labels(sensor).inc(resets)
+            if retries:
+                self.hx.metrics.retries.inc(retries)
+            for reason, delta in zip(REJECT_REASONS, deltas[3:]):
+                if delta:
+                    REJECTED.labels(sensor, reason).inc(delta)
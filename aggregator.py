@@ -0,0 +1,105 @@
+"""Platform totals from the four corner load cells.
+
+A PlatformAggregator combines the sampled streams of the corner sensors into
+frames: every sample of any sensor starts a frame holding the latest sample
+of each sensor at that time, so frames come at the combined sample rate of
+all corners.  A block of frames is converted in one pass: per-corner
+calibration to grams, then the corner-coupling matrix, which corrects the
+load one corner sees from weight resting on another, then total, center of
+mass and per-corner load.
+
+It reads the samplers' rings, so it works the same with sampler threads and
+with the acquisition process.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from utils import logger
+
+# Arrays over the frames of a window (scalars for latest()).  loads has one
+# column per corner, in sensor_ids order; x and y are NaN while the total is
+# below min_total.
+Aggregate = namedtuple('Aggregate', 'timestamps total x y loads')
+
+
+def estimate_coupling(loads, weight):
+    """Coupling matrix from calibration loads: row j of loads is the per-corner
+    load measured with `weight` grams on corner j alone."""
+    loads = np.asarray(loads, dtype=np.float64)
+    if loads.ndim != 2 or loads.shape[0] != loads.shape[1]:
+        raise ValueError("Need one row of corner loads per corner")
+    return weight * np.linalg.inv(loads.T)
+
+
+class PlatformAggregator:
+    def __init__(self, sensors, positions, coupling=None, min_total=1.0):
+        """sensors: {sensor_id: WeightSensor}, all sampling in the background;
+        positions: {sensor_id: (x, y)} of each corner; coupling: square
+        matrix in sensor_ids order mapping measured to true corner loads
+        (None: identity)."""
+        self.sensor_ids = list(sensors)
+        self.sensors = [sensors[sensor_id] for sensor_id in self.sensor_ids]
+        missing = [sensor_id for sensor_id in self.sensor_ids if sensor_id not in positions]
+        if missing:
+            raise ValueError(f"No position for sensors {missing}")
+        self.positions = np.array([positions[sensor_id] for sensor_id in self.sensor_ids],
+                                  dtype=np.float64)
+        corners = len(self.sensor_ids)
+        self.coupling = None
+        if coupling is not None:
+            self.coupling = np.asarray(coupling, dtype=np.float64)
+            if self.coupling.shape != (corners, corners):
+                raise ValueError(f"Coupling matrix must be {corners}x{corners}")
+        self.min_total = min_total
+
+    def frames(self, n=None):
+        """(timestamps, raw) of the aligned frames over the last n samples of
+        every sensor; raw has one column per corner."""
+        series = [sensor.sampler.ring.latest(n) for sensor in self.sensors]
+        if any(not len(timestamps) for timestamps, _ in series):
+            return np.empty(0), np.empty((0, len(self.sensors)), dtype=np.int32)
+        # A frame needs a sample of every sensor, so start at the latest first sample.
+        start = max(timestamps[0] for timestamps, _ in series)
+        timestamps = np.unique(np.concatenate([t[t >= start] for t, _ in series]))
+        raw = np.empty((len(timestamps), len(series)), dtype=np.int32)
+        for corner, (t, values) in enumerate(series):
+            raw[:, corner] = values[np.searchsorted(t, timestamps, side='right') - 1]
+        return timestamps, raw
+
+    def loads(self, raw):
+        """Per-corner loads in grams of a (frames, corners) block of raw readings."""
+        raw = np.asarray(raw, dtype=np.float64)
+        if all(sensor.calibration is None for sensor in self.sensors):
+            offsets = np.array([sensor.hx.OFFSET for sensor in self.sensors], dtype=np.float64)
+            units = np.array([sensor.reference_unit for sensor in self.sensors], dtype=np.float64)
+            loads = (raw - offsets) / units
+        else:
+            loads = np.column_stack([sensor.raw_to_weight(raw[:, corner])
+                                     for corner, sensor in enumerate(self.sensors)])
+        if self.coupling is not None:
+            loads = loads @ self.coupling.T
+        return loads
+
+    def aggregate(self, timestamps, raw):
+        """Aggregate of a block of aligned frames."""
+        loads = self.loads(raw)
+        total = loads.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            center = (loads @ self.positions) / total[:, None]
+        center[np.abs(total) < self.min_total] = np.nan
+        return Aggregate(timestamps, total, center[:, 0], center[:, 1], loads)
+
+    def window(self, n):
+        """Aggregate of the frames over the last n samples of every sensor."""
+        return self.aggregate(*self.frames(n))
+
+    def latest(self):
+        """Aggregate of the most recent frame, with scalar fields, or None
+        before every sensor has a sample."""
+        result = self.window(1)
+        if not len(result.total):
+            logger.debug("No platform frame yet")
+            return None
+        return Aggregate(float(result.timestamps[-1]), float(result.total[-1]),
+                         float(result.x[-1]), float(result.y[-1]), result.loads[-1])
@@ -0,0 +1,99 @@
+"""Automatic zero tracking.
+
+An AutoZeroTracker runs as a sampler estimator: it sees every raw sample in
+the sampler thread and never reads the HX711 itself.  Every `window`
+samples it checks whether the scale is empty and stable -- the window's
+weight is within `zero_band` grams of zero and its stddev and drift are
+within `threshold` -- and if so moves the sensor's OFFSET towards the
+window mean, by at most `max_rate` grams per second of sample time.
+Corrections smaller than `min_step` grams are noise and are skipped.  A
+real load outside the zero band is never tracked away.
+
+Every applied correction is an OffsetEvent, logged, kept in `events` and
+passed to `on_event`; the new offset is persisted by the caller.
+"""
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from settle import is_settled
+from utils import logger
+
+# timestamp: epoch seconds; delta: grams moved, positive when readings were high.
+OffsetEvent = namedtuple('OffsetEvent', 'timestamp sensor old_offset new_offset delta')
+
+
+class AutoZeroTracker:
+    def __init__(self, sensor, zero_band=2.0, max_rate=0.5, threshold=1.0, window=20,
+                 min_step=0.05, name=None, on_event=None, history=100):
+        if window < 2:
+            raise ValueError("window must be >= 2")
+        self.sensor = sensor
+        self.zero_band = zero_band
+        self.max_rate = max_rate
+        self.threshold = threshold
+        self.window = window
+        self.min_step = min_step
+        self.name = name if name is not None else sensor.dout_pin
+        self.on_event = on_event
+        self.events = deque(maxlen=history)
+        # Sum of all corrections, in grams.
+        self.tracked = 0.0
+        self.enabled = True
+
+        self._values = np.zeros(window, dtype=np.float64)
+        self._filled = 0
+        # Timestamp of the last check, or of the first sample after a reset.
+        self._last_check = None
+
+    def update(self, value, timestamp=None):
+        # timestamp: epoch seconds of the sample (default: now).
+        if timestamp is None:
+            timestamp = time.time()
+        if self._last_check is None:
+            self._last_check = timestamp
+        self._values[self._filled] = value
+        self._filled += 1
+        if self._filled == self.window:
+            self._filled = 0
+            if self.enabled:
+                self._check(timestamp)
+
+    def _check(self, now):
+        elapsed = now - self._last_check
+        self._last_check = now
+
+        offset = self.sensor.hx.OFFSET
+        weights = self.sensor.raw_to_weight(self._values)
+        error = float(weights.mean())
+        if abs(error) > self.zero_band or abs(error) < self.min_step:
+            return
+        if not is_settled(weights.tolist(), self.threshold):
+            return
+
+        # Bounded tracking rate: move only part of the way when the error is
+        # larger than what max_rate allows in the time since the last check.
+        fraction = min(1.0, self.max_rate * elapsed / abs(error))
+        new_offset = offset + (float(self._values.mean()) - offset) * fraction
+        if self.sensor.hx.OFFSET != offset:
+            # Tared meanwhile; the window belongs to the old offset.
+            return
+        self.sensor.hx.set_offset(new_offset)
+        self.sensor.tared_at = now
+        self.tracked += error * fraction
+
+        event = OffsetEvent(self.sensor.tared_at, self.name, offset, new_offset, error * fraction)
+        self.events.append(event)
+        logger.info(f"Auto-zero sensor {self.name}: offset {offset:.1f} -> {new_offset:.1f} "
+                    f"({event.delta:+.3f} g)")
+        if self.on_event is not None:
+            try:
+                self.on_event(event)
+            except Exception as e:
+                logger.error(f"Auto-zero event handler failed: {e}")
+
+    def reset(self):
+        """Forget the partial window, e.g. after a tare."""
+        self._filled = 0
+        self._last_check = None
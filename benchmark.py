@@ -0,0 +1,543 @@
+"""Read-throughput benchmarks for the acquisition path.
+
+Everything runs against SimulatedHX711 chips, so the numbers can be taken on
+any Linux box and compared between changes:
+
+    python benchmark.py --rate 80 --json baseline.json
+    python benchmark.py --rate 80 --baseline baseline.json
+
+Every benchmark runs with one simulated chip per sensor in config.SENSOR_CONFIGS.
+We report operations/s, HX711 conversions consumed per second (all chips),
+per-operation latency percentiles and the CPU time spent by the process,
+which shows how much of a core the read path burns.  --metrics runs with
+the metrics of metrics.py enabled, to compare against the default disabled
+mode, and prints what they recorded.
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+from config import SENSOR_CONFIGS
+from gpio_backend import MmapGPIOBackend, RPiGPIOBackend, SimulatedBackend
+from metrics import REGISTRY
+from utils import logger
+
+# Single-sensor benchmarks use the pins of the first configured sensor.
+DOUT_PIN, PD_SCK_PIN = SENSOR_CONFIGS[1]
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a setup function taking (backend, ready_mode).
+
+    It returns the operation to time, or an (operation, teardown) pair.
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@benchmark('hx711.read')
+def setup_hx711_read(backend, ready_mode):
+    from hx711 import HX711
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, gpio=backend, ready_mode=ready_mode)
+    return hx.read
+
+
+@benchmark('hx711.read_average')
+def setup_hx711_read_average(backend, ready_mode):
+    from hx711 import HX711
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, gpio=backend, ready_mode=ready_mode)
+    return lambda: hx.read_average(5)
+
+
+@benchmark('hx711.tare')
+def setup_hx711_tare(backend, ready_mode):
+    from hx711 import HX711
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, gpio=backend, ready_mode=ready_mode)
+    return hx.tare
+
+
+@benchmark('hx711_o.read_long')
+def setup_hx711_o_read_long(backend, ready_mode):
+    from hx711_o import HX711
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, gpio=backend, ready_mode=ready_mode)
+    return hx.read_long
+
+
+@benchmark('hx711_o.read_average')
+def setup_hx711_o_read_average(backend, ready_mode):
+    from hx711_o import HX711
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, gpio=backend, ready_mode=ready_mode)
+    return lambda: hx.read_average(5)
+
+
+@benchmark('weight_sensor.get_weight')
+def setup_weight_sensor_get_weight(backend, ready_mode):
+    from weight_sensor import WeightSensor
+    sensor = WeightSensor(dout_pin=DOUT_PIN, pd_sck_pin=PD_SCK_PIN, gpio=backend,
+                          ready_mode=ready_mode)
+    sensor.set_reference_unit(100)
+    return sensor.get_weight
+
+
+@benchmark('weight_sensor.get_weight_sampled')
+def setup_weight_sensor_get_weight_sampled(backend, ready_mode):
+    from weight_sensor import WeightSensor
+    sensor = WeightSensor(dout_pin=DOUT_PIN, pd_sck_pin=PD_SCK_PIN, gpio=backend,
+                          ready_mode=ready_mode)
+    sensor.set_reference_unit(100)
+    sensor.start_sampling()
+    sensor.sampler.wait_for_samples(sensor.window)
+    return sensor.get_weight, sensor.stop_sampling
+
+
+@benchmark('hx711.tare adaptive')
+def setup_hx711_tare_adaptive(backend, ready_mode):
+    from hx711 import HX711
+    hx = HX711(DOUT_PIN, PD_SCK_PIN, gpio=backend, ready_mode=ready_mode)
+    return lambda: hx.tare(15, threshold=200)
+
+
+@benchmark('weight_sensor.get_settled_weight')
+def setup_weight_sensor_get_settled_weight(backend, ready_mode):
+    from weight_sensor import WeightSensor
+    sensor = WeightSensor(dout_pin=DOUT_PIN, pd_sck_pin=PD_SCK_PIN, gpio=backend,
+                          ready_mode=ready_mode)
+    sensor.set_reference_unit(100)
+    return lambda: sensor.get_settled_weight(threshold=2.0)
+
+
+@benchmark('hx711.read x4 sequential')
+def setup_hx711_read_sequential(backend, ready_mode):
+    from hx711 import HX711
+    sensors = [HX711(dout, sck, gpio=backend, ready_mode=ready_mode)
+               for dout, sck in SENSOR_CONFIGS.values()]
+    return lambda: [hx.read() for hx in sensors]
+
+
+@benchmark('multi_hx711.read')
+def setup_multi_hx711_read(backend, ready_mode):
+    from multi_hx711 import MultiHX711
+    multi = MultiHX711(SENSOR_CONFIGS, gpio=backend, ready_mode=ready_mode)
+    return multi.read
+
+
+@benchmark('weight_sensor.setup')
+def setup_weight_sensor_setup(backend, ready_mode):
+    from weight_sensor import WeightSensor
+    sensor = WeightSensor(dout_pin=DOUT_PIN, pd_sck_pin=PD_SCK_PIN, gpio=backend,
+                          ready_mode=ready_mode)
+    return sensor.setup
+
+
+@benchmark('weight_sensor.setup stored offset')
+def setup_weight_sensor_setup_stored(backend, ready_mode):
+    from calibration_store import SensorCalibration
+    from weight_sensor import WeightSensor
+    sensor = WeightSensor(dout_pin=DOUT_PIN, pd_sck_pin=PD_SCK_PIN, gpio=backend,
+                          ready_mode=ready_mode)
+    calibration = SensorCalibration(1, 100000.0, 100.0, tared_at=time.time())
+    return lambda: sensor.setup(calibration)
+
+
+@benchmark('weight_sensor startup x4 sequential')
+def setup_startup_sequential(backend, ready_mode):
+    from weight_sensor import WeightSensor
+
+    def start():
+        for dout, sck in SENSOR_CONFIGS.values():
+            sensor = WeightSensor(dout, sck, gpio=backend, ready_mode=ready_mode)
+            sensor.setup()
+            sensor.hx.close()
+    return start
+
+
+@benchmark('startup.start_sensors x4')
+def setup_start_sensors(backend, ready_mode):
+    from startup import start_sensors
+
+    def start():
+        sensors, _ = start_sensors(SENSOR_CONFIGS, gpio=backend, ready_mode=ready_mode)
+        for sensor in sensors.values():
+            sensor.hx.close()
+    return start
+
+
+@benchmark('calibration_store.load x4')
+def setup_calibration_store_load(backend, ready_mode):
+    import os
+    import tempfile
+    from calibration_store import SensorCalibration, load_calibration, save_calibration
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, 'calibration.hxc')
+    now = time.time()
+    save_calibration({sensor_id: SensorCalibration(sensor_id, 100000.0, 100.0, calibrated_at=now,
+                                                   tared_at=now)
+                      for sensor_id in SENSOR_CONFIGS}, path)
+    return lambda: load_calibration(path), directory.cleanup
+
+
+@benchmark('aggregator.window x4')
+def setup_aggregator_window(backend, ready_mode):
+    from aggregator import PlatformAggregator
+    from config import PLATFORM_POSITIONS
+    from weight_sensor import WeightSensor
+    sensors = {}
+    for sensor_id, (dout, sck) in SENSOR_CONFIGS.items():
+        sensor = sensors[sensor_id] = WeightSensor(dout, sck, gpio=backend, ready_mode=ready_mode)
+        sensor.set_reference_unit(100)
+        sensor.start_sampling()
+    for sensor in sensors.values():
+        sensor.sampler.wait_for_samples(10)
+    platform = PlatformAggregator(sensors, PLATFORM_POSITIONS)
+
+    def teardown():
+        for sensor in sensors.values():
+            sensor.stop_sampling()
+    # One second of frames at 80 SPS.
+    return lambda: platform.window(80), teardown
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class IntendedPowerDowns:
+    """Counts the power-downs of the simulated chips that HX711.power_down()
+    and MultiHX711.power_down() ask for (reset() uses them), so only the
+    ones caused by a read holding PD_SCK high too long are reported."""
+
+    def __init__(self, backend):
+        self.chips = {chip.pd_sck_pin: chip for chip in backend.chips}
+        self.count = 0
+        self._patched = []
+
+    def __enter__(self):
+        from hx711 import HX711
+        from multi_hx711 import MultiHX711
+        for cls, pins in ((HX711, lambda hx: [hx.PD_SCK]), (MultiHX711, lambda hx: hx.PD_SCKS)):
+            original = cls.power_down
+
+            def power_down(hx, original=original, pins=pins):
+                chips = [self.chips[pin] for pin in pins(hx) if pin in self.chips]
+                powered = [chip for chip in chips if chip.powered]
+                original(hx)
+                for chip in powered:
+                    chip.dout()  # notices the power-down without waiting for the next edge
+                    if not chip.powered:
+                        self.count += 1
+            cls.power_down = power_down
+            self._patched.append((cls, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for cls, original in self._patched:
+            cls.power_down = original
+        self._patched = []
+
+
+def run_benchmark(name, rate=10, ready_mode='interrupt', duration=2.0, min_iterations=3,
+                  value=100000, noise=50.0):
+    backend = SimulatedBackend.for_sensors(SENSOR_CONFIGS, rate=rate, value=value, noise=noise)
+    with IntendedPowerDowns(backend) as intended:
+        return _run_benchmark(name, backend, intended, rate, ready_mode, duration,
+                              min_iterations)
+
+
+def _run_benchmark(name, backend, intended, rate, ready_mode, duration, min_iterations):
+    operation = BENCHMARKS[name](backend, ready_mode)
+    teardown = None
+    if isinstance(operation, tuple):
+        operation, teardown = operation
+
+    latencies = []
+    conversions_before = sum(chip.conversions for chip in backend.chips)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        operation()
+        t1 = time.perf_counter()
+        latencies.append(t1 - t0)
+        if len(latencies) >= min_iterations and t1 - wall_start >= duration:
+            break
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    conversions = sum(chip.conversions for chip in backend.chips) - conversions_before
+    if teardown is not None:
+        teardown()
+    backend.cleanup()
+
+    latencies.sort()
+    return {
+        'name': name,
+        'rate': rate,
+        'ready_mode': ready_mode,
+        'iterations': len(latencies),
+        'ops_per_s': len(latencies) / wall,
+        'samples_per_s': conversions / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p90_ms': percentile(latencies, 0.90) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'max_ms': latencies[-1] * 1e3,
+        'cpu_s': cpu,
+        'cpu_util': cpu / wall,
+        'power_downs': sum(chip.power_downs for chip in backend.chips) - intended.count,
+    }
+
+
+def bit_backends(gpiomem_path=None):
+    """Backends available for the per-bit benchmark on this machine."""
+    backends = {}
+    try:
+        backends['rpi'] = RPiGPIOBackend()
+    except (ImportError, RuntimeError):
+        pass
+    if gpiomem_path:
+        backends['gpiomem'] = MmapGPIOBackend(gpiomem_path)
+    else:
+        backends['mmap (anonymous)'] = MmapGPIOBackend.anonymous()
+    return backends
+
+
+def run_bit_benchmark(name, gpio, cycles=100000):
+    """Cost of one clock bit: single sensor (2 output + 1 input) and four sensors in lockstep."""
+    douts = [dout for dout, _ in SENSOR_CONFIGS.values()]
+    scks = [sck for _, sck in SENSOR_CONFIGS.values()]
+    for pin in scks:
+        gpio.setup(pin, gpio.OUT)
+    for pin in douts:
+        gpio.setup(pin, gpio.IN)
+
+    output = gpio.output
+    read_pin = gpio.input
+    dout, sck = douts[0], scks[0]
+
+    t0 = time.perf_counter()
+    for _ in range(cycles):
+        output(sck, True)
+        output(sck, False)
+        read_pin(dout)
+    single = (time.perf_counter() - t0) / cycles
+
+    read_levels = getattr(gpio, 'read_levels', None)
+    t0 = time.perf_counter()
+    for _ in range(cycles):
+        output(scks, True)
+        output(scks, False)
+        if read_levels is not None:
+            levels = read_levels()
+            [(levels >> pin) & 1 for pin in douts]
+        else:
+            [read_pin(pin) for pin in douts]
+    multi = (time.perf_counter() - t0) / cycles
+
+    output(scks, False)
+    return {'name': name, 'single_ns': single * 1e9, 'multi_ns': multi * 1e9}
+
+
+def _busy(stop_event):
+    # Pure-Python work holding the GIL, standing in for the logging, HTTP
+    # and storage threads of the running system.
+    while not stop_event.is_set():
+        sum(i * i for i in range(10000))
+
+
+def run_jitter_benchmark(mode, rate=10, duration=10.0, load_threads=2, cpu=None, priority=None,
+                         max_slew=None, value=100000, noise=50.0):
+    """Sample every sensor for `duration` seconds with sampler threads in this
+    process (mode 'thread') or an AcquisitionProcess ('process'), while
+    load_threads busy threads run here.  Reports the spread of the intervals
+    between samples, conversions missed and samples off the simulated value."""
+    from acquisition import AcquisitionProcess
+    from hx711 import HX711
+    from sampler import Sampler
+
+    capacity = int(duration * rate * 2) + 16
+    backend = SimulatedBackend.for_sensors(SENSOR_CONFIGS, rate=rate, value=value, noise=noise)
+    if mode == 'thread':
+        samplers = [Sampler(HX711(dout, sck, gpio=backend, max_slew=max_slew), capacity)
+                    for dout, sck in SENSOR_CONFIGS.values()]
+        for sampler in samplers:
+            sampler.start()
+        rings = [sampler.ring for sampler in samplers]
+    else:
+        acquisition = AcquisitionProcess(SENSOR_CONFIGS, capacity, gpio=backend, max_slew=max_slew,
+                                         cpu=cpu, priority=priority)
+        acquisition.start()
+        rings = list(acquisition.rings.values())
+
+    stop_event = threading.Event()
+    load = [threading.Thread(target=_busy, args=(stop_event,), daemon=True)
+            for _ in range(load_threads)]
+    for thread in load:
+        thread.start()
+    # Skip the first conversions, taken while everything starts up.
+    time.sleep(0.5)
+    started = time.monotonic()
+    time.sleep(duration)
+    stop_event.set()
+    for thread in load:
+        thread.join()
+
+    if mode == 'thread':
+        for sampler in samplers:
+            sampler.stop()
+            sampler.hx.close()
+    else:
+        acquisition.close()
+    backend.cleanup()
+
+    period = 1.0 / rate
+    deviations, samples, missed, corrupted = [], 0, 0, 0
+    for ring in rings:
+        timestamps, values = ring.latest()
+        keep = timestamps >= started
+        timestamps, values = timestamps[keep], values[keep]
+        samples += len(values)
+        intervals = np.diff(timestamps)
+        steps = np.maximum(np.round(intervals / period), 1)
+        missed += int(np.sum(steps - 1))
+        deviations.extend(np.abs(intervals - steps * period).tolist())
+        corrupted += int(np.count_nonzero(np.abs(values - value) > max(10 * noise, 1)))
+    deviations.sort()
+    return {
+        'mode': mode,
+        'samples_per_s': samples / duration,
+        'jitter_p50_ms': percentile(deviations, 0.50) * 1e3,
+        'jitter_p99_ms': percentile(deviations, 0.99) * 1e3,
+        'jitter_max_ms': deviations[-1] * 1e3,
+        'missed': missed,
+        'corrupted': corrupted,
+    }
+
+
+def format_jitter_results(results):
+    header = "%-10s %10s %14s %14s %14s %8s %10s" % (
+        'mode', 'samples/s', 'jitter p50 ms', 'jitter p99 ms', 'jitter max ms', 'missed',
+        'corrupted')
+    lines = [header, '-' * len(header)]
+    for r in results:
+        lines.append("%-10s %10.2f %14.2f %14.2f %14.2f %8d %10d" % (
+            r['mode'], r['samples_per_s'], r['jitter_p50_ms'], r['jitter_p99_ms'],
+            r['jitter_max_ms'], r['missed'], r['corrupted']))
+    return '\n'.join(lines)
+
+
+def format_results(results, baseline=None):
+    header = "%-34s %8s %10s %9s %9s %9s %8s %6s" % (
+        'benchmark', 'ops/s', 'samples/s', 'p50 ms', 'p90 ms', 'p99 ms', 'cpu s', 'cpu%')
+    lines = [header, '-' * len(header)]
+    for r in results:
+        line = "%-34s %8.2f %10.2f %9.2f %9.2f %9.2f %8.3f %5.0f%%" % (
+            r['name'], r['ops_per_s'], r['samples_per_s'], r['p50_ms'], r['p90_ms'],
+            r['p99_ms'], r['cpu_s'], r['cpu_util'] * 100)
+        base = (baseline or {}).get(r['name'])
+        if base:
+            line += "   samples/s x%.2f, p50 x%.2f, cpu%% x%.2f" % (
+                r['samples_per_s'] / base['samples_per_s'] if base['samples_per_s'] else float('nan'),
+                r['p50_ms'] / base['p50_ms'] if base['p50_ms'] else float('nan'),
+                r['cpu_util'] / base['cpu_util'] if base['cpu_util'] else float('nan'))
+        if r['power_downs']:
+            line += "   (%d unintended power-downs)" % r['power_downs']
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the HX711 read path on simulated chips")
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                        help="benchmarks to run (default: all of %s)" % ', '.join(BENCHMARKS))
+    parser.add_argument('--rate', type=int, choices=(10, 80), default=10, help="HX711 output data rate")
+    parser.add_argument('--ready-mode', choices=('interrupt', 'poll'), default='interrupt',
+                        help="how the drivers wait for DOUT to go low")
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds per benchmark")
+    parser.add_argument('--bits', action='store_true',
+                        help="measure the per-bit GPIO cost of each available hardware backend instead")
+    parser.add_argument('--gpiomem', help="register block to map for --bits, e.g. /dev/gpiomem "
+                                          "(default: an anonymous mmap)")
+    parser.add_argument('--jitter', action='store_true',
+                        help="compare sample jitter and missed/corrupted samples of sampler threads "
+                             "and the acquisition process, under load, instead")
+    parser.add_argument('--load-threads', type=int, default=2,
+                        help="busy threads running during --jitter (default: 2)")
+    parser.add_argument('--cpu', type=int, help="CPU to pin the acquisition process to for --jitter")
+    parser.add_argument('--priority', type=int,
+                        help="SCHED_FIFO priority of the acquisition process for --jitter")
+    parser.add_argument('--max-slew', type=int,
+                        help="reject jumps of more than this many counts during --jitter")
+    parser.add_argument('--replay', metavar='RECORDING',
+                        help="time the post-acquisition pipeline on a recording (recording.py) instead")
+    parser.add_argument('--metrics', action='store_true',
+                        help="enable the metrics while benchmarking and print them afterwards")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--baseline', help="compare against results previously written with --json")
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.WARNING)
+    REGISTRY.enabled = args.metrics
+
+    if args.bits:
+        print("%-20s %16s %20s" % ('backend', 'ns/bit (1 sensor)', 'ns/bit (4 sensors)'))
+        for name, gpio in bit_backends(args.gpiomem).items():
+            r = run_bit_benchmark(name, gpio)
+            print("%-20s %16.0f %20.0f" % (name, r['single_ns'], r['multi_ns']))
+        return
+
+    if args.jitter:
+        results = [run_jitter_benchmark(mode, rate=args.rate, duration=args.duration,
+                                        load_threads=args.load_threads, cpu=args.cpu,
+                                        priority=args.priority, max_slew=args.max_slew)
+                   for mode in ('thread', 'process')]
+        print(format_jitter_results(results))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    if args.replay:
+        from calibration_store import load_calibration
+        from config import CALIBRATION_FILE
+        from recording import load_recording, replay_pipeline
+        try:
+            calibrations = load_calibration(CALIBRATION_FILE)
+        except FileNotFoundError:
+            calibrations = None
+        result = replay_pipeline(load_recording(args.replay), calibrations, auto_zero=True)
+        print("replayed %d samples in %.3f s: %.0f samples/s, %d load events"
+              % (result.samples, result.seconds, result.samples / result.seconds,
+                 len(result.events)))
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r['name']: r for r in json.load(f)}
+
+    results = []
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+        results.append(run_benchmark(name, rate=args.rate, ready_mode=args.ready_mode,
+                                     duration=args.duration))
+
+    print(format_results(results, baseline))
+    if args.metrics:
+        print()
+        print(REGISTRY.render(), end='')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
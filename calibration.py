@@ -1,12 +1,14 @@
+import argparse
 import time
-import pickle
+from calibration_model import CalibrationModel, KINDS
+from calibration_store import update_calibration
+from config import CALIBRATION_FILE, SENSOR_CONFIGS
 from weight_sensor import WeightSensor
 from utils import logger
-import RPi.GPIO as GPIO
 
 def check_connection(sensor):
     logger.info("Checking HX711 connection...")
-    if GPIO.input(sensor.hx.DOUT) == 0:
+    if sensor.hx.gpio.input(sensor.hx.DOUT) == 0:
         logger.info("HX711 DOUT pin is LOW (as expected when ready)")
     else:
         logger.warning("HX711 DOUT pin is HIGH (unexpected, might indicate a problem)")
@@ -21,8 +23,57 @@ def read_raw_values(sensor, num_readings=20):
         time.sleep(0.1)
     return raw_values
 
-def calibrate():
-    sensor = WeightSensor()
+def log_residuals(model):
+    logger.info(f"Calibration model: {model}")
+    for point in model.residuals():
+        logger.info(f"  {point.weight:10.2f} g  counts {point.counts:12.1f}  "
+                    f"predicted {point.predicted:10.2f} g  residual {point.residual:+.3f} g")
+    logger.info(f"Largest residual: {model.max_residual():.3f} g")
+
+def collect_points(sensor, tare_values):
+    # The empty scale is the first point; known weights are added until an empty entry.
+    counts = [sum(tare_values) / len(tare_values) - sensor.hx.OFFSET]
+    weights = [0.0]
+    while True:
+        entry = input("Place a known weight on the scale and enter the weight in grams "
+                      "(empty to finish): ").strip()
+        if not entry:
+            return counts, weights
+        known_weight = float(entry)
+        values = read_raw_values(sensor)
+        logger.info(f"Raw values with {known_weight}g: {values}")
+        counts.append(sum(values) / len(values) - sensor.hx.OFFSET)
+        weights.append(known_weight)
+
+def calibrate_multipoint(sensor, tare_values, kind, degree):
+    counts, weights = collect_points(sensor, tare_values)
+    try:
+        model = CalibrationModel(counts, weights, kind, degree)
+        linear = CalibrationModel(counts, weights, 'linear')
+    except ValueError as e:
+        logger.error(f"Unable to calibrate: {e}")
+        return False
+    log_residuals(model)
+    # A straight-line reference unit is kept for code that doesn't use the model.
+    reference_unit = float(1 / linear.slopes[0])
+    sensor.set_reference_unit(reference_unit)
+    sensor.set_calibration(model)
+    return True
+
+def save_calibration(sensor, sensor_id, temperature=None):
+    # Atomically replaces this sensor's entry, the other sensors' are kept.
+    sensor.calibrated_at = time.time()
+    update_calibration(sensor.calibration_record(sensor_id, temperature), CALIBRATION_FILE)
+    logger.info(f"Calibration of sensor {sensor_id} saved to {CALIBRATION_FILE}")
+
+def calibrate(kind=None, degree=2, sensor_id=1, temperature=None):
+    """Calibrate from one known weight, or with kind ('linear', 'polynomial',
+    'piecewise') from as many known weights as are entered.
+
+    sensor_id selects the pins from config.SENSOR_CONFIGS.
+    """
+    dout_pin, pd_sck_pin = SENSOR_CONFIGS[sensor_id]
+    sensor = WeightSensor(dout_pin, pd_sck_pin, sensor_id=sensor_id)
     sensor.setup()
 
     check_connection(sensor)
@@ -37,6 +88,17 @@ def calibrate():
     tare_values = read_raw_values(sensor)
     logger.info(f"Raw values after tare: {tare_values}")
 
+    if kind is not None:
+        if not calibrate_multipoint(sensor, tare_values, kind, degree):
+            sensor.cleanup()
+            return
+        save_calibration(sensor, sensor_id, temperature)
+        logger.info("Calibration complete")
+        measured_weight = sensor.get_weight()
+        logger.info(f"Verification: Measured weight: {measured_weight:.2f}g")
+        sensor.cleanup()
+        return
+
     known_weight = float(input("Place a known weight on the scale and enter the weight in grams: "))
     
     # Read raw values with weight
@@ -48,7 +110,8 @@ def calibrate():
         logger.info("Please check your wiring and ensure the HX711 is properly connected.")
         return
 
-    raw_value = sum(weight_values) / len(weight_values)
+    # Tare-relative, the offset set by the tare is not part of the weight.
+    raw_value = sum(weight_values) / len(weight_values) - sensor.hx.OFFSET
     logger.info(f"Average raw value: {raw_value}")
 
     if raw_value == 0:
@@ -62,10 +125,7 @@ def calibrate():
         return
 
     sensor.set_reference_unit(reference_unit)
-
-    calibration_data = {'reference_unit': reference_unit}
-    with open('calibration_data.pkl', 'wb') as f:
-        pickle.dump(calibration_data, f)
+    save_calibration(sensor, sensor_id, temperature)
 
     logger.info(f"Calibration complete. Reference unit: {reference_unit}")
 
@@ -76,4 +136,12 @@ def calibrate():
     sensor.cleanup()
 
 if __name__ == "__main__":
-    calibrate()
+    parser = argparse.ArgumentParser(description="Calibrate the HX711 load cell")
+    parser.add_argument('--model', choices=KINDS,
+                        help="fit this model to several known weights (default: one known weight)")
+    parser.add_argument('--degree', type=int, default=2, help="degree of the polynomial model")
+    parser.add_argument('--sensor', type=int, choices=sorted(SENSOR_CONFIGS), default=1,
+                        help="sensor id from config.SENSOR_CONFIGS (default: 1)")
+    parser.add_argument('--temperature', type=float, help="ambient temperature to record, in C")
+    args = parser.parse_args()
+    calibrate(args.model, args.degree, args.sensor, args.temperature)
@@ -0,0 +1,115 @@
+"""Multi-point calibration models.
+
+A model maps tare-relative counts (raw reading minus OFFSET) to grams.  It is
+fitted from several (counts, known weight) points -- the empty scale counts
+as the point (0, 0) -- as a straight line, a low-order polynomial or a
+piecewise-linear curve through the points, and then compiled into a segment
+table: sorted segment start knots with a slope and intercept each.  Applying
+the model to a block of samples is one searchsorted and one multiply-add over
+the whole array; a single-segment (linear) table skips the search.
+
+Polynomials are tabulated with TABLE_SEGMENTS segments across the calibrated
+range.  Outside the calibrated range every model extends its end segments.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+KINDS = ('linear', 'polynomial', 'piecewise')
+TABLE_SEGMENTS = 256
+MAX_DEGREE = 3
+
+# Fit of one calibration point: counts and known weight as entered,
+# predicted weight from the table, and predicted - weight.
+Residual = namedtuple('Residual', 'counts weight predicted residual')
+
+
+class CalibrationModel:
+    def __init__(self, counts, weights, kind='linear', degree=2):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown calibration model {kind!r}, expected one of {', '.join(KINDS)}")
+        counts = np.asarray(counts, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        if counts.shape != weights.shape or counts.ndim != 1:
+            raise ValueError("counts and weights must be sequences of the same length")
+        order = np.argsort(counts)
+        self.counts = counts[order]
+        self.weights = weights[order]
+        self.kind = kind
+        self.degree = degree if kind == 'polynomial' else 1
+
+        unique = len(np.unique(self.counts))
+        if unique < 2:
+            raise ValueError("At least two calibration points with different readings are needed")
+        if kind == 'polynomial':
+            if not 1 <= degree <= MAX_DEGREE:
+                raise ValueError(f"Polynomial degree must be between 1 and {MAX_DEGREE}")
+            if unique <= degree:
+                raise ValueError(f"A degree {degree} polynomial needs at least {degree + 1} points")
+        if kind == 'piecewise' and unique != len(self.counts):
+            raise ValueError("Piecewise calibration points must have different readings")
+
+        self.knots, self.slopes, self.intercepts = self._build_table()
+
+    def _build_table(self):
+        x, y = self.counts, self.weights
+        if self.kind == 'linear':
+            slope, intercept = np.polyfit(x, y, 1)
+            return np.array([x[0]]), np.array([slope]), np.array([intercept])
+
+        if self.kind == 'polynomial':
+            coefficients = np.polyfit(x, y, self.degree)
+            x = np.linspace(x[0], x[-1], TABLE_SEGMENTS + 1)
+            y = np.polyval(coefficients, x)
+
+        slopes = np.diff(y) / np.diff(x)
+        intercepts = y[:-1] - slopes * x[:-1]
+        return x[:-1].copy(), slopes, intercepts
+
+    def segments(self, counts):
+        """Index of the table segment used for each value of counts."""
+        return np.clip(np.searchsorted(self.knots, counts, side='right') - 1, 0, len(self.knots) - 1)
+
+    def apply(self, counts):
+        """Convert tare-relative counts (scalar or array) to grams."""
+        scalar = np.ndim(counts) == 0
+        counts = np.asarray(counts, dtype=np.float64)
+        if len(self.knots) == 1:
+            weights = counts * self.slopes[0] + self.intercepts[0]
+        else:
+            index = self.segments(counts)
+            weights = counts * self.slopes[index] + self.intercepts[index]
+        return float(weights) if scalar else weights
+
+    __call__ = apply
+
+    def slope(self, counts):
+        """Counts-to-grams slope of the table at counts (scalar or array)."""
+        if np.ndim(counts) == 0:
+            return float(self.slopes[self.segments(counts)])
+        return self.slopes[self.segments(counts)]
+
+    def residuals(self):
+        predicted = self.apply(self.counts)
+        return [Residual(float(c), float(w), float(p), float(p - w))
+                for c, w, p in zip(self.counts, self.weights, predicted)]
+
+    def max_residual(self):
+        return float(np.max(np.abs(self.apply(self.counts) - self.weights)))
+
+    def to_dict(self):
+        # The table is rebuilt from the points on load, so only they are stored.
+        return {
+            'kind': self.kind,
+            'degree': self.degree,
+            'points': [[float(c), float(w)] for c, w in zip(self.counts, self.weights)],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        counts, weights = zip(*data['points'])
+        return cls(counts, weights, data['kind'], data.get('degree', 2))
+
+    def __repr__(self):
+        return (f"CalibrationModel(kind={self.kind!r}, degree={self.degree}, "
+                f"points={len(self.counts)}, segments={len(self.knots)})")
@@ -0,0 +1,163 @@
+"""Versioned binary calibration file for all sensors.
+
+Layout, little-endian:
+
+    header   magic b'HXCL', version, sensor count, CRC-32 of everything after
+             the header
+    records  one per sensor: sensor id, channel (A/B), gain, offset,
+             reference unit, temperature (NaN if unknown), calibration time,
+             tare time, then the multi-point model (kind, degree, point
+             count) followed by its points as (counts, weight) doubles
+
+Loading is a few struct unpacks; the CalibrationModel of a record is only
+fitted when calibration_model() is called.  Files are replaced atomically, so
+a reader sees either the old or the new calibration, never a partial one.
+"""
+import math
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import namedtuple
+
+from calibration_model import CalibrationModel, KINDS
+from config import CALIBRATION_FILE
+
+MAGIC = b'HXCL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+RECORD = struct.Struct('<HcBddfddBBH')
+POINT = struct.Struct('<dd')
+
+# Model kinds on disk; 0 means no multi-point model.
+_KIND_CODES = {kind: code for code, kind in enumerate(KINDS, 1)}
+_CODE_KINDS = {code: kind for kind, code in _KIND_CODES.items()}
+
+_FIELDS = ('sensor_id offset reference_unit gain channel temperature '
+           'calibrated_at tared_at model')
+
+
+class SensorCalibration(namedtuple('SensorCalibration', _FIELDS)):
+    """Calibration of one sensor.  offset is in raw counts, taken at tared_at
+    (epoch seconds); model is a CalibrationModel.to_dict() or None."""
+
+    __slots__ = ()
+
+    def calibration_model(self):
+        if self.model is None:
+            return None
+        return CalibrationModel.from_dict(self.model)
+
+    def offset_age(self, now=None):
+        """Seconds since the offset was taken, None if never tared."""
+        if not self.tared_at:
+            return None
+        return (time.time() if now is None else now) - self.tared_at
+
+
+SensorCalibration.__new__.__defaults__ = (128, 'A', None, 0.0, 0.0, None)
+
+
+class CalibrationError(ValueError):
+    pass
+
+
+def _pack_record(record):
+    model = record.model or {}
+    points = model.get('points', [])
+    temperature = math.nan if record.temperature is None else record.temperature
+    data = RECORD.pack(record.sensor_id, record.channel.encode(), record.gain,
+                       record.offset, record.reference_unit, temperature,
+                       record.calibrated_at, record.tared_at,
+                       _KIND_CODES[model['kind']] if model else 0,
+                       model.get('degree', 0), len(points))
+    return data + b''.join(POINT.pack(counts, weight) for counts, weight in points)
+
+
+def encode_calibration(calibrations):
+    """Serialize {sensor_id: SensorCalibration} to bytes."""
+    body = b''.join(_pack_record(calibrations[sensor_id]) for sensor_id in sorted(calibrations))
+    return HEADER.pack(MAGIC, VERSION, len(calibrations), zlib.crc32(body)) + body
+
+
+def decode_calibration(data):
+    """Parse bytes written by encode_calibration(); raises CalibrationError."""
+    if len(data) < HEADER.size:
+        raise CalibrationError("Calibration file is truncated")
+    magic, version, count, checksum = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise CalibrationError("Not a calibration file")
+    if version != VERSION:
+        raise CalibrationError(f"Unsupported calibration file version {version}")
+    body = memoryview(data)[HEADER.size:]
+    if zlib.crc32(body) != checksum:
+        raise CalibrationError("Calibration file checksum mismatch")
+
+    calibrations = {}
+    position = 0
+    try:
+        for _ in range(count):
+            (sensor_id, channel, gain, offset, reference_unit, temperature, calibrated_at,
+             tared_at, kind, degree, points) = RECORD.unpack_from(body, position)
+            position += RECORD.size
+            model = None
+            if kind:
+                model = {'kind': _CODE_KINDS[kind], 'degree': degree,
+                         'points': [list(POINT.unpack_from(body, position + i * POINT.size))
+                                    for i in range(points)]}
+                position += points * POINT.size
+            calibrations[sensor_id] = SensorCalibration(
+                sensor_id, offset, reference_unit, gain, channel.decode(),
+                None if math.isnan(temperature) else temperature, calibrated_at, tared_at, model)
+    except (struct.error, KeyError) as e:
+        raise CalibrationError(f"Corrupt calibration record: {e}")
+    if position != len(body):
+        raise CalibrationError("Trailing data in calibration file")
+
+    for record in calibrations.values():
+        if record.reference_unit == 0 or not math.isfinite(record.reference_unit):
+            raise CalibrationError(f"Invalid reference unit for sensor {record.sensor_id}")
+        if not math.isfinite(record.offset):
+            raise CalibrationError(f"Invalid offset for sensor {record.sensor_id}")
+    return calibrations
+
+
+def load_calibration(path=CALIBRATION_FILE):
+    """{sensor_id: SensorCalibration}; raises FileNotFoundError or CalibrationError."""
+    with open(path, 'rb') as f:
+        return decode_calibration(f.read())
+
+
+def save_calibration(calibrations, path=CALIBRATION_FILE):
+    """Atomically replace the calibration file."""
+    data = encode_calibration(calibrations)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.calibration-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o644)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    # Make the rename itself durable.
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def update_calibration(record, path=CALIBRATION_FILE):
+    """Store the calibration of one sensor, keeping the others."""
+    try:
+        calibrations = load_calibration(path)
+    except FileNotFoundError:
+        calibrations = {}
+    calibrations[record.sensor_id] = record
+    save_calibration(calibrations, path)
+    return calibrations
@@ -0,0 +1,135 @@
+"""Interleaved channel A / channel B sampling for hx711_o.HX711.
+
+The pulses after the 24 data bits of a read select the channel and gain of
+the *next* conversion.  ChannelScheduler uses them to program the channel
+each conversion should have according to a repeating pattern, so every
+conversion is a usable sample of some channel -- unlike set_gain(), which
+throws a conversion away on every switch.  A ratio of (3, 1) at 10 SPS gives
+7.5 channel A and 2.5 channel B samples per second.
+
+Samples are attributed to a channel from the gain they were actually
+converted at (HX711.lastGain), and kept in one SampleRing per channel.
+"""
+import threading
+import time
+
+from filters import Mean
+from hx711_o import GAIN_PULSES
+from sampler import SampleRing, DEFAULT_CAPACITY
+from utils import logger
+
+CHANNELS = ('A', 'B')
+CHANNEL_B_GAIN = 32
+
+
+def interleave(ratio_A, ratio_B):
+    """One period of channel names with ratio_A A's and ratio_B B's spread evenly."""
+    if ratio_A < 0 or ratio_B < 0 or ratio_A + ratio_B == 0:
+        raise ValueError("Channel ratio must be non-negative and not all zero")
+    slots = [((k + 0.5) / ratio_A, 'A') for k in range(ratio_A)]
+    slots += [((k + 0.5) / ratio_B, 'B') for k in range(ratio_B)]
+    return [channel for _, channel in sorted(slots)]
+
+
+class ChannelScheduler(threading.Thread):
+    """Thread that reads an hx711_o.HX711 continuously, alternating channels
+    in the A:B `ratio`, into one SampleRing per channel.
+
+    Weights per channel are the weight_filter (default Mean) of the last
+    `window` samples, with the driver's OFFSET/REFERENCE_UNIT for channel A
+    and OFFSET_B/REFERENCE_UNIT_B for channel B.
+    """
+
+    ERROR_BACKOFF = 0.1
+
+    def __init__(self, hx, ratio=(1, 1), gain_A=128, capacity=DEFAULT_CAPACITY, window=10,
+                 weight_filter=None, name=None):
+        if gain_A not in (128, 64):
+            raise ValueError("Channel A gain must be 128 or 64")
+        super().__init__(name=name or f"channels-{hx.DOUT}", daemon=True)
+        self.hx = hx
+        self.pattern = interleave(*ratio)
+        self.gains = {'A': gain_A, 'B': CHANNEL_B_GAIN}
+        self.streams = {channel: SampleRing(capacity) for channel in CHANNELS}
+        self.window = window
+        self.weight_filter = weight_filter if weight_filter is not None else Mean()
+        self.conversions = 0
+        self._position = 0
+        self._stop_event = threading.Event()
+
+    def step(self):
+        """Read one conversion and program the channel of the one after it;
+        returns (channel, raw value)."""
+        self._position = (self._position + 1) % len(self.pattern)
+        return self._record(self.hx.read_long(self.gains[self.pattern[self._position]]))
+
+    def _record(self, value):
+        channel = 'B' if self.hx.lastGain == CHANNEL_B_GAIN else 'A'
+        self.streams[channel].append(time.monotonic(), value)
+        self.conversions += 1
+        return channel, value
+
+    def run(self):
+        logger.info(f"Channel scheduler started on DOUT={self.hx.DOUT} "
+                    f"(pattern {''.join(self.pattern)})")
+        while not self._stop_event.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Channel scheduler read error on DOUT={self.hx.DOUT}: {e}")
+                self._stop_event.wait(self.ERROR_BACKOFF)
+        # Program channel A for whoever reads the driver next; the sample
+        # read on the way is still kept.
+        try:
+            if self.hx.GAIN != GAIN_PULSES[self.gains['A']]:
+                self._record(self.hx.read_long(self.gains['A']))
+        except Exception as e:
+            logger.error(f"Channel scheduler could not restore channel A: {e}")
+        logger.info(f"Channel scheduler stopped on DOUT={self.hx.DOUT}")
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def wait_for_samples(self, channel, n, timeout=None):
+        """Block until n new samples of channel are in its ring; returns them."""
+        ring = self.streams[channel]
+        target = ring.count + n
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while ring.count < target:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Channel {channel} on DOUT={self.hx.DOUT} produced "
+                                   f"{n - (target - ring.count)} of {n} samples")
+            if not self.is_alive():
+                raise RuntimeError(f"Channel scheduler on DOUT={self.hx.DOUT} is not running")
+            time.sleep(0.01)
+        return ring.latest(n)
+
+    def _calibration(self, channel):
+        if channel == 'B':
+            return self.hx.get_offset_B(), self.hx.get_reference_unit_B()
+        return self.hx.get_offset_A(), self.hx.get_reference_unit_A()
+
+    def get_value(self, channel='A'):
+        """Filtered raw value of channel minus its offset, None before any sample."""
+        _, values = self.streams[channel].latest(self.window)
+        if not len(values):
+            return None
+        return float(self.weight_filter(values)) - self._calibration(channel)[0]
+
+    def get_weight(self, channel='A'):
+        value = self.get_value(channel)
+        if value is None:
+            return None
+        return value / self._calibration(channel)[1]
+
+    def tare(self, channel='A', times=15, timeout=None):
+        """Set the offset of channel from its next `times` samples."""
+        _, values = self.wait_for_samples(channel, times, timeout)
+        offset = float(self.hx.averageFilter(values))
+        if channel == 'B':
+            self.hx.set_offset_B(offset)
+        else:
+            self.hx.set_offset_A(offset)
+        return offset
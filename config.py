@@ -1,3 +1,6 @@
+# GPIO backend: 'rpi' (RPi.GPIO) or 'gpiomem' (memory-mapped GPIO registers)
+GPIO_BACKEND = 'rpi'
+
 # GPIO pin configurations for each HX711 sensor
 SENSOR_CONFIGS = {
     1: (5, 12),   # (DT, SCK)
@@ -6,9 +9,113 @@ SENSOR_CONFIGS = {
     4: (19, 26)
 }
 
-# Data persistence configuration
-DATA_SAVE_INTERVAL = 300  # Save data every 5 minutes
+# Platform geometry for aggregator.py: (x, y) of each sensor's corner, in mm,
+# and the corner-coupling matrix from aggregator.estimate_coupling (None:
+# corners don't affect each other)
+PLATFORM_POSITIONS = {
+    1: (0.0, 0.0),
+    2: (400.0, 0.0),
+    3: (0.0, 400.0),
+    4: (400.0, 400.0)
+}
+PLATFORM_COUPLING = None
+
+# Background sampling: ring buffer size per sensor and number of recent
+# samples averaged into each weight
+SAMPLE_BUFFER_SIZE = 1024
+WEIGHT_WINDOW = 10
+# Samples in the incrementally maintained median/trimmed-mean window
+# (None disables it and weights are filtered from the last WEIGHT_WINDOW samples)
+STATS_WINDOW = 200
+# Seconds a measured weight is reused by other get_weight callers
+WEIGHT_CACHE_MAX_AGE = 0.5
+
+# Adaptive settle detection: a weight is stable once the stddev and drift of
+# the last SETTLE_WINDOW samples are within SETTLE_THRESHOLD grams; give up
+# after SETTLE_MAX_SAMPLES samples or SETTLE_TIMEOUT seconds
+SETTLE_THRESHOLD = 1.0
+SETTLE_WINDOW = 5
+SETTLE_MAX_SAMPLES = 50
+SETTLE_TIMEOUT = 2.0
+
+# Validation of every conversion read (hx711.HX711): saturated or all-ones
+# codes and reads after which DOUT did not return high are rejected, and so
+# are jumps of more than READ_MAX_SLEW raw counts from the previous sample
+# that the next sample does not confirm (None disables the slew check).  A
+# read gives up after READ_MAX_RETRIES retries.
+READ_MAX_RETRIES = 3
+READ_MAX_SLEW = None
+# Seconds a read waits for the chip before it fails with a timeout and the
+# sensor counts as degraded (its sampler then resets it with backoff)
+READ_TIMEOUT = 1.0
+
+# Sample all sensors in a separate process (acquisition.py) instead of sampler
+# threads sharing the GIL with the rest of the system.  ACQUISITION_CPU pins
+# it to one CPU, ACQUISITION_PRIORITY runs it SCHED_FIFO at that priority
+# (1-99, needs root); None leaves either unchanged.
+ACQUISITION_PROCESS = False
+ACQUISITION_CPU = None
+ACQUISITION_PRIORITY = None
+
+# Calibration of every sensor (see calibration_store.py).  At startup a stored
+# offset younger than CALIBRATION_OFFSET_MAX_AGE seconds replaces the tare.
+CALIBRATION_FILE = 'calibration.hxc'
+CALIBRATION_OFFSET_MAX_AGE = 6 * 3600
+
+# Automatic zero tracking: while a sensor reads within AUTO_ZERO_BAND grams of
+# zero and is stable, its offset follows the drift by at most AUTO_ZERO_RATE
+# grams per second, checked every AUTO_ZERO_WINDOW samples.  Tracked offsets
+# are saved to CALIBRATION_FILE at most every AUTO_ZERO_SAVE_INTERVAL seconds.
+AUTO_ZERO_ENABLED = True
+AUTO_ZERO_BAND = 2.0
+AUTO_ZERO_RATE = 0.5
+AUTO_ZERO_WINDOW = 20
+AUTO_ZERO_MIN_STEP = 0.05
+AUTO_ZERO_SAVE_INTERVAL = 60
+
+# Load-change events (see load_events.py): a change is detected once the
+# CUSUM of the filtered weight's deviation beyond LOAD_EVENTS_DRIFT grams per
+# sample exceeds LOAD_EVENTS_THRESHOLD, and reported when the last
+# LOAD_EVENTS_SETTLE_WINDOW samples are within SETTLE_THRESHOLD grams.
+# Changes of at least LOAD_EVENTS_MIN_DELTA grams are items added or removed;
+# LOAD_CELL_CAPACITY is the rated load of one cell in grams (None: no
+# overload events).
+LOAD_EVENTS_ENABLED = True
+LOAD_EVENTS_DRIFT = 2.0
+LOAD_EVENTS_THRESHOLD = 20.0
+LOAD_EVENTS_MIN_DELTA = 5.0
+LOAD_EVENTS_SETTLE_WINDOW = 10
+LOAD_CELL_CAPACITY = 5000.0
+
+# Data persistence configuration: samples are appended to a binary log in
+# DATA_DIR (see sample_log.py), DATA_FILE is the default CSV export path
+DATA_SAVE_INTERVAL = 1  # Move sampled data to the log every second
+DATA_FSYNC_INTERVAL = 30  # At most one fsync every 30 seconds
+DATA_SEGMENT_BYTES = 16 * 1024 * 1024
+DATA_SEGMENT_SECONDS = 24 * 3600
+DATA_DIR = 'sensor_data'
 DATA_FILE = 'sensor_data.csv'
+# History rollups (see rollup.py): (resolution, retention) in seconds of each
+# tier of per-sensor min/max/mean/last buckets, saved as ROLLUP_FILE in
+# DATA_DIR every ROLLUP_SAVE_INTERVAL seconds; queries without a resolution
+# return at most about ROLLUP_MAX_POINTS buckets
+ROLLUP_TIERS = ((1, 6 * 3600), (60, 30 * 24 * 3600), (3600, 366 * 24 * 3600))
+ROLLUP_FILE = 'rollups.npz'
+ROLLUP_SAVE_INTERVAL = 300
+ROLLUP_MAX_POINTS = 1000
+# Raw stream recording for replay (see recording.py): the samples of every
+# sensor are written to RECORD_FILE for the first RECORD_SECONDS seconds
+# (None: until shutdown) after startup; None disables it
+RECORD_FILE = None
+RECORD_SECONDS = 600
 
 # Remote monitoring configuration
-WEB_SERVER_PORT = 8080
\ No newline at end of file
+WEB_SERVER_PORT = 8080
+# Seconds between snapshots served and streamed to web clients
+WEB_PUBLISH_INTERVAL = 0.1
+# Snapshots queued per streaming client before its oldest ones are dropped
+WEB_CLIENT_QUEUE = 16
+
+# Counters and latency histograms (metrics.py), served on /metrics.
+# Disabled, instrumented code skips all timing.
+METRICS_ENABLED = True
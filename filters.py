@@ -0,0 +1,144 @@
+"""Vectorized filtering of raw HX711 sample blocks.
+
+Every stage works on a NumPy block of samples along the last axis, so one
+call filters a window of a single sensor (shape (n,)) or of several sensors
+at once (shape (sensors, n)).  Stages either transform the block (Hampel,
+SavitzkyGolay, ExponentialMovingAverage) or reduce it to one value per
+sensor (TrimmedMean, Median, Mean, Last).  FilterPipeline chains them:
+
+    pipeline = FilterPipeline(Hampel(window=7), TrimmedMean(0.2))
+    weights = (pipeline(block) - offsets) / reference_units
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal, stats
+
+
+class FilterStage:
+    """Base class of the filter stages."""
+
+    # Reducing stages turn a block into one value per sensor.
+    reduces = False
+
+    def __call__(self, block):
+        return self.apply(np.asarray(block, dtype=np.float64))
+
+    def apply(self, block):
+        raise NotImplementedError
+
+    def __repr__(self):
+        params = ', '.join('%s=%r' % item for item in vars(self).items())
+        return '%s(%s)' % (type(self).__name__, params)
+
+
+class Mean(FilterStage):
+    reduces = True
+
+    def apply(self, block):
+        return block.mean(axis=-1)
+
+
+class Median(FilterStage):
+    reduces = True
+
+    def apply(self, block):
+        return np.median(block, axis=-1)
+
+
+class TrimmedMean(FilterStage):
+    """Mean after cutting `proportion` of the samples from each end, like
+    hx711_o.HX711.read_average does with 20%."""
+
+    reduces = True
+
+    def __init__(self, proportion=0.2):
+        if not 0 <= proportion < 0.5:
+            raise ValueError("proportion must be in [0, 0.5)")
+        self.proportion = proportion
+
+    def apply(self, block):
+        return stats.trim_mean(block, self.proportion, axis=-1)
+
+
+class Last(FilterStage):
+    """Most recent value, e.g. the current output of a moving average."""
+
+    reduces = True
+
+    def apply(self, block):
+        return block[..., -1]
+
+
+class ExponentialMovingAverage(FilterStage):
+    """y[i] = alpha * x[i] + (1 - alpha) * y[i-1], started at the first sample."""
+
+    def __init__(self, alpha=0.2):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+
+    def apply(self, block):
+        if block.shape[-1] == 0:
+            return block
+        b = [self.alpha]
+        a = [1.0, self.alpha - 1.0]
+        zi = signal.lfilter_zi(b, a) * block[..., :1]
+        filtered, _ = signal.lfilter(b, a, block, axis=-1, zi=zi)
+        return filtered
+
+
+class Hampel(FilterStage):
+    """Replace samples further than n_sigmas robust deviations from the
+    median of their centred window by that median."""
+
+    # Scales the median absolute deviation to a standard deviation.
+    MAD_SCALE = 1.4826
+
+    def __init__(self, window=7, n_sigmas=3.0):
+        if window < 3 or window % 2 == 0:
+            raise ValueError("window must be odd and >= 3")
+        self.window = window
+        self.n_sigmas = n_sigmas
+
+    def apply(self, block):
+        if block.shape[-1] < 3:
+            return block
+        half = min(self.window // 2, (block.shape[-1] - 1) // 2)
+        pad = [(0, 0)] * (block.ndim - 1) + [(half, half)]
+        windows = sliding_window_view(np.pad(block, pad, mode='edge'), 2 * half + 1, axis=-1)
+        medians = np.median(windows, axis=-1)
+        mad = self.MAD_SCALE * np.median(np.abs(windows - medians[..., None]), axis=-1)
+        outliers = np.abs(block - medians) > self.n_sigmas * mad
+        return np.where(outliers, medians, block)
+
+
+class SavitzkyGolay(FilterStage):
+    """Least-squares polynomial smoothing over a sliding window."""
+
+    def __init__(self, window=11, polyorder=2):
+        if window % 2 == 0 or window <= polyorder:
+            raise ValueError("window must be odd and greater than polyorder")
+        self.window = window
+        self.polyorder = polyorder
+
+    def apply(self, block):
+        n = block.shape[-1]
+        window = min(self.window, n if n % 2 else n - 1)
+        if window <= self.polyorder:
+            return block
+        return signal.savgol_filter(block, window, self.polyorder, axis=-1)
+
+
+class FilterPipeline(FilterStage):
+    """Runs stages in order; only the last one may reduce the block."""
+
+    def __init__(self, *stages):
+        if any(stage.reduces for stage in stages[:-1]):
+            raise ValueError("Only the last stage of a pipeline can reduce the block")
+        self.stages = stages
+        self.reduces = bool(stages) and stages[-1].reduces
+
+    def apply(self, block):
+        for stage in self.stages:
+            block = stage.apply(block)
+        return block
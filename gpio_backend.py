@@ -0,0 +1,513 @@
+"""GPIO backends for the HX711 drivers.
+
+The drivers never import RPi.GPIO themselves; they talk to the pins through
+a backend object.  RPiGPIOBackend drives real hardware through RPi.GPIO,
+MmapGPIOBackend drives it through the memory-mapped GPIO registers, and
+SimulatedBackend drives one or more SimulatedHX711 chips so the whole
+acquisition path can be run and measured on a plain Linux box.
+"""
+import logging
+import mmap
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger('weight_sensing_system')
+
+# Pin directions and edges understood by every backend.
+IN = 'in'
+OUT = 'out'
+FALLING = 'falling'
+RISING = 'rising'
+BOTH = 'both'
+
+
+class GPIOBackend:
+    """Interface used by the HX711 drivers to access the GPIO pins."""
+
+    IN = IN
+    OUT = OUT
+    FALLING = FALLING
+    RISING = RISING
+    BOTH = BOTH
+
+    def setup(self, pin, direction):
+        raise NotImplementedError
+
+    def output(self, pin, value):
+        # pin may also be a list of pins that are all set to value, as in RPi.GPIO.
+        raise NotImplementedError
+
+    def input(self, pin):
+        raise NotImplementedError
+
+    def add_event_detect(self, pin, edge, callback=None):
+        raise NotImplementedError
+
+    def remove_event_detect(self, pin):
+        raise NotImplementedError
+
+    def setwarnings(self, flag):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+class RPiGPIOBackend(GPIOBackend):
+    """Backend for real hardware, a thin layer over RPi.GPIO in BCM mode."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+
+        self._GPIO = GPIO
+        self._directions = {IN: GPIO.IN, OUT: GPIO.OUT}
+        self._edges = {FALLING: GPIO.FALLING, RISING: GPIO.RISING, BOTH: GPIO.BOTH}
+
+        GPIO.setmode(GPIO.BCM)
+
+        # output() and input() sit in the bit-banging loop, so bind the C
+        # functions directly instead of adding a Python call per bit.
+        self.output = GPIO.output
+        self.input = GPIO.input
+
+    def setup(self, pin, direction):
+        self._GPIO.setup(pin, self._directions[direction])
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self._GPIO.add_event_detect(pin, self._edges[edge], callback=callback)
+
+    def remove_event_detect(self, pin):
+        self._GPIO.remove_event_detect(pin)
+
+    def setwarnings(self, flag):
+        self._GPIO.setwarnings(flag)
+
+    def cleanup(self):
+        self._GPIO.cleanup()
+
+
+class MmapGPIOBackend(GPIOBackend):
+    """Backend for real hardware that writes the BCM283x/BCM2711 GPIO registers.
+
+    /dev/gpiomem is mapped into the process, so setting, clearing and reading
+    pins are plain word stores and loads instead of RPi.GPIO calls, and
+    read_levels() returns the level of pins 0-31 in a single load.  Any
+    mmap-like buffer of at least BLOCK_SIZE bytes can stand in for the
+    register block (see anonymous()), which is how it is exercised off the Pi.
+
+    The register block has no interrupt support; add_event_detect is
+    forwarded to the events backend if one is given and raises RuntimeError
+    otherwise, so DataReadyWaiter falls back to polling.
+    """
+
+    BLOCK_SIZE = 4096
+
+    # Word offsets of the registers used.
+    GPFSEL0 = 0x00 // 4
+    GPSET0 = 0x1c // 4
+    GPCLR0 = 0x28 // 4
+    GPLEV0 = 0x34 // 4
+
+    def __init__(self, path='/dev/gpiomem', buffer=None, events=None):
+        if buffer is None:
+            fd = os.open(path, os.O_RDWR | os.O_SYNC)
+            try:
+                buffer = mmap.mmap(fd, self.BLOCK_SIZE, mmap.MAP_SHARED,
+                                   mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+        self._buffer = buffer
+        self.registers = memoryview(buffer).cast('I')
+        self.events = events
+        # Per-bank set/clear masks of the pin lists passed to output().
+        self._masks = {}
+
+    @classmethod
+    def anonymous(cls, events=None):
+        """Backend over an anonymous mmap standing in for the register block."""
+        return cls(buffer=mmap.mmap(-1, cls.BLOCK_SIZE), events=events)
+
+    def setup(self, pin, direction):
+        index = self.GPFSEL0 + pin // 10
+        shift = (pin % 10) * 3
+        function = 1 if direction == OUT else 0
+        word = self.registers[index] & ~(7 << shift) & 0xffffffff
+        self.registers[index] = word | (function << shift)
+        if self.events is not None and direction == IN:
+            self.events.setup(pin, direction)
+
+    def output(self, pin, value):
+        if isinstance(pin, (list, tuple)):
+            # One store per bank sets or clears every pin of the list.
+            pins = tuple(pin)
+            masks = self._masks.get(pins)
+            if masks is None:
+                banks = {}
+                for p in pins:
+                    banks[p >> 5] = banks.get(p >> 5, 0) | (1 << (p & 31))
+                masks = self._masks[pins] = tuple(banks.items())
+            base = self.GPSET0 if value else self.GPCLR0
+            for bank, mask in masks:
+                self.registers[base + bank] = mask
+            return
+        self.registers[(self.GPSET0 if value else self.GPCLR0) + (pin >> 5)] = 1 << (pin & 31)
+
+    def input(self, pin):
+        return (self.registers[self.GPLEV0 + (pin >> 5)] >> (pin & 31)) & 1
+
+    def read_levels(self):
+        """Levels of GPIO 0-31 as one 32-bit word."""
+        return self.registers[self.GPLEV0]
+
+    def add_event_detect(self, pin, edge, callback=None):
+        if self.events is None:
+            raise RuntimeError("Edge detection is not available on the register backend")
+        self.events.add_event_detect(pin, edge, callback=callback)
+
+    def remove_event_detect(self, pin):
+        if self.events is not None:
+            self.events.remove_event_detect(pin)
+
+    def cleanup(self):
+        if self.events is not None:
+            self.events.cleanup()
+
+
+class SimulatedHX711:
+    """Timing model of one HX711 attached to a DOUT and a PD_SCK pin.
+
+    Conversions complete every 1/rate seconds.  DOUT goes low when an unread
+    conversion is available, the 24 data bits are shifted out MSB first on
+    the PD_SCK rising edges, and the number of pulses after the data bits
+    (25, 26 or 27) selects channel and gain for the next conversion.  Holding
+    PD_SCK high for more than power_down_us powers the chip down; pulling it
+    low again powers it up on channel A, gain 128, with the first conversion
+    ready after the output settling time (four conversion periods).
+
+    Independent chips run on their own oscillators, so each one starts at a
+    random phase within the conversion period unless phase is given.
+
+    The analog input is value (channel A counts at gain 128) and value_B
+    (channel B counts at gain 32) plus gaussian noise, or whatever
+    source(channel, gain, t) returns.  Results saturate to the 24-bit range.
+    """
+
+    GAIN_BY_PULSES = {25: ('A', 128), 26: ('B', 32), 27: ('A', 64)}
+    SETTLING_PERIODS = 4
+
+    def __init__(self, dout_pin, pd_sck_pin, rate=10, value=0, value_B=0,
+                 noise=0.0, source=None, power_down_us=60, phase=None,
+                 clock=time.monotonic):
+        if rate not in (10, 80):
+            raise ValueError("HX711 output data rate must be 10 or 80 SPS")
+
+        self.dout_pin = dout_pin
+        self.pd_sck_pin = pd_sck_pin
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.value = value
+        self.value_B = value_B
+        self.noise = noise
+        self.source = source
+        self.power_down_us = power_down_us
+        self.clock = clock
+
+        self.changed = threading.Condition()
+
+        self.channel = 'A'
+        self.gain = 128
+        self.powered = True
+        self.conversions = 0
+        self.power_downs = 0
+        # Incremented every time DOUT returns high, used to detect falling edges.
+        self.high_generation = 0
+
+        self._sck = False
+        self._sck_high_since = None
+        self._pulses = 0
+        self._word = 0
+        self._consumed = 0
+        if phase is None:
+            phase = random.uniform(0, self.period)
+        self._epoch = clock() - phase
+
+    def _index(self, now):
+        # Index of the latest completed conversion, the first one is 1.
+        return int((now - self._epoch) / self.period)
+
+    def _check_power_down(self, now):
+        if (self.powered and self._sck and self.power_down_us is not None
+                and now - self._sck_high_since > self.power_down_us * 1e-6):
+            self.powered = False
+            self.power_downs += 1
+            self.high_generation += 1
+            self.changed.notify_all()
+
+    def _analog(self, now):
+        if self.source is not None:
+            counts = self.source(self.channel, self.gain, now)
+        elif self.channel == 'B':
+            counts = self.value_B
+        else:
+            counts = self.value * self.gain / 128
+        if self.noise:
+            counts += random.gauss(0, self.noise)
+        return max(-0x800000, min(0x7fffff, int(round(counts))))
+
+    def _is_ready(self, now):
+        return (self.powered and (self._pulses == 0 or self._pulses >= 25)
+                and self._index(now) > self._consumed)
+
+    def dout(self):
+        with self.changed:
+            now = self.clock()
+            self._check_power_down(now)
+            if not self.powered:
+                return 1
+            if 0 < self._pulses <= 24:
+                return (self._word >> (24 - self._pulses)) & 1
+            return 0 if self._is_ready(now) else 1
+
+    def clock_pin(self, level):
+        level = bool(level)
+        with self.changed:
+            now = self.clock()
+            self._check_power_down(now)
+            if level == self._sck:
+                return
+            self._sck = level
+
+            if level:
+                self._sck_high_since = now
+                if not self.powered:
+                    return
+                if self._is_ready(now):
+                    # First rising edge of a frame latches the conversion.
+                    self._consumed = self._index(now)
+                    self._word = self._analog(now) & 0xffffff
+                    self._pulses = 1
+                    self.conversions += 1
+                elif self._pulses:
+                    self._pulses += 1
+                    if self._pulses == 25:
+                        # DOUT is back high.  Edge detectors are not woken here,
+                        # they sleep until the next conversion completes.
+                        self.high_generation += 1
+                    if self._pulses >= 25:
+                        self.channel, self.gain = self.GAIN_BY_PULSES[min(self._pulses, 27)]
+                return
+
+            if not self.powered:
+                # Power up: defaults to channel A / gain 128 and settles.
+                self.powered = True
+                self.channel, self.gain = 'A', 128
+                self._pulses = 0
+                self._consumed = 0
+                self._epoch = now + (self.SETTLING_PERIODS - 1) * self.period
+                self.changed.notify_all()
+
+    def next_ready_time(self):
+        """Time at which the next conversion completes, or None if powered down."""
+        with self.changed:
+            if not self.powered:
+                return None
+            return self._epoch + (max(self._consumed, self._index(self.clock())) + 1) * self.period
+
+
+class SimulatedBackend(GPIOBackend):
+    """Backend that routes DOUT/PD_SCK pins to SimulatedHX711 chips."""
+
+    def __init__(self, chips=()):
+        self.chips = []
+        self._by_dout = {}
+        self._by_sck = {}
+        self._levels = {}
+        self._directions = {}
+        self._detectors = {}
+        for chip in chips:
+            self.attach(chip)
+
+    @classmethod
+    def for_sensors(cls, sensor_configs, **chip_kwargs):
+        """Build a backend with one chip per (DT, SCK) pair of SENSOR_CONFIGS."""
+        return cls(SimulatedHX711(dout, sck, **chip_kwargs)
+                   for dout, sck in sensor_configs.values())
+
+    def attach(self, chip):
+        self.chips.append(chip)
+        self._by_dout[chip.dout_pin] = chip
+        self._by_sck[chip.pd_sck_pin] = chip
+        return chip
+
+    def chip(self, pin):
+        return self._by_dout.get(pin) or self._by_sck.get(pin)
+
+    def setup(self, pin, direction):
+        self._directions[pin] = direction
+
+    def output(self, pin, value):
+        if isinstance(pin, (list, tuple)):
+            for p in pin:
+                self.output(p, value)
+            return
+        chip = self._by_sck.get(pin)
+        if chip is not None:
+            chip.clock_pin(value)
+        else:
+            self._levels[pin] = 1 if value else 0
+
+    def input(self, pin):
+        chip = self._by_dout.get(pin)
+        if chip is not None:
+            return chip.dout()
+        return self._levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None):
+        if pin in self._detectors:
+            raise RuntimeError("Conflicting edge detection already enabled for GPIO %d" % pin)
+        chip = self._by_dout.get(pin)
+        if chip is None or edge != FALLING:
+            raise RuntimeError("Failed to add edge detection on GPIO %d" % pin)
+        detector = _FallingEdgeDetector(chip, callback)
+        self._detectors[pin] = detector
+        detector.start()
+
+    def remove_event_detect(self, pin):
+        detector = self._detectors.pop(pin, None)
+        if detector is not None:
+            detector.stop()
+
+    def cleanup(self):
+        for pin in list(self._detectors):
+            self.remove_event_detect(pin)
+        self._levels.clear()
+        self._directions.clear()
+
+
+class _FallingEdgeDetector(threading.Thread):
+    # Emulates the RPi.GPIO edge-detection thread for a simulated DOUT pin.
+
+    def __init__(self, chip, callback):
+        super().__init__(daemon=True)
+        self.chip = chip
+        self.callback = callback
+        self._running = True
+
+    def stop(self):
+        with self.chip.changed:
+            self._running = False
+            self.chip.changed.notify_all()
+        if threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        chip = self.chip
+        with chip.changed:
+            # An already low DOUT is not an edge.
+            fired = chip.high_generation if chip.dout() == 0 else None
+        while True:
+            with chip.changed:
+                while self._running:
+                    if chip.dout() == 0 and chip.high_generation != fired:
+                        fired = chip.high_generation
+                        break
+                    ready = chip.next_ready_time()
+                    timeout = 0.1 if ready is None else max(0.0, ready - chip.clock())
+                    chip.changed.wait(min(timeout, 0.1))
+                if not self._running:
+                    return
+            if self.callback is not None:
+                self.callback(chip.dout_pin)
+
+
+class DataReadyWaiter:
+    """Waits for an HX711 DOUT pin to go low without spinning on the GIL.
+
+    In 'interrupt' mode a falling-edge detector on DOUT wakes the waiting
+    thread; if the backend cannot detect edges on the pin, or in 'poll'
+    mode, DOUT is polled with an exponentially growing sleep instead.
+    """
+
+    MODES = ('interrupt', 'poll')
+
+    # The edge wait times out periodically so a missed edge costs at most
+    # this long instead of hanging the reader.
+    EDGE_TIMEOUT = 0.1
+    POLL_MIN = 0.0005
+    POLL_MAX = 0.005
+
+    def __init__(self, gpio, pin, mode='interrupt'):
+        if mode not in self.MODES:
+            raise ValueError("ready mode must be one of %s" % ', '.join(self.MODES))
+        self.gpio = gpio
+        self.pin = pin
+        self.mode = mode
+        self._edge = threading.Event()
+
+        if mode == 'interrupt':
+            try:
+                gpio.add_event_detect(pin, gpio.FALLING, callback=self._on_edge)
+            except RuntimeError as e:
+                logger.warning(f"Edge detection unavailable on GPIO {pin} ({e}), polling DOUT instead")
+                self.mode = 'poll'
+
+    def _on_edge(self, pin):
+        self._edge.set()
+
+    def wait(self, is_ready, timeout=None):
+        """Wait until is_ready() is true; returns False if timeout seconds
+        (None: no limit) passed first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.mode == 'interrupt':
+            while not is_ready():
+                wait = self.EDGE_TIMEOUT
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                self._edge.wait(wait)
+                self._edge.clear()
+            return True
+
+        interval = self.POLL_MIN
+        while not is_ready():
+            sleep = interval
+            if deadline is not None:
+                sleep = min(sleep, deadline - time.monotonic())
+                if sleep <= 0:
+                    return False
+            time.sleep(sleep)
+            interval = min(interval * 2, self.POLL_MAX)
+        return True
+
+    def close(self):
+        if self.mode == 'interrupt':
+            self.gpio.remove_event_detect(self.pin)
+            self.mode = 'poll'
+
+
+_default_backend = None
+
+
+def create_backend(name):
+    """Create a hardware backend by name: 'rpi' or 'gpiomem'."""
+    if name == 'rpi':
+        return RPiGPIOBackend()
+    if name == 'gpiomem':
+        return MmapGPIOBackend()
+    raise ValueError("Unknown GPIO backend %r" % name)
+
+
+def get_default_backend():
+    """Return the process-wide backend, creating an RPiGPIOBackend on first use."""
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = RPiGPIOBackend()
+    return _default_backend
+
+
+def set_default_backend(backend):
+    global _default_backend
+    _default_backend = backend
@@ -1,31 +1,119 @@
-import RPi.GPIO as GPIO
 import time
 import threading
+from collections import Counter
+
+from gpio_backend import DataReadyWaiter, get_default_backend
+from metrics import REGISTRY, ReadMetrics
+from settle import read_until_settled
+
+# Raw 24-bit words no healthy conversion of an in-range load produces: the two
+# saturation codes, and all ones, which is what a chip that powered down in
+# the middle of a read shifts out.
+INVALID_CODES = {0x7fffff: 'saturated', 0x800000: 'saturated', 0xffffff: 'all_ones'}
+# Every reason check_conversion() rejects a conversion for.
+REJECT_REASONS = ('saturated', 'all_ones', 'dout_low', 'slew')
+
+
+def check_conversion(value, dout_high, last, suspect, max_slew):
+    """Reason to reject a conversion, None if it is valid.  last is the
+    previous accepted value (None: no slew check), suspect the last value
+    rejected for slew in this read, which value may confirm."""
+    reason = INVALID_CODES.get(value & 0xffffff)
+    if reason is not None:
+        return reason
+    if not dout_high:
+        return 'dout_low'
+    if (max_slew is not None and last is not None and abs(value - last) > max_slew
+            and (suspect is None or abs(value - suspect) > max_slew)):
+        return 'slew'
+    return None
+
+
+class CorruptSampleError(ValueError):
+    """Every read within the retry budget returned a rejected conversion."""
+
+
+class ReadTimeoutError(TimeoutError):
+    """The HX711 did not deliver a conversion before the deadline."""
+
+
+def time_left(deadline):
+    """Seconds until a time.monotonic() deadline, None without one; raises
+    ReadTimeoutError once it has passed."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise ReadTimeoutError("Deadline passed")
+    return remaining
+
+
+def deadline_after(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
 
 class HX711:
-    def __init__(self, dout_pin, pd_sck_pin, gain=128):
+    """HX711 driver that validates every conversion it reads.
+
+    A conversion is rejected if it is one of INVALID_CODES, if DOUT did not
+    return high after the final clock pulse (the read ran into the next
+    conversion or the chip glitched), or if it differs from the previous
+    accepted value by more than max_slew counts -- unless the next read
+    confirms the new level, so real load changes pass after one extra
+    conversion.  read() retries up to max_retries times, then raises
+    CorruptSampleError.  Rejections by reason and retries are counted in
+    self.rejected and self.retries.
+
+    A read waits at most read_timeout seconds (None: forever) for the read
+    lock and the conversions it needs, then raises ReadTimeoutError, so an
+    unplugged sensor or a DOUT stuck high cannot hang its callers.  read(),
+    get_value(), get_weight(), read_average() and tare() take a timeout for
+    the whole call instead.
+
+    HX711s that are read from several threads can share a clock_lock: each
+    read still waits for its own conversion concurrently, but clocks it out
+    only while holding the lock, so the bit-bang loops never compete for
+    the CPU and hold SCK high long enough to power a chip down.
+
+    sensor_id (default: the DOUT pin) is the `sensor` label of its metrics.
+    """
+
+    def __init__(self, dout_pin, pd_sck_pin, gain=128, gpio=None, ready_mode='interrupt',
+                 max_retries=3, max_slew=None, read_timeout=1.0, clock_lock=None,
+                 sensor_id=None):
         self.PD_SCK = pd_sck_pin
         self.DOUT = dout_pin
+        self.sensor_id = dout_pin if sensor_id is None else sensor_id
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.PD_SCK, GPIO.OUT)
-        GPIO.setup(self.DOUT, GPIO.IN)
+        self.gpio = gpio if gpio is not None else get_default_backend()
+        self.gpio.setup(self.PD_SCK, self.gpio.OUT)
+        self.gpio.setup(self.DOUT, self.gpio.IN)
 
         self.GAIN = 0
         self.REFERENCE_UNIT = 1
         self.OFFSET = 1
-        self.lastVal = int(0)
+        # Last accepted value, None when the next one cannot be slew-checked.
+        self.lastVal = None
+
+        self.max_retries = max_retries
+        self.max_slew = max_slew
+        self.read_timeout = read_timeout
+        self.rejected = Counter()
+        self.retries = 0
 
         self.isNegative = False
         self.MSBIndex = 0
         self.LSBIndex = 0
 
         self.readLock = threading.Lock()
+        self.clockLock = clock_lock
+        self.dataReady = DataReadyWaiter(self.gpio, self.DOUT, ready_mode)
+        self.metrics = ReadMetrics(self.sensor_id)
 
         self.set_gain(gain)
 
     def is_ready(self):
-        return GPIO.input(self.DOUT) == 0
+        return self.gpio.input(self.DOUT) == 0
 
     def set_gain(self, gain):
         if gain == 128:
@@ -37,42 +125,113 @@ class HX711:
         else:
             raise ValueError("Gain must be 128, 64, or 32")
 
-        GPIO.output(self.PD_SCK, False)
+        self.gpio.output(self.PD_SCK, False)
+        self.lastVal = None
         self.read()
 
-    def read(self):
-        with self.readLock:
-            while not self.is_ready():
-                pass
+    def read(self, timeout=None):
+        # timeout: seconds for the whole read, retries included (default read_timeout).
+        if timeout is None:
+            timeout = self.read_timeout
+        deadline = deadline_after(timeout)
+        suspect = None
+        for attempt in range(self.max_retries + 1):
+            value, dout_high = self._read_conversion(deadline)
+            reason = self._check(value, dout_high, suspect)
+            if reason is None:
+                self.lastVal = value
+                return value
 
-            value = 0
-            for i in range(24):
-                GPIO.output(self.PD_SCK, True)
-                GPIO.output(self.PD_SCK, False)
-                value = (value << 1) | GPIO.input(self.DOUT)
+            self.rejected[reason] += 1
+            if REGISTRY.enabled:
+                self.metrics.record_rejected(reason)
+            if reason == 'slew':
+                suspect = value
+            if attempt < self.max_retries:
+                self.retries += 1
+                if REGISTRY.enabled:
+                    self.metrics.retries.inc()
+        raise CorruptSampleError(f"No valid conversion from the HX711 on DOUT={self.DOUT} "
+                                 f"in {self.max_retries + 1} reads (last: {reason})")
 
-            for _ in range(self.GAIN):
-                GPIO.output(self.PD_SCK, True)
-                GPIO.output(self.PD_SCK, False)
+    def _check(self, value, dout_high, suspect):
+        return check_conversion(value, dout_high, self.lastVal, suspect, self.max_slew)
+
+    def _read_conversion(self, deadline=None):
+        # One conversion as clocked out, and whether DOUT was back high
+        # after the final pulse.
+        # Timestamps only when metrics are enabled, to keep the disabled cost
+        # to a single attribute check.
+        timed = REGISTRY.enabled
+        if timed:
+            started = time.perf_counter()
+        if deadline is None:
+            self.readLock.acquire()
+        elif not self.readLock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise ReadTimeoutError(f"HX711 on DOUT={self.DOUT} is busy, read lock not acquired in time")
+        try:
+            if timed:
+                locked = time.perf_counter()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not self.dataReady.wait(self.is_ready, remaining):
+                raise ReadTimeoutError(f"HX711 on DOUT={self.DOUT} did not signal data ready in time")
+            if timed:
+                ready = time.perf_counter()
+
+            if self.clockLock is None:
+                value, dout_high = self._clock_out()
+            else:
+                with self.clockLock:
+                    value, dout_high = self._clock_out()
 
             if value & 0x800000:  # negative flag is set
                 value -= 1 << 24
+        finally:
+            self.readLock.release()
+
+        if timed:
+            self.metrics.record_read(started, locked, ready, time.perf_counter())
+        return value, dout_high
 
-            return value
+    def _clock_out(self):
+        value = 0
+        for i in range(24):
+            self.gpio.output(self.PD_SCK, True)
+            self.gpio.output(self.PD_SCK, False)
+            value = (value << 1) | self.gpio.input(self.DOUT)
 
-    def get_value(self):
-        return self.read() - self.OFFSET
+        for _ in range(self.GAIN):
+            self.gpio.output(self.PD_SCK, True)
+            self.gpio.output(self.PD_SCK, False)
+        return value, self.gpio.input(self.DOUT) == 1
 
-    def get_weight(self, times=3):
+    def get_value(self, timeout=None):
+        return self.read(timeout) - self.OFFSET
+
+    def get_weight(self, times=3, timeout=None):
+        deadline = deadline_after(timeout)
         values = []
         for _ in range(times):
-            values.append(self.get_value())
+            values.append(self.get_value(time_left(deadline)))
         return sum(values) / len(values) / self.REFERENCE_UNIT
 
-    def tare(self, times=15):
+    def tare(self, times=15, threshold=None, timeout=None):
+        # With a threshold (raw counts), stop as soon as the readings have
+        # settled; times is then the maximum number of reads.
+        started = time.perf_counter()
+        deadline = deadline_after(timeout)
+        reference_unit = self.REFERENCE_UNIT
         self.set_reference_unit(1)
-        self.OFFSET = self.read_average(times)
-        self.set_reference_unit(self.REFERENCE_UNIT)
+        try:
+            if threshold is None:
+                self.OFFSET = self.read_average(times, timeout)
+            else:
+                self.OFFSET = read_until_settled(lambda: self.read(time_left(deadline)), threshold,
+                                                 max_samples=max(times, 5)).value
+        finally:
+            self.set_reference_unit(reference_unit)
+        if REGISTRY.enabled:
+            self.metrics.tare.observe(time.perf_counter() - started)
 
     def set_reading_format(self, byte_format="MSB", bit_format="MSB"):
         if byte_format == "LSB":
@@ -98,22 +257,28 @@ class HX711:
         self.REFERENCE_UNIT = reference_unit
 
     def power_down(self):
-        GPIO.output(self.PD_SCK, False)
-        GPIO.output(self.PD_SCK, True)
+        self.gpio.output(self.PD_SCK, False)
+        self.gpio.output(self.PD_SCK, True)
         time.sleep(0.0001)
 
     def power_up(self):
-        GPIO.output(self.PD_SCK, False)
+        self.gpio.output(self.PD_SCK, False)
         time.sleep(0.0001)
 
     def reset(self):
-        self.power_down()
-        self.power_up()
+        with self.readLock:
+            self.power_down()
+            self.power_up()
+        self.lastVal = None
+
+    def close(self):
+        self.dataReady.close()
 
-    def read_average(self, times=3):
+    def read_average(self, times=3, timeout=None):
+        deadline = deadline_after(timeout)
         values = []
         for _ in range(times):
-            values.append(self.read())
+            values.append(self.read(time_left(deadline)))
         return sum(values) / len(values)
 
 # Additional methods can be added as needed
@@ -1,10 +1,19 @@
-import RPi.GPIO as GPIO
 import time
 import threading
 
+import numpy as np
+
+from filters import Median, TrimmedMean
+from gpio_backend import DataReadyWaiter, get_default_backend
+from metrics import REGISTRY, ReadMetrics
+
+# Extra clock pulses after the 24 data bits for each gain: they select the
+# channel and gain of the *next* conversion (A/128, A/64, B/32).
+GAIN_PULSES = {128: 1, 64: 3, 32: 2}
+
 class HX711:
 
-    def __init__(self, dout, pd_sck, gain=128):
+    def __init__(self, dout, pd_sck, gain=128, gpio=None, ready_mode='interrupt'):
         self.PD_SCK = pd_sck
 
         self.DOUT = dout
@@ -13,11 +22,20 @@ class HX711:
         # software try to access get values from the class at the same time.
         self.readLock = threading.Lock()
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.PD_SCK, GPIO.OUT)
-        GPIO.setup(self.DOUT, GPIO.IN)
+        self.gpio = gpio if gpio is not None else get_default_backend()
+        self.gpio.setup(self.PD_SCK, self.gpio.OUT)
+        self.gpio.setup(self.DOUT, self.gpio.IN)
+
+        # Waits for DOUT to go low, on a falling-edge interrupt when the
+        # backend supports it, polling with a backoff otherwise.
+        self.dataReady = DataReadyWaiter(self.gpio, self.DOUT, ready_mode)
+
+        # Read and tare timings, recorded while metrics.REGISTRY is enabled.
+        self.metrics = ReadMetrics(self.DOUT)
 
         self.GAIN = 0
+        # Gain of the conversion returned by the last read.
+        self.lastGain = 128
 
         # The value returned by the hx711 that corresponds to your reference
         # unit AFTER dividing by the SCALE.
@@ -33,10 +51,14 @@ class HX711:
         self.byte_format = 'MSB'
         self.bit_format = 'MSB'
 
-        self.set_gain(gain)
+        # Filters used by read_average() and read_median(), any stage or
+        # pipeline from filters.py that reduces a block to a value.
+        self.averageFilter = TrimmedMean(0.2)
+        self.medianFilter = Median()
 
-        # Think about whether this is necessary.
-        time.sleep(1)
+        # set_gain() waits for DOUT and reads once, so the chip is ready and
+        # the next conversion uses the requested gain; no extra sleep needed.
+        self.set_gain(gain)
 
 
     def convertFromTwosComplement24bit(self, inputValue):
@@ -44,7 +66,7 @@ class HX711:
 
 
     def is_ready(self):
-        return GPIO.input(self.DOUT) == 0
+        return self.gpio.input(self.DOUT) == 0
 
 
     def set_gain(self, gain):
@@ -55,7 +77,7 @@ class HX711:
         elif gain == 32:
             self.GAIN = 2
 
-        GPIO.output(self.PD_SCK, False)
+        self.gpio.output(self.PD_SCK, False)
 
         # Read out a set of raw bytes and throw it away.
         self.readRawBytes()
@@ -77,9 +99,9 @@ class HX711:
        # Clock HX711 Digital Serial Clock (PD_SCK).  DOUT will be
        # ready 1us after PD_SCK rising edge, so we sample after
        # lowering PD_SCL, when we know DOUT will be stable.
-       GPIO.output(self.PD_SCK, True)
-       GPIO.output(self.PD_SCK, False)
-       value = GPIO.input(self.DOUT)
+       self.gpio.output(self.PD_SCK, True)
+       self.gpio.output(self.PD_SCK, False)
+       value = self.gpio.input(self.DOUT)
 
        # Convert Boolean to int and return it.
        return int(value)
@@ -102,14 +124,24 @@ class HX711:
        return byteValue
 
 
-    def readRawBytes(self):
+    def readRawBytes(self, next_gain=None):
+        # next_gain: gain to program for the following conversion with this
+        # read's trailing pulses; by default the current gain is kept.  The
+        # gain of the conversion being read is left in self.lastGain.
+        timed = REGISTRY.enabled
+        if timed:
+            started = time.perf_counter()
+
         # Wait for and get the Read Lock, in case another thread is already
         # driving the HX711 serial interface.
         self.readLock.acquire()
+        if timed:
+            locked = time.perf_counter()
 
         # Wait until HX711 is ready for us to read a sample.
-        while not self.is_ready():
-           pass
+        self.dataReady.wait(self.is_ready)
+        if timed:
+            ready = time.perf_counter()
 
         # Read three bytes of data from the HX711.
         firstByte  = self.readNextByte()
@@ -118,6 +150,9 @@ class HX711:
 
         # HX711 Channel and gain factor are set by number of bits read
         # after 24 data bits.
+        self.lastGain = self.get_gain()
+        if next_gain is not None:
+            self.GAIN = GAIN_PULSES[next_gain]
         for i in range(self.GAIN):
            # Clock a bit out of the HX711 and throw it away.
            self.readNextBit()
@@ -126,6 +161,9 @@ class HX711:
         # serial interface.
         self.readLock.release()
 
+        if timed:
+            self.metrics.record_read(started, locked, ready, time.perf_counter())
+
         # Depending on how we're configured, return an ordered list of raw byte
         # values.
         if self.byte_format == 'LSB':
@@ -134,9 +172,9 @@ class HX711:
            return [firstByte, secondByte, thirdByte]
 
 
-    def read_long(self):
+    def read_long(self, next_gain=None):
         # Get a sample from the HX711 in the form of raw bytes.
-        dataBytes = self.readRawBytes()
+        dataBytes = self.readRawBytes(next_gain)
 
 
         if self.DEBUG_PRINTING:
@@ -160,6 +198,15 @@ class HX711:
         return int(signedIntValue)
 
 
+    def read_block(self, times, next_gain=None):
+        # Collect `times` samples into an int32 array for the filters.  The
+        # last read programs next_gain, so switching back after a block on
+        # another channel costs no extra conversion.
+        block = np.fromiter((self.read_long() for x in range(times - 1)), dtype=np.int32,
+                            count=times - 1)
+        return np.append(block, np.int32(self.read_long(next_gain)))
+
+
     def read_average(self, times=3):
         # Make sure we've been asked to take a rational amount of samples.
         if times <= 0:
@@ -174,23 +221,10 @@ class HX711:
         if times < 5:
             return self.read_median(times)
 
-        # If we're taking a lot of samples, we'll collect them in a list, remove
-        # the outliers, then take the mean of the remaining set.
-        valueList = []
-
-        for x in range(times):
-            valueList += [self.read_long()]
-
-        valueList.sort()
-
-        # We'll be trimming 20% of outlier samples from top and bottom of collected set.
-        trimAmount = int(len(valueList) * 0.2)
-
-        # Trim the edge case values.
-        valueList = valueList[trimAmount:-trimAmount]
-
-        # Return the mean of remaining samples.
-        return sum(valueList) / len(valueList)
+        # If we're taking a lot of samples, we'll collect them in an array and
+        # filter it, by default trimming 20% of outliers from top and bottom
+        # and taking the mean of the rest.
+        return float(self.averageFilter(self.read_block(times)))
 
 
     # A median-based read method, might help when getting random value spikes
@@ -203,21 +237,8 @@ class HX711:
        if times == 1:
           return self.read_long()
 
-       valueList = []
-
-       for x in range(times):
-          valueList += [self.read_long()]
-
-       valueList.sort()
-
-       # If times is odd we can just take the centre value.
-       if (times & 0x1) == 0x1:
-          return valueList[len(valueList) // 2]
-       else:
-          # If times is even we have to take the arithmetic mean of
-          # the two middle values.
-          midpoint = len(valueList) / 2
-          return sum(valueList[midpoint:midpoint+2]) / 2.0
+       # Median of the block, the mean of the two middle values if times is even.
+       return float(self.medianFilter(self.read_block(times)))
 
 
     # Compatibility function, uses channel A version
@@ -230,12 +251,12 @@ class HX711:
 
 
     def get_value_B(self, times=3):
-        # for channel B, we need to set_gain(32)
+        # for channel B, we need to set_gain(32); the last channel B read
+        # programs the previous gain again.
         g = self.get_gain()
         self.set_gain(32)
-        value = self.read_median(times) - self.get_offset_B()
-        self.set_gain(g)
-        return value
+        value = float(self.medianFilter(self.read_block(max(times, 1), next_gain=g)))
+        return value - self.get_offset_B()
 
     # Compatibility function, uses channel A version
     def get_weight(self, times=3):
@@ -255,7 +276,11 @@ class HX711:
 
     # Sets tare for channel A for compatibility purposes
     def tare(self, times=15):
-        return self.tare_A(times)
+        started = time.perf_counter()
+        value = self.tare_A(times)
+        if REGISTRY.enabled:
+            self.metrics.tare.observe(time.perf_counter() - started)
+        return value
 
 
     def tare_A(self, times=15):
@@ -282,18 +307,24 @@ class HX711:
         self.set_reference_unit_B(1)
 
         # for channel B, we need to set_gain(32)
+        if times <= 0:
+            raise ValueError("HX711()::tare_B(): times must >= 1!!")
         backupGain = self.get_gain()
         self.set_gain(32)
 
-        value = self.read_average(times)
+        # Filtered like read_average(); the last read restores the gain.
+        block = self.read_block(times, next_gain=backupGain)
+        if times < 5:
+            value = float(self.medianFilter(block))
+        else:
+            value = float(self.averageFilter(block))
 
         if self.DEBUG_PRINTING:
             print("Tare B value:", value)
 
         self.set_offset_B(value)
 
-        # Restore gain/channel/reference unit settings.
-        self.set_gain(backupGain)
+        # Restore the reference unit setting.
         self.set_reference_unit_B(backupReferenceUnit)
 
         return value
@@ -378,8 +409,8 @@ class HX711:
         # Because a rising edge on HX711 Digital Serial Clock (PD_SCK).  We then
         # leave it held up and wait 100us.  After 60us the HX711 should be
         # powered down.
-        GPIO.output(self.PD_SCK, False)
-        GPIO.output(self.PD_SCK, True)
+        self.gpio.output(self.PD_SCK, False)
+        self.gpio.output(self.PD_SCK, True)
 
         time.sleep(0.0001)
 
@@ -394,7 +425,7 @@ class HX711:
         self.readLock.acquire()
 
         # Lower the HX711 Digital Serial Clock (PD_SCK) line.
-        GPIO.output(self.PD_SCK, False)
+        self.gpio.output(self.PD_SCK, False)
 
         # Wait 100 us for the HX711 to power back up.
         time.sleep(0.0001)
@@ -415,8 +446,13 @@ class HX711:
         self.power_down()
         self.power_up()
 
+
+    def close(self):
+        # Stop the DOUT edge detection used to wait for samples.
+        self.dataReady.close()
+
 def hx711_add_event_detect(hx711_instance, event_callback):
-        GPIO.add_event_detect(self.DOUT, GPIO.FALLING,
-            callback=event_callback)
+        hx711_instance.gpio.add_event_detect(hx711_instance.DOUT,
+            hx711_instance.gpio.FALLING, callback=event_callback)
 
 # EOF - hx711.py
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""Load-change events from the live sample stream.
+
+A LoadChangeDetector runs as a sampler estimator, like the auto-zero
+tracker, so it sees every sample as it is read.  It keeps an exponentially
+filtered weight and runs a two-sided CUSUM of its difference from the last
+settled weight: small noise below `drift` grams per sample never adds up,
+while a real step crosses `threshold` within a few samples.  From then on it
+waits until the last `settle_window` weights are stable and emits one event
+with the settled weight and its change:
+
+    added      the settled weight rose by at least min_delta grams
+    removed    it fell by at least min_delta grams
+    settled    it moved and came back within min_delta grams
+    overload   the filtered weight went above capacity (once, until it drops
+               below OVERLOAD_RELEASE of it)
+
+so an event follows a change by about the CUSUM delay plus the settle time.
+Event times are those of the samples, so a replayed stream gives the same
+events as the live one.
+Events go to an EventBus, which calls its callbacks in the sampler thread and
+queues them for asyncio subscribers.
+"""
+import asyncio
+import threading
+import time
+from collections import deque, namedtuple
+
+from metrics import REGISTRY
+from settle import is_settled
+from utils import logger
+
+KINDS = ('added', 'removed', 'settled', 'overload')
+
+# timestamp: epoch seconds of the sample the event was detected at; started:
+# epoch seconds of the sample the change began at (CUSUM change point); weight: settled (or, for overload,
+# filtered) weight in grams; delta: grams changed since the last settled weight.
+LoadEvent = namedtuple('LoadEvent', 'kind sensor timestamp started weight delta')
+
+LOAD_EVENTS = REGISTRY.counter('load_events_total', "Load events published, by kind",
+                               ['sensor', 'kind'])
+
+
+class EventBus:
+    """Delivers events to callbacks and asyncio subscribers.
+
+    Callbacks run in the publishing thread and must be quick.  Every
+    subscriber has its own queue of queue_size events; a subscriber that
+    falls behind loses its oldest events.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.callbacks = []
+        self.published = 0
+        self.dropped = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def publish(self, event):
+        self.published += 1
+        for callback in list(self.callbacks):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Load event callback failed: {e}")
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, event)
+            except RuntimeError:
+                # The subscriber's loop is closed.
+                pass
+
+    def _put(self, queue, event):
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(event)
+
+    async def subscribe(self):
+        """Async iterator over the events published from now on."""
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(self.queue_size))
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            while True:
+                yield await subscriber[1].get()
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+
+class LoadChangeDetector:
+    # The overload event re-arms once the weight is below this fraction of capacity.
+    OVERLOAD_RELEASE = 0.95
+
+    def __init__(self, sensor, bus, name=None, alpha=0.3, drift=2.0, threshold=20.0,
+                 min_delta=5.0, settle_window=10, settle_threshold=1.0, capacity=None):
+        if settle_window < 2:
+            raise ValueError("settle_window must be >= 2")
+        self.sensor = sensor
+        self.bus = bus
+        self.name = name if name is not None else sensor.sensor_id
+        self.alpha = alpha
+        self.drift = drift
+        self.threshold = threshold
+        self.min_delta = min_delta
+        self.settle_threshold = settle_threshold
+        self.capacity = capacity
+        self._weights = deque(maxlen=settle_window)
+        self.reset()
+
+    def reset(self):
+        """Start over from the next settled weight, e.g. after a tare."""
+        self.baseline = None
+        self.changing = False
+        self.overloaded = False
+        self._filtered = None
+        self._weights.clear()
+        # The CUSUM starts once a weight has settled.
+        self._reset_cusum(None)
+
+    def _reset_cusum(self, now):
+        self._high = self._low = 0.0
+        self._high_since = self._low_since = now
+        self._started = None
+
+    def update(self, value, timestamp=None):
+        # timestamp: epoch seconds of the sample (default: now).
+        now = time.time() if timestamp is None else timestamp
+        weight = float(self.sensor.raw_to_weight(value))
+        self._weights.append(weight)
+        if self._filtered is None:
+            self._filtered = weight
+        else:
+            self._filtered += self.alpha * (weight - self._filtered)
+
+        if self.capacity is not None:
+            if not self.overloaded and self._filtered > self.capacity:
+                self.overloaded = True
+                delta = self._filtered - self.baseline if self.baseline is not None else 0.0
+                self._emit('overload', now, now, self._filtered, delta)
+            elif self.overloaded and self._filtered < self.capacity * self.OVERLOAD_RELEASE:
+                self.overloaded = False
+
+        if self.baseline is None or self.changing:
+            self._check_settled(now)
+            return
+
+        error = self._filtered - self.baseline
+        self._high = max(0.0, self._high + error - self.drift)
+        self._low = max(0.0, self._low - error - self.drift)
+        # The change started when the sum last left zero.
+        if self._high == 0.0:
+            self._high_since = now
+        if self._low == 0.0:
+            self._low_since = now
+        if self._high > self.threshold or self._low > self.threshold:
+            self.changing = True
+            self._started = self._high_since if self._high > self.threshold else self._low_since
+
+    def _check_settled(self, now):
+        if len(self._weights) < self._weights.maxlen or not is_settled(self._weights,
+                                                                       self.settle_threshold):
+            return
+        weight = sum(self._weights) / len(self._weights)
+        previous, started = self.baseline, self._started
+        self.baseline = weight
+        self._filtered = weight
+        self.changing = False
+        self._reset_cusum(now)
+        if previous is None:
+            # First settled weight: the reference, not a change.
+            return
+        delta = weight - previous
+        if delta >= self.min_delta:
+            kind = 'added'
+        elif delta <= -self.min_delta:
+            kind = 'removed'
+        else:
+            kind = 'settled'
+        self._emit(kind, now, started, weight, delta)
+
+    def _emit(self, kind, now, started, weight, delta):
+        event = LoadEvent(kind, self.name, now, started, weight, delta)
+        logger.debug(f"Load event: {event}")
+        if REGISTRY.enabled:
+            LOAD_EVENTS.labels(self.name, kind).inc()
+        self.bus.publish(event)
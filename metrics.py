@@ -0,0 +1,259 @@
+"""Low-overhead counters, gauges and latency histograms.
+
+Instrumented code checks REGISTRY.enabled before taking any timestamps, so
+with metrics disabled (the default until main() enables them from
+config.METRICS_ENABLED) the hot paths pay one attribute lookup.  Values are
+available as Python dicts (REGISTRY.collect()) and in the Prometheus text
+exposition format (REGISTRY.render(), served on /metrics).
+
+Updates are not locked; an increment can very rarely be lost when two
+threads update the same series at the same moment.
+"""
+import bisect
+import math
+
+# 10 us .. ~10 s, four buckets per decade.
+DEFAULT_BUCKETS = tuple(round(10 ** (e / 4), 9) for e in range(-20, 5))
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[n] for n in self.labelnames)
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        # Metric without labels: the single child.
+        return self.labels()
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Counter incremented by the code, or read from existing counters by
+    `function` at collection time (returning a value, or a dict of
+    label-value tuple -> value)."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        super().__init__(name, help, labelnames)
+        self.function = function
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def collect(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                self.labels(*labels).value = value
+        return {values: child.value for values, child in self._children.items()}
+
+    def render(self):
+        self.collect()
+        for values, child in self._children.items():
+            yield '%s%s %s' % (self.name, _label_text(self.labelnames, values), _format_value(child.value))
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(Counter):
+    """Gauge set by the code, or computed by `function` like Counter."""
+
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q (None if empty)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def collect(self):
+        return {values: {'count': child.count, 'sum': child.sum,
+                         'p50': child.quantile(0.5), 'p90': child.quantile(0.9),
+                         'p99': child.quantile(0.99)}
+                for values, child in self._children.items()}
+
+    def render(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                labels = _label_text(self.labelnames, values, [('le', _format_value(bound))])
+                yield '%s_bucket%s %d' % (self.name, labels, cumulative)
+            labels = _label_text(self.labelnames, values)
+            yield '%s_sum%s %r' % (self.name, labels, child.sum)
+            yield '%s_count%s %d' % (self.name, labels, child.count)
+
+
+class Registry:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics = {}
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=(), function=None):
+        return self._register(Counter(name, help, labelnames, function))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self._register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collect(self):
+        """All metrics as {name: {label values: value}}."""
+        return {name: metric.collect() for name, metric in self.metrics.items()}
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Acquisition path, labelled by the sensor id (the DOUT pin if it has none).
+READS = REGISTRY.counter('hx711_reads_total', "Conversions read from the HX711", ['sensor'])
+READ_SECONDS = REGISTRY.histogram('hx711_read_seconds', "Total time of one read", ['sensor'])
+LOCK_WAIT_SECONDS = REGISTRY.histogram('hx711_lock_wait_seconds',
+                                       "Time waiting for the read lock", ['sensor'])
+READY_WAIT_SECONDS = REGISTRY.histogram('hx711_ready_wait_seconds',
+                                        "Time waiting for DOUT to signal data ready", ['sensor'])
+CLOCK_SECONDS = REGISTRY.histogram('hx711_clock_seconds',
+                                   "Time clocking the data and gain bits out", ['sensor'])
+TARE_SECONDS = REGISTRY.histogram('hx711_tare_seconds', "Duration of a tare", ['sensor'])
+REJECTED = REGISTRY.counter('hx711_rejected_total', "Conversions rejected as corrupt, by reason",
+                            ['sensor', 'reason'])
+RETRIES = REGISTRY.counter('hx711_retries_total', "Reads retried after a rejected conversion",
+                           ['sensor'])
+
+
+class ReadMetrics:
+    """Per-sensor children of the acquisition metrics, looked up once."""
+
+    def __init__(self, sensor):
+        sensor = str(sensor)
+        self.sensor = sensor
+        self.reads = READS.labels(sensor)
+        self.read = READ_SECONDS.labels(sensor)
+        self.lock_wait = LOCK_WAIT_SECONDS.labels(sensor)
+        self.ready_wait = READY_WAIT_SECONDS.labels(sensor)
+        self.clock = CLOCK_SECONDS.labels(sensor)
+        self.tare = TARE_SECONDS.labels(sensor)
+        self.retries = RETRIES.labels(sensor)
+
+    def record_read(self, started, locked, ready, finished):
+        self.reads.inc()
+        self.read.observe(finished - started)
+        self.lock_wait.observe(locked - started)
+        self.ready_wait.observe(ready - locked)
+        self.clock.observe(finished - ready)
+
+    def record_rejected(self, reason):
+        REJECTED.labels(self.sensor, reason).inc()
@@ -0,0 +1,280 @@
+import time
+import threading
+from collections import Counter
+
+from gpio_backend import DataReadyWaiter, get_default_backend
+from hx711 import CorruptSampleError, ReadTimeoutError, check_conversion, deadline_after
+from metrics import REGISTRY, REJECTED, ReadMetrics
+
+
+class MultiHX711Channel:
+    """Offset and reference unit of one load cell read by a MultiHX711."""
+
+    def __init__(self, sensor_id, dout_pin, pd_sck_pin):
+        self.sensor_id = sensor_id
+        self.DOUT = dout_pin
+        self.PD_SCK = pd_sck_pin
+        self.REFERENCE_UNIT = 1
+        self.OFFSET = 1
+        # Last accepted value, None when the next one cannot be slew-checked.
+        self.lastVal = None
+
+    def set_offset(self, offset):
+        self.OFFSET = offset
+
+    def get_offset(self):
+        return self.OFFSET
+
+    def set_reference_unit(self, reference_unit):
+        if reference_unit == 0:
+            raise ValueError("Reference unit can't be 0")
+        self.REFERENCE_UNIT = reference_unit
+
+    def get_reference_unit(self):
+        return self.REFERENCE_UNIT
+
+
+class MultiHX711:
+    """Reads several HX711s in one pass.
+
+    Waits until every DOUT line is low at the same time, then clocks all
+    sensors together and samples each DOUT pin on every clock, so one
+    bit-bang cycle yields an aligned frame with one raw value per sensor.
+    sensor_pins maps a sensor id to its (DT, SCK) pins, as in
+    config.SENSOR_CONFIGS; frames are lists in the order of sensor_ids.
+
+    Every conversion of a frame is validated like hx711.HX711.read() does
+    (max_retries, max_slew); a frame with a rejected conversion is read
+    again, and read() raises CorruptSampleError once the retries are used
+    up, or ReadTimeoutError when not every sensor is ready within
+    read_timeout seconds.
+
+    A frame waits for the slowest chip, and a backend that sets pins one by
+    one clocks each sensor separately per bit, so on RPi.GPIO or the
+    simulator this is not faster than reading the chips one after another.
+    What it gives is aligned frames from a single clocking thread.
+    """
+
+    def __init__(self, sensor_pins, gain=128, gpio=None, ready_mode='interrupt',
+                 max_retries=3, max_slew=None, read_timeout=1.0):
+        self.gpio = gpio if gpio is not None else get_default_backend()
+        self.max_retries = max_retries
+        self.max_slew = max_slew
+        self.read_timeout = read_timeout
+        self.rejected = Counter()
+        self.retries = 0
+
+        self.sensor_ids = list(sensor_pins)
+        self.channels = {sensor_id: MultiHX711Channel(sensor_id, dout, sck)
+                         for sensor_id, (dout, sck) in sensor_pins.items()}
+        self.DOUTS = [self.channels[i].DOUT for i in self.sensor_ids]
+        self.PD_SCKS = [self.channels[i].PD_SCK for i in self.sensor_ids]
+
+        for pin in self.PD_SCKS:
+            self.gpio.setup(pin, self.gpio.OUT)
+        for pin in self.DOUTS:
+            self.gpio.setup(pin, self.gpio.IN)
+
+        self.GAIN = 0
+        self.lastFrame = None
+
+        # Backends that can read all pin levels at once (MmapGPIOBackend).
+        self.read_levels = None
+        if hasattr(self.gpio, 'read_levels') and max(self.DOUTS) < 32:
+            self.read_levels = self.gpio.read_levels
+
+        self.readLock = threading.Lock()
+        self.dataReady = [DataReadyWaiter(self.gpio, pin, ready_mode) for pin in self.DOUTS]
+        # One series for the whole frame, labelled with all sensor ids.
+        self.metrics = ReadMetrics('+'.join(str(sensor_id) for sensor_id in self.sensor_ids))
+
+        self.set_gain(gain)
+
+    def channel(self, sensor_id):
+        return self.channels[sensor_id]
+
+    def is_ready(self):
+        return all(self.gpio.input(pin) == 0 for pin in self.DOUTS)
+
+    def set_gain(self, gain):
+        if gain == 128:
+            self.GAIN = 1
+        elif gain == 64:
+            self.GAIN = 3
+        elif gain == 32:
+            self.GAIN = 2
+        else:
+            raise ValueError("Gain must be 128, 64, or 32")
+
+        self.gpio.output(self.PD_SCKS, False)
+        for channel in self.channels.values():
+            channel.lastVal = None
+        self.read()
+
+    def read(self, timeout=None):
+        """Read one conversion from every sensor; returns raw values in sensor_ids order.
+        timeout: seconds for the whole read, retries included (default read_timeout)."""
+        if timeout is None:
+            timeout = self.read_timeout
+        deadline = deadline_after(timeout)
+        channels = [self.channels[sensor_id] for sensor_id in self.sensor_ids]
+        suspects = [None] * len(channels)
+        for attempt in range(self.max_retries + 1):
+            values, dout_high = self._read_frame(deadline)
+            reasons = [check_conversion(value, high, channel.lastVal, suspect, self.max_slew)
+                       for value, high, channel, suspect
+                       in zip(values, dout_high, channels, suspects)]
+            if not any(reasons):
+                for channel, value in zip(channels, values):
+                    channel.lastVal = value
+                self.lastFrame = values
+                return values
+
+            for i, reason in enumerate(reasons):
+                if reason is None:
+                    continue
+                self.rejected[reason] += 1
+                if REGISTRY.enabled:
+                    REJECTED.labels(channels[i].sensor_id, reason).inc()
+                if reason == 'slew':
+                    suspects[i] = values[i]
+            if attempt < self.max_retries:
+                self.retries += 1
+                if REGISTRY.enabled:
+                    self.metrics.retries.inc()
+        rejected = ', '.join(f"DOUT={channel.DOUT}: {reason}"
+                             for channel, reason in zip(channels, reasons) if reason)
+        raise CorruptSampleError(f"No valid frame from the HX711s in {self.max_retries + 1} "
+                                 f"reads (last: {rejected})")
+
+    def _read_frame(self, deadline):
+        # One frame as clocked out, and per sensor whether DOUT was back high
+        # after the final pulse.
+        output = self.gpio.output
+        read_pin = self.gpio.input
+        sck = self.PD_SCKS
+        douts = self.DOUTS
+
+        timed = REGISTRY.enabled
+        if timed:
+            started = time.perf_counter()
+        if deadline is None:
+            self.readLock.acquire()
+        elif not self.readLock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise ReadTimeoutError(f"HX711s on DOUT={douts} are busy, read lock not acquired in time")
+        try:
+            if timed:
+                locked = time.perf_counter()
+            # Wait until all DOUT lines are low at once: a sensor found ready
+            # earlier may be updating its conversion by the time the last
+            # one is, so every wait is followed by a check of all of them.
+            while True:
+                waiting = [i for i, pin in enumerate(douts) if read_pin(pin) != 0]
+                if not waiting:
+                    break
+                pin = douts[waiting[0]]
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or not self.dataReady[waiting[0]].wait(
+                        lambda: read_pin(pin) == 0, remaining):
+                    raise ReadTimeoutError(
+                        f"HX711s on DOUT={[douts[i] for i in waiting]} did not signal data "
+                        f"ready in time")
+            if timed:
+                ready = time.perf_counter()
+
+            values = [0] * len(douts)
+            if self.read_levels is not None:
+                # One store per edge clocks every sensor, one register load
+                # gives the level of every DOUT pin.
+                read_levels = self.read_levels
+                for _ in range(24):
+                    output(sck, True)
+                    output(sck, False)
+                    levels = read_levels()
+                    values = [(value << 1) | ((levels >> pin) & 1)
+                              for value, pin in zip(values, douts)]
+            else:
+                # The backend sets the pins one by one: pulse every clock on
+                # its own, so no PD_SCK stays high while the others are set.
+                for _ in range(24):
+                    for pin in sck:
+                        output(pin, True)
+                        output(pin, False)
+                    values = [(value << 1) | read_pin(pin) for value, pin in zip(values, douts)]
+
+            for _ in range(self.GAIN):
+                for pin in sck:
+                    output(pin, True)
+                    output(pin, False)
+            dout_high = [read_pin(pin) == 1 for pin in douts]
+            for pin, clock, high in zip(douts, sck, dout_high):
+                if not high and read_pin(pin) == 0:
+                    # Its next conversion landed during the frame.  Clock it
+                    # out alone, so the next frame starts after it instead of
+                    # running into the same conversion edge again.
+                    for _ in range(24 + self.GAIN):
+                        output(clock, True)
+                        output(clock, False)
+        finally:
+            self.readLock.release()
+
+        if timed:
+            self.metrics.record_read(started, locked, ready, time.perf_counter())
+        values = [value - (1 << 24) if value & 0x800000 else value for value in values]
+        return values, dout_high
+
+    def read_average(self, times=3):
+        if times <= 0:
+            raise ValueError("times must be >= 1")
+        sums = [0] * len(self.sensor_ids)
+        for _ in range(times):
+            sums = [total + value for total, value in zip(sums, self.read())]
+        return [total / times for total in sums]
+
+    def get_values(self, times=3):
+        averages = self.read_average(times)
+        return [value - self.channels[i].OFFSET for i, value in zip(self.sensor_ids, averages)]
+
+    def get_weights(self, times=3):
+        values = self.get_values(times)
+        return [value / self.channels[i].REFERENCE_UNIT for i, value in zip(self.sensor_ids, values)]
+
+    def tare(self, times=15):
+        """Set every channel's offset from the same `times` frames; returns the offsets."""
+        started = time.perf_counter()
+        offsets = self.read_average(times)
+        for sensor_id, offset in zip(self.sensor_ids, offsets):
+            self.channels[sensor_id].set_offset(offset)
+        if REGISTRY.enabled:
+            self.metrics.tare.observe(time.perf_counter() - started)
+        return offsets
+
+    def set_offset(self, sensor_id, offset):
+        self.channels[sensor_id].set_offset(offset)
+
+    def set_reference_unit(self, sensor_id, reference_unit):
+        self.channels[sensor_id].set_reference_unit(reference_unit)
+
+    def power_down(self):
+        with self.readLock:
+            self.gpio.output(self.PD_SCKS, False)
+            self.gpio.output(self.PD_SCKS, True)
+            time.sleep(0.0001)
+
+    def power_up(self):
+        with self.readLock:
+            self.gpio.output(self.PD_SCKS, False)
+            time.sleep(0.0001)
+
+        # The chips power up on channel A / gain 128, throw one frame away
+        # if another gain was requested.
+        if self.GAIN != 1:
+            self.read()
+
+    def reset(self):
+        self.power_down()
+        self.power_up()
+
+    def close(self):
+        for waiter in self.dataReady:
+            waiter.close()
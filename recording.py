@@ -0,0 +1,341 @@
+"""Recording and replay of raw sample streams.
+
+A StreamRecorder thread copies the raw samples of every sensor from its
+sampler ring into a recording file: a 16-byte header (magic, version,
+record size, creation time) followed by fixed-size little-endian records
+(RECORD_DTYPE), 14 bytes per sample.  Recordings are mapped back with
+load_recording(); extract_sample_log() turns the samples of a sample log
+(sample_log.py) into the same array, so field traces can be replayed too.
+
+A Replay feeds a recording to WeightSensors in place of their samplers,
+either paced like the original (speed 1.0, or faster/slower) or as fast as
+possible (speed None).  Everything after the sampler -- tare, filters,
+calibration, auto-zero, load events, the platform aggregator -- runs
+unchanged.  replay_pipeline() sets that up and times it:
+
+    python recording.py replay recording.hxr [--speed 1] [--calibration calibration.hxc] [--platform]
+    python recording.py extract [log_directory] recording.hxr
+"""
+import argparse
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from aggregator import PlatformAggregator
+from config import DATA_DIR, PLATFORM_COUPLING, PLATFORM_POSITIONS, STATS_WINDOW, WEIGHT_WINDOW
+from gpio_backend import SimulatedBackend
+from load_events import EventBus
+from sample_log import HEADER, HEADER_SIZE, iter_range
+from sampler import Sampler, DEFAULT_CAPACITY
+from utils import logger
+
+MAGIC = b'HXRS'
+VERSION = 1
+
+# timestamp: seconds since the epoch, non-decreasing per sensor.
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('sensor', '<u2'),
+    ('raw', '<i4'),
+])
+
+# samples: replayed samples of all sensors; seconds: wall time the replay
+# took; events: load_events.LoadEvents in publishing order; weights:
+# {sensor_id: weight} at the end of the replay; platform: aggregator.Aggregate
+# of the last platform frame, None without positions.
+ReplayResult = namedtuple('ReplayResult', 'samples seconds events weights platform')
+
+
+def load_recording(path):
+    """Map a recording as a read-only structured array (no copy)."""
+    with open(path, 'rb') as f:
+        magic, version, record_size, _ = HEADER.unpack(f.read(HEADER_SIZE))
+    if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a version {VERSION} recording")
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if count <= 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def save_recording(records, path):
+    """Write an array of RECORD_DTYPE records as a recording file."""
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, time.time()))
+        f.write(np.asarray(records, dtype=RECORD_DTYPE).tobytes())
+
+
+def extract_sample_log(directory=DATA_DIR, start=None, end=None):
+    """Raw samples of a sample log directory with start <= timestamp < end,
+    as RECORD_DTYPE records."""
+    blocks = []
+    for chunk in iter_range(directory, start, end):
+        block = np.empty(len(chunk), dtype=RECORD_DTYPE)
+        for field in RECORD_DTYPE.names:
+            block[field] = chunk[field]
+        blocks.append(block)
+    if not blocks:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(blocks)
+
+
+class StreamRecorder(threading.Thread):
+    """Copies the samples of every sensor from its sampler ring to a recording
+    file, one batch every `interval` seconds, for `duration` seconds (None:
+    until stopped).  Like the DataSaver, it must keep up with the ring."""
+
+    def __init__(self, sensors, path, interval=1.0, duration=None):
+        super().__init__(name='stream-recorder', daemon=True)
+        # sensors: a WeightSensor, or a dict of sensor id -> WeightSensor
+        if not isinstance(sensors, dict):
+            sensors = {1: sensors}
+        for sensor_id, sensor in sensors.items():
+            if sensor.sampler is None:
+                raise ValueError(f"Recording needs background sampling on sensor {sensor_id}")
+        self.sensors = sensors
+        self.path = path
+        self.interval = interval
+        self.duration = duration
+        self.records_written = 0
+        self.dropped = 0
+        self._saved = {sensor_id: sensor.sampler.ring.count for sensor_id, sensor in sensors.items()}
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, time.time()))
+        self._stop_event = threading.Event()
+
+    def run(self):
+        logger.info(f"Recording raw samples to {self.path}")
+        ends = None if self.duration is None else time.monotonic() + self.duration
+        while not self._stop_event.wait(self.interval):
+            self.save()
+            if ends is not None and time.monotonic() >= ends:
+                break
+        self.save()
+        self._file.close()
+        logger.info(f"Recorded {self.records_written} samples to {self.path}")
+
+    def save(self):
+        blocks = []
+        for sensor_id, sensor in self.sensors.items():
+            ring = sensor.sampler.ring
+            count = ring.count
+            timestamps, raws = ring.read(self._saved[sensor_id], count)
+            lost = count - self._saved[sensor_id] - len(raws)
+            self._saved[sensor_id] = count
+            if lost:
+                self.dropped += lost
+                logger.warning(f"Recorder fell behind, {lost} samples of "
+                               f"sensor {sensor_id} were lost")
+            if not len(raws):
+                continue
+            block = np.empty(len(raws), dtype=RECORD_DTYPE)
+            # Ring timestamps are monotonic clock readings, recordings store wall time.
+            block['timestamp'] = timestamps + (time.time() - time.monotonic())
+            block['sensor'] = sensor_id
+            block['raw'] = raws
+            blocks.append(block)
+        if not blocks:
+            return
+        records = np.concatenate(blocks)
+        try:
+            self._file.write(records.tobytes())
+            self._file.flush()
+        except OSError as e:
+            logger.error(f"Error recording samples: {e}")
+            return
+        self.records_written += len(records)
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+class Replay:
+    """Feeds recorded samples to WeightSensors, standing in for an
+    acquisition.AcquisitionProcess: pass it as start_sampling(acquisition=...).
+
+    pins: {sensor_id: DOUT pin} of the sensors to feed.  Their samplers wait
+    for start(); then every sensor's samples go into its ring and estimators
+    at the recorded intervals divided by speed, or back to back with speed
+    None.  Ring timestamps keep the recorded spacing either way, starting at
+    the time of start().
+    """
+
+    def __init__(self, records, pins, speed=1.0):
+        if speed is not None and speed <= 0:
+            raise ValueError("Replay speed must be positive")
+        self.speed = speed
+        self.pins = dict(pins)
+        records = np.asarray(records)
+        self.first_timestamp = float(records['timestamp'].min()) if len(records) else 0.0
+        self._records = {}
+        for sensor_id, dout in self.pins.items():
+            selected = records[records['sensor'] == sensor_id]
+            self._records[dout] = (selected['timestamp'] - self.first_timestamp,
+                                   selected['raw'].astype(np.int64))
+        self.samplers = []
+        self.started = None
+        self._start_event = threading.Event()
+
+    def sampler(self, hx, estimators=(), capacity=DEFAULT_CAPACITY):
+        """ReplaySampler for the sensor on hx.DOUT."""
+        offsets, values = self._records[hx.DOUT]
+        sampler = ReplaySampler(self, hx, offsets, values, capacity, estimators=estimators)
+        self.samplers.append(sampler)
+        return sampler
+
+    def is_alive(self):
+        return any(sampler.is_alive() for sampler in self.samplers)
+
+    def start(self):
+        self.started = time.monotonic()
+        self._start_event.set()
+
+    def wait(self, timeout=None):
+        """Wait until every sampler has replayed its samples; returns whether they have."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for sampler in self.samplers:
+            sampler.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not self.is_alive()
+
+
+class ReplaySampler(Sampler):
+    """Sampler that replays recorded samples instead of reading the HX711."""
+
+    def __init__(self, replay, hx, offsets, values, capacity=DEFAULT_CAPACITY, estimators=()):
+        super().__init__(hx, capacity, name=f"replay-{hx.DOUT}", estimators=estimators)
+        self.replay = replay
+        self.offsets = offsets
+        self.values = values
+        self.replayed = 0
+
+    def _sample(self):
+        while not self.replay._start_event.wait(0.1):
+            if self._stop_event.is_set():
+                return
+        started, speed = self.replay.started, self.replay.speed
+        first_timestamp = self.replay.first_timestamp
+        for offset, value in zip(self.offsets.tolist(), self.values.tolist()):
+            if speed is not None:
+                delay = started + offset / speed - time.monotonic()
+                if delay > 0 and self._stop_event.wait(delay):
+                    return
+            elif self._stop_event.is_set():
+                return
+            self.ring.append(started + offset, value)
+            # Estimators get the recorded time, so replays repeat exactly.
+            timestamp = first_timestamp + offset
+            for estimator in self.estimators:
+                estimator.update(value, timestamp)
+            self.replayed += 1
+
+
+def replay_pipeline(records, calibrations=None, speed=None, tare_samples=15,
+                    stats_window=STATS_WINDOW, window=WEIGHT_WINDOW, auto_zero=False,
+                    load_events=True, positions=None, coupling=None):
+    """Run a recording through WeightSensors and return a ReplayResult.
+
+    calibrations: {sensor_id: SensorCalibration} applied to each sensor
+    (default: reference unit 1).  Each sensor is tared from its first
+    tare_samples recorded samples, as at startup; with tare_samples=0 the
+    calibrations' offsets are kept.  auto_zero and load_events start those
+    estimators with their defaults.  positions (and coupling), as for
+    aggregator.PlatformAggregator, aggregate the sensors into platform
+    frames as well.
+    """
+    from weight_sensor import WeightSensor
+
+    records = np.asarray(records)
+    sensor_ids = sorted(int(sensor_id) for sensor_id in np.unique(records['sensor']))
+    # The drivers need pins; simulated chips keep the real GPIO out of it.
+    pins = {sensor_id: (2 * i, 2 * i + 1) for i, sensor_id in enumerate(sensor_ids)}
+    backend = SimulatedBackend.for_sensors(pins)
+    replay = Replay(records, {sensor_id: dout for sensor_id, (dout, _) in pins.items()}, speed)
+    bus = EventBus()
+    events = []
+    bus.add_callback(events.append)
+
+    sensors = {}
+    for sensor_id, (dout, sck) in pins.items():
+        sensor = sensors[sensor_id] = WeightSensor(dout, sck, gpio=backend, sensor_id=sensor_id)
+        if calibrations is not None and sensor_id in calibrations:
+            sensor.apply_calibration(calibrations[sensor_id])
+            sensor.hx.set_offset(calibrations[sensor_id].offset)
+        if tare_samples:
+            _, raws = replay._records[dout]
+            if len(raws):
+                sensor.hx.set_offset(float(sensor.weight_filter(raws[:tare_samples])))
+        sensor.start_sampling(window=window, stats_window=stats_window, acquisition=replay)
+        if auto_zero:
+            sensor.start_auto_zero(name=sensor_id)
+        if load_events:
+            sensor.start_load_events(bus, sensor_id)
+
+    platform = None
+    if positions is not None:
+        platform = PlatformAggregator(sensors, positions, coupling)
+
+    started = time.perf_counter()
+    replay.start()
+    try:
+        replay.wait()
+        seconds = time.perf_counter() - started
+        weights = {sensor_id: float(sensor.get_weight(fresh=True))
+                   for sensor_id, sensor in sensors.items()}
+        frame = platform.latest() if platform is not None else None
+    finally:
+        for sensor in sensors.values():
+            sensor.cleanup()
+    samples = sum(sampler.replayed for sampler in replay.samplers)
+    return ReplayResult(samples, seconds, events, weights, frame)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Raw sample recording tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay = commands.add_parser('replay', help="run a recording through the weight pipeline")
+    replay.add_argument('path')
+    replay.add_argument('--speed', type=float,
+                        help="replay speed, 1 for real time (default: as fast as possible)")
+    replay.add_argument('--calibration', help="calibration file to apply (calibration_store.py)")
+    replay.add_argument('--auto-zero', action='store_true', help="run auto-zero tracking too")
+    replay.add_argument('--platform', action='store_true',
+                        help="aggregate the sensors with PLATFORM_POSITIONS and PLATFORM_COUPLING")
+    extract = commands.add_parser('extract', help="turn a sample log directory into a recording")
+    extract.add_argument('directory', nargs='?', default=DATA_DIR)
+    extract.add_argument('path')
+    extract.add_argument('--start', type=float, help="first epoch second to extract")
+    extract.add_argument('--end', type=float, help="epoch second to stop at")
+    args = parser.parse_args(argv)
+
+    if args.command == 'extract':
+        records = extract_sample_log(args.directory, args.start, args.end)
+        save_recording(records, args.path)
+        print(f"Extracted {len(records)} samples to {args.path}")
+    elif args.command == 'replay':
+        calibrations = None
+        if args.calibration:
+            from calibration_store import load_calibration
+            calibrations = load_calibration(args.calibration)
+        positions = PLATFORM_POSITIONS if args.platform else None
+        result = replay_pipeline(load_recording(args.path), calibrations, args.speed,
+                                 auto_zero=args.auto_zero, positions=positions,
+                                 coupling=PLATFORM_COUPLING)
+        print(f"Replayed {result.samples} samples in {result.seconds:.3f} s "
+              f"({result.samples / result.seconds:.0f} samples/s)")
+        for event in result.events:
+            print(f"  sensor {event.sensor}: {event.kind} {event.delta:+.2f} g, "
+                  f"now {event.weight:.2f} g")
+        for sensor_id, weight in result.weights.items():
+            print(f"  sensor {sensor_id}: final weight {weight:.2f} g")
+        if result.platform is not None:
+            print(f"  platform: total {result.platform.total:.2f} g at "
+                  f"({result.platform.x:.1f}, {result.platform.y:.1f}) mm")
+
+
+if __name__ == '__main__':
+    main()
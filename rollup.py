@@ -0,0 +1,355 @@
+"""Multi-resolution rollups of the weight history.
+
+A RollupStore keeps, for every sensor, the count, min, max, sum and last
+weight of each 1 s, 1 min and 1 h bucket (config.ROLLUP_TIERS).  Each tier
+is a ring of buckets indexed by bucket number modulo its capacity, so memory
+is fixed by its retention, adding a block of samples is a few NumPy
+reductions per tier, and a query touches only the buckets it returns.
+
+query() answers from the coarsest tier that is still fine enough for the
+requested resolution and reaches back to the start of the range; buckets
+are merged when the resolution is a multiple of the tier's:
+
+    store.query(3, time.time() - 7 * 86400, time.time(), resolution=3600)
+
+The DataSaver feeds the store with every batch it logs and saves it in the
+log directory; load() restores it at startup.  A save appends only the
+buckets changed since the last one to a journal next to ROLLUP_FILE (58
+bytes per bucket) and fsyncs it; once the journal outgrows
+JOURNAL_MAX_BYTES, a full snapshot atomically replaces ROLLUP_FILE and
+starts a new journal.  Snapshot and journal share a generation number, so a
+journal left over from an older snapshot is never applied to a newer one.
+"""
+import math
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from config import ROLLUP_MAX_POINTS, ROLLUP_TIERS
+from utils import logger
+
+# Arrays over the returned buckets: timestamps are bucket starts in epoch
+# seconds; empty buckets are left out.
+Rollup = namedtuple('Rollup', 'resolution timestamps count min max mean last')
+
+FIELDS = ('bucket', 'count', 'min', 'max', 'sum', 'last')
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_MAGIC = b'HXRJ'
+JOURNAL_VERSION = 1
+# Magic, version, record size, generation of the snapshot it continues.
+JOURNAL_HEADER = struct.Struct('<4sHHq')
+# One changed bucket of one tier; the slot is bucket % capacity.
+JOURNAL_DTYPE = np.dtype([
+    ('sensor', '<u2'),
+    ('resolution', '<f8'),
+    ('bucket', '<i8'),
+    ('count', '<i8'),
+    ('min', '<f8'),
+    ('max', '<f8'),
+    ('sum', '<f8'),
+    ('last', '<f8'),
+])
+
+
+def _group_starts(keys):
+    """Indices where a run of equal keys starts, in a non-decreasing key array."""
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+
+def _fsync_directory(path):
+    # Make a rename in the directory of path durable.
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _replace(path, write):
+    """Write a new file with write(f), then atomically and durably replace path with it."""
+    temporary = path + '.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+    _fsync_directory(path)
+
+
+class RollupTier:
+    """Ring of `retention` / `resolution` buckets of one sensor."""
+
+    def __init__(self, resolution, retention):
+        if resolution <= 0 or retention < resolution:
+            raise ValueError("Rollup tiers need resolution > 0 and retention >= resolution")
+        self.resolution = resolution
+        self.retention = retention
+        self.capacity = int(math.ceil(retention / resolution))
+        # Bucket number (start // resolution) held by each slot, -1 for none.
+        self.bucket = np.full(self.capacity, -1, dtype=np.int64)
+        self.count = np.zeros(self.capacity, dtype=np.int64)
+        self.min = np.zeros(self.capacity, dtype=np.float64)
+        self.max = np.zeros(self.capacity, dtype=np.float64)
+        self.sum = np.zeros(self.capacity, dtype=np.float64)
+        self.last = np.zeros(self.capacity, dtype=np.float64)
+        # Slots changed since the last save.
+        self.dirty = np.zeros(self.capacity, dtype=bool)
+
+    def add(self, timestamps, values):
+        """Add samples with non-decreasing timestamps."""
+        buckets = np.floor_divide(timestamps, self.resolution).astype(np.int64)
+        starts = _group_starts(buckets)
+        if len(starts) > self.capacity:
+            # Older buckets would be overwritten within this block anyway.
+            starts = starts[-self.capacity:]
+            buckets, values = buckets[starts[0]:], values[starts[0]:]
+            starts = starts - starts[0]
+        ids = buckets[starts]
+        counts = np.diff(np.append(starts, len(buckets)))
+        groups = (ids, counts, np.minimum.reduceat(values, starts),
+                  np.maximum.reduceat(values, starts), np.add.reduceat(values, starts),
+                  values[starts + counts - 1])
+        slots = ids % self.capacity
+        current = self.bucket[slots]
+        # Slots holding a newer bucket keep it; the samples are past retention.
+        keep = ids >= current
+        if not keep.all():
+            groups = tuple(group[keep] for group in groups)
+            slots, current = slots[keep], current[keep]
+        ids, counts, low, high, total, last = groups
+
+        fresh = ids > current
+        self.bucket[slots[fresh]] = ids[fresh]
+        self.count[slots[fresh]] = 0
+        self.min[slots[fresh]] = np.inf
+        self.max[slots[fresh]] = -np.inf
+        self.sum[slots[fresh]] = 0.0
+
+        self.count[slots] += counts
+        self.min[slots] = np.minimum(self.min[slots], low)
+        self.max[slots] = np.maximum(self.max[slots], high)
+        self.sum[slots] += total
+        self.last[slots] = last
+        self.dirty[slots] = True
+
+    def changes(self):
+        """Journal records of the slots changed since the last call, except
+        sensor, which the caller fills in."""
+        slots = np.flatnonzero(self.dirty)
+        self.dirty[slots] = False
+        records = np.empty(len(slots), dtype=JOURNAL_DTYPE)
+        records['resolution'] = self.resolution
+        for field in FIELDS:
+            records[field] = getattr(self, field)[slots]
+        return records
+
+    def restore(self, records):
+        """Apply journal records of this tier, in the order they were written."""
+        slots = records['bucket'] % self.capacity
+        # The last record of a slot holds its current state.
+        _, last = np.unique(slots[::-1], return_index=True)
+        last = len(slots) - 1 - last
+        for field in FIELDS:
+            getattr(self, field)[slots[last]] = records[field][last]
+
+    def query(self, start, end, factor=1):
+        """Rollup of the buckets starting in [start, end), merged factor at a time."""
+        first = math.floor(start / self.resolution)
+        stop = math.ceil(end / self.resolution)
+        first = max(first, stop - self.capacity)
+        ids = np.arange(first, max(first, stop), dtype=np.int64)
+        slots = ids % self.capacity
+        present = self.bucket[slots] == ids
+        ids, slots = ids[present], slots[present]
+        count, low, high = self.count[slots], self.min[slots], self.max[slots]
+        total, last = self.sum[slots], self.last[slots]
+        if factor > 1 and len(ids):
+            groups = ids // factor
+            starts = _group_starts(groups)
+            ids = groups[starts] * factor
+            ends = np.append(starts[1:], len(groups)) - 1
+            count = np.add.reduceat(count, starts)
+            low = np.minimum.reduceat(low, starts)
+            high = np.maximum.reduceat(high, starts)
+            total = np.add.reduceat(total, starts)
+            last = last[ends]
+        return Rollup(self.resolution * factor, ids * float(self.resolution), count, low, high,
+                      total / count, last)
+
+
+class RollupStore:
+    """Rollup tiers of every sensor.  tiers: (resolution, retention) pairs in
+    seconds, finest first."""
+
+    # Journal size at which save() writes a full snapshot instead.
+    JOURNAL_MAX_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, tiers=ROLLUP_TIERS, max_points=ROLLUP_MAX_POINTS):
+        self.tiers = tuple(sorted(tiers))
+        self.max_points = max_points
+        self._sensors = {}
+        self._lock = threading.Lock()
+        # Generation of the snapshot the journal on disk continues, None
+        # until a snapshot is written or loaded with an intact journal.
+        self._generation = None
+        self._journal_bytes = 0
+
+    @property
+    def sensors(self):
+        return sorted(self._sensors)
+
+    def _tiers(self, sensor):
+        tiers = self._sensors.get(sensor)
+        if tiers is None:
+            tiers = self._sensors[sensor] = [RollupTier(resolution, retention)
+                                             for resolution, retention in self.tiers]
+        return tiers
+
+    def add_block(self, sensor, timestamps, values):
+        """Add samples of one sensor: epoch-second timestamps, non-decreasing,
+        and weights."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if not len(timestamps):
+            return
+        # A wall clock step back must not split a bucket in two.
+        timestamps = np.maximum.accumulate(timestamps)
+        values = np.asarray(values, dtype=np.float64)
+        with self._lock:
+            for tier in self._tiers(sensor):
+                tier.add(timestamps, values)
+
+    def tier_for(self, start, end, resolution=None, now=None):
+        """Index of the tier a query of [start, end) at resolution is answered
+        from: the coarsest tier no coarser than resolution (default: the range
+        over max_points) that still reaches back to start, else the finest
+        tier that does, else the one reaching back furthest."""
+        now = time.time() if now is None else now
+        if resolution is None:
+            resolution = (end - start) / self.max_points
+        reaching = [i for i, (_, retention) in enumerate(self.tiers) if now - retention <= start]
+        fine_enough = [i for i in reaching if self.tiers[i][0] <= resolution]
+        if fine_enough:
+            return fine_enough[-1]
+        if reaching:
+            return reaching[0]
+        return len(self.tiers) - 1
+
+    def query(self, sensor, start, end, resolution=None):
+        """Rollup of one sensor over [start, end), see tier_for().  A resolution
+        that is a multiple of the tier's merges its buckets."""
+        index = self.tier_for(start, end, resolution)
+        tier_resolution = self.tiers[index][0]
+        factor = 1
+        if resolution is not None and resolution > tier_resolution:
+            factor = max(1, int(resolution // tier_resolution))
+        with self._lock:
+            if sensor not in self._sensors:
+                raise KeyError(f"No rollups for sensor {sensor}")
+            return self._sensors[sensor][index].query(start, end, factor)
+
+    def save(self, path):
+        """Save the changes since the last save to the journal of path, or a
+        full snapshot to path (NumPy .npz) with a new, empty journal when
+        there is none yet or the journal has grown past JOURNAL_MAX_BYTES.
+        Files are fsynced; the changes are copied under the lock and written
+        outside it."""
+        with self._lock:
+            full = self._generation is None or self._journal_bytes >= self.JOURNAL_MAX_BYTES
+            if full:
+                arrays = {'tiers': np.array(self.tiers, dtype=np.float64)}
+                for sensor, tiers in self._sensors.items():
+                    for tier in tiers:
+                        tier.dirty[:] = False
+                        for field in FIELDS:
+                            name = f"{sensor}/{tier.resolution:g}/{field}"
+                            arrays[name] = getattr(tier, field).copy()
+            else:
+                blocks = []
+                for sensor, tiers in self._sensors.items():
+                    for tier in tiers:
+                        records = tier.changes()
+                        records['sensor'] = sensor
+                        blocks.append(records)
+        journal = path + JOURNAL_SUFFIX
+        try:
+            if full:
+                generation = time.time_ns()
+                arrays['generation'] = np.array(generation, dtype=np.int64)
+                _replace(path, lambda f: np.savez(f, **arrays))
+                _replace(journal, lambda f: f.write(JOURNAL_HEADER.pack(
+                    JOURNAL_MAGIC, JOURNAL_VERSION, JOURNAL_DTYPE.itemsize, generation)))
+                self._generation = generation
+                self._journal_bytes = 0
+                return
+            records = np.concatenate(blocks) if blocks else np.empty(0, dtype=JOURNAL_DTYPE)
+            if not len(records):
+                return
+            with open(journal, 'ab') as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_bytes += records.nbytes
+        except BaseException:
+            # The changes taken are not safely on disk: snapshot everything next time.
+            self._generation = None
+            raise
+
+    @classmethod
+    def load(cls, path, tiers=ROLLUP_TIERS, max_points=ROLLUP_MAX_POINTS):
+        """Store with the rollups saved in path and its journal.  Tiers whose
+        resolution or retention changed since are started empty."""
+        store = cls(tiers, max_points)
+        with np.load(path) as data:
+            saved = {tuple(tier) for tier in data['tiers'].tolist()}
+            generation = int(data['generation']) if 'generation' in data.files else None
+            sensors = {int(name.split('/', 1)[0]) for name in data.files if '/' in name}
+            for sensor in sensors:
+                for tier in store._tiers(sensor):
+                    if (tier.resolution, tier.retention) not in saved:
+                        logger.warning(f"Rollup tier {tier.resolution:g} s changed, "
+                                       f"starting it empty")
+                        continue
+                    for field in FIELDS:
+                        getattr(tier, field)[:] = data[f"{sensor}/{tier.resolution:g}/{field}"]
+        if generation is not None:
+            kept = [i for i, tier in enumerate(store.tiers) if tier in saved]
+            store._load_journal(path + JOURNAL_SUFFIX, generation, kept)
+        return store
+
+    def _load_journal(self, path, generation, kept):
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(JOURNAL_HEADER.size)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(header) < JOURNAL_HEADER.size:
+            return
+        magic, version, record_size, journal_generation = JOURNAL_HEADER.unpack(header)
+        if (magic != JOURNAL_MAGIC or version != JOURNAL_VERSION
+                or record_size != JOURNAL_DTYPE.itemsize or journal_generation != generation):
+            logger.warning(f"Ignoring rollup journal {path}, it does not continue the snapshot")
+            return
+        # A record cut short by a power loss is dropped.
+        complete = len(data) - len(data) % record_size
+        records = np.frombuffer(data[:complete], dtype=JOURNAL_DTYPE)
+        for index in kept:
+            resolution = self.tiers[index][0]
+            selected = records[records['resolution'] == resolution]
+            for sensor in np.unique(selected['sensor']).tolist():
+                self._tiers(sensor)[index].restore(selected[selected['sensor'] == sensor])
+        if complete == len(data):
+            # Appending goes on after the last record; otherwise the next
+            # save starts over with a snapshot.
+            self._generation = generation
+            self._journal_bytes = len(data)
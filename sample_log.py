@@ -0,0 +1,311 @@
+"""Append-only binary sample log.
+
+Samples are stored as fixed-size little-endian records (RECORD_DTYPE) in
+segment files named samples-<start time in us>.hxl inside a log directory.
+Each segment starts with a 16-byte header (magic, version, record size,
+creation time).  The writer appends records in batches, fsyncs at most once
+per fsync_interval and starts a new segment when the current one reaches
+segment_bytes or segment_seconds.  A new segment gets its header through
+a fsynced temporary file renamed into place.  Readers map a segment straight
+into a NumPy structured array without copying; a record cut short by a power
+loss is ignored, and so is a segment whose header never made it to disk.
+Range reads skip, with a warning, a segment that is not a sample log.
+
+Time ranges are read without scanning: the segment names give each
+segment's first timestamp, and the records' timestamps never decrease, so
+read_range() and iter_range() find [start, end) by binary search over the
+segment list and over the mapped timestamp column.  Only the pages around
+the search path and the records returned are read, and iter_range() copies
+them out one chunk at a time.
+
+Export to CSV for compatibility with (defaults: config.DATA_DIR, DATA_FILE):
+
+    python sample_log.py export [log_directory] [csv_path] [--start T0] [--end T1] [--sensor N]
+"""
+import argparse
+import bisect
+import csv
+import os
+import struct
+import time
+
+import numpy as np
+
+from config import DATA_DIR, DATA_FILE
+from metrics import REGISTRY
+from utils import logger
+
+MAGIC = b'HXLG'
+VERSION = 1
+HEADER = struct.Struct('<4sHHd')
+HEADER_SIZE = HEADER.size
+
+# timestamp: seconds since the epoch, never decreasing within a log.
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('sensor', '<u2'),
+    ('flags', '<u2'),
+    ('raw', '<i4'),
+    ('weight', '<f4'),
+])
+
+# Bits of the flags field.
+FLAG_STABLE = 0x1
+
+SEGMENT_PREFIX = 'samples-'
+SEGMENT_SUFFIX = '.hxl'
+
+WRITE_SECONDS = REGISTRY.histogram('sample_log_write_seconds', "Time to write one batch of records")
+FSYNC_SECONDS = REGISTRY.histogram('sample_log_fsync_seconds', "Time to fsync a segment")
+RECORDS_WRITTEN = REGISTRY.counter('sample_log_records_total', "Records written to the sample log")
+BYTES_WRITTEN = REGISTRY.counter('sample_log_bytes_total', "Bytes written to the sample log")
+
+
+class SampleLogWriter:
+    """Appends sample records to the segments of a log directory."""
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, segment_seconds=3600,
+                 fsync_interval=30.0, batch_size=4096):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync_interval = fsync_interval
+
+        self._batch = np.zeros(batch_size, dtype=RECORD_DTYPE)
+        self._pending = 0
+        self._file = None
+        self._segment_started = 0.0
+        self._segment_size = 0
+        self._last_fsync = time.monotonic()
+        self._last_timestamp = 0.0
+
+        self.records_written = 0
+        self.bytes_written = 0
+        self.fsyncs = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._last_timestamp = last_timestamp(directory)
+
+    def append(self, timestamp, sensor, raw, weight, flags=0):
+        if self._pending == len(self._batch):
+            self.flush()
+        timestamp = max(timestamp, self._last_timestamp)
+        self._last_timestamp = timestamp
+        self._batch[self._pending] = (timestamp, sensor, flags, raw, weight)
+        self._pending += 1
+
+    def append_block(self, timestamps, sensor, raws, weights, flags=0):
+        """Append many samples, given as arrays; sensor is one id for all of
+        them or an array of one per sample."""
+        n = len(timestamps)
+        if not n:
+            return
+        block = np.empty(n, dtype=RECORD_DTYPE)
+        # Keep timestamps non-decreasing across the whole log.
+        block['timestamp'] = np.maximum.accumulate(
+            np.maximum(np.asarray(timestamps, dtype=np.float64), self._last_timestamp))
+        block['sensor'] = sensor
+        block['flags'] = flags
+        block['raw'] = raws
+        block['weight'] = weights
+        self._last_timestamp = float(block['timestamp'][-1])
+        self.flush()
+        self._write(block)
+
+    def flush(self):
+        """Write the pending batch; fsync if fsync_interval has passed."""
+        if self._pending:
+            self._write(self._batch[:self._pending])
+            self._pending = 0
+        if self._file is not None and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is None:
+            return
+        started = time.perf_counter()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+        self.fsyncs += 1
+        if REGISTRY.enabled:
+            FSYNC_SECONDS.observe(time.perf_counter() - started)
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _write(self, records):
+        if (self._file is None or self._segment_size >= self.segment_bytes
+                or time.time() - self._segment_started >= self.segment_seconds):
+            self._rotate(float(records['timestamp'][0]))
+        started = time.perf_counter()
+        data = records.tobytes()
+        self._file.write(data)
+        self._segment_size += len(data)
+        self.bytes_written += len(data)
+        self.records_written += len(records)
+        if REGISTRY.enabled:
+            WRITE_SECONDS.observe(time.perf_counter() - started)
+            RECORDS_WRITTEN.inc(len(records))
+            BYTES_WRITTEN.inc(len(data))
+
+    def _rotate(self, first_timestamp):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+        self._segment_started = time.time()
+        name = '%s%016d%s' % (SEGMENT_PREFIX, int(first_timestamp * 1e6), SEGMENT_SUFFIX)
+        path = os.path.join(self.directory, name)
+        # Two segments starting in the same microsecond: keep appending to the
+        # existing one rather than overwriting it.
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE:
+            # The header is on disk before the segment appears, so a power
+            # loss never leaves a segment without one.
+            temporary = path + '.tmp'
+            with open(temporary, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, self._segment_started))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, path)
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self.bytes_written += HEADER_SIZE
+        self._file = open(path, 'ab', buffering=0)
+        self._segment_size = self._file.tell()
+
+
+def segment_paths(directory):
+    """Segment files of a log directory, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(n for n in os.listdir(directory)
+                   if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, n) for n in names]
+
+
+def read_segment(path):
+    """Map a segment as a read-only structured array (no copy)."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not any(header):
+        # Created by an older writer right before a power loss: no records.
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    magic, version, record_size, _ = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} is not a version {VERSION} sample log segment")
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if count <= 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def iter_segments(directory):
+    for path in segment_paths(directory):
+        yield read_segment(path)
+
+
+def read_log(directory):
+    """All records of a log as one array (copied out of the segments)."""
+    segments = list(iter_segments(directory))
+    if not segments:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(segments)
+
+
+def last_timestamp(directory):
+    """Timestamp of the last record of a log, 0.0 if it has none."""
+    for path in reversed(segment_paths(directory)):
+        try:
+            records = read_segment(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable segment {path}: {e}")
+            continue
+        if len(records):
+            return float(records['timestamp'][-1])
+    return 0.0
+
+
+def segment_start(path):
+    """Epoch seconds in the name of a segment: its first timestamp, rounded down to 1 us."""
+    name = os.path.basename(path)
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) / 1e6
+
+
+def iter_range(directory, start=None, end=None, sensors=None, chunk_size=65536):
+    """Records with start <= timestamp < end (None: unbounded) of the given
+    sensors (None: all), oldest first, as copied arrays of at most
+    chunk_size records.  Segments that cannot be read are skipped with a
+    warning."""
+    paths = segment_paths(directory)
+    starts = [segment_start(path) for path in paths]
+    # A segment can end with the first timestamp of the next one, so begin
+    # with the last segment starting strictly before start.
+    first = 0 if start is None else max(0, bisect.bisect_left(starts, start) - 1)
+    stop = len(paths) if end is None else bisect.bisect_left(starts, end)
+    if sensors is not None:
+        sensors = np.asarray(sorted(sensors), dtype=RECORD_DTYPE['sensor'])
+    for path in paths[first:stop]:
+        try:
+            records = read_segment(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable segment {path}: {e}")
+            continue
+        # bisect, not np.searchsorted: that copies the strided column first.
+        timestamps = records['timestamp']
+        low = 0 if start is None else bisect.bisect_left(timestamps, start)
+        high = len(records) if end is None else bisect.bisect_left(timestamps, end, low)
+        for offset in range(low, high, chunk_size):
+            chunk = records[offset:min(offset + chunk_size, high)]
+            if sensors is not None:
+                chunk = chunk[np.isin(chunk['sensor'], sensors)]
+            if len(chunk):
+                yield np.array(chunk)
+
+
+def read_range(directory, start=None, end=None, sensors=None):
+    """Records of iter_range() as one array."""
+    chunks = list(iter_range(directory, start, end, sensors))
+    if not chunks:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(chunks)
+
+
+def export_csv(directory, csv_path, start=None, end=None, sensors=None):
+    """Write the records of a log in [start, end) of the given sensors (see
+    iter_range()) to a CSV file; returns the number of rows."""
+    rows = 0
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(RECORD_DTYPE.names)
+        for records in iter_range(directory, start, end, sensors):
+            writer.writerows(records.tolist())
+            rows += len(records)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sample log tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help="export a log directory to CSV")
+    export.add_argument('directory', nargs='?', default=DATA_DIR)
+    export.add_argument('csv_path', nargs='?', default=DATA_FILE)
+    export.add_argument('--start', type=float, help="first epoch second to export")
+    export.add_argument('--end', type=float, help="epoch second to stop at")
+    export.add_argument('--sensor', type=int, action='append',
+                        help="export only this sensor (repeatable)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        rows = export_csv(args.directory, args.csv_path, args.start, args.end, args.sensor)
+        print(f"Exported {rows} records to {args.csv_path}")
+
+
+if __name__ == '__main__':
+    main()
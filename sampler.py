@@ -0,0 +1,247 @@
+"""Continuous background sampling of an HX711 into a ring buffer.
+
+A Sampler thread reads the chip at its native data rate and appends every
+conversion to a SampleRing, so callers compute weights from the most recent
+samples instead of bit-banging the chip themselves.
+
+The sampler is also the watchdog of its sensor: when a read times out, or
+CORRUPT_LIMIT reads in a row get nothing but corrupt conversions (as with
+DOUT stuck low), the sensor is marked degraded and the chip is reset, again
+after 1, 2, 4 ... up to RESET_BACKOFF_MAX seconds while it stays that way.
+Every sensor has its own sampler, so the others keep streaming at full rate
+meanwhile.
+"""
+import threading
+import time
+import weakref
+
+import numpy as np
+
+from hx711 import CorruptSampleError, ReadTimeoutError
+from metrics import REGISTRY
+from utils import logger
+
+DEFAULT_CAPACITY = 1024
+
+# Seconds of ring history the sample rate gauge is computed over.
+RATE_WINDOW = 5.0
+
+_samplers = weakref.WeakSet()
+
+
+def _sample_rates():
+    rates = {}
+    now = time.monotonic()
+    for sampler in list(_samplers):
+        timestamps, _ = sampler.ring.latest()
+        span = min(RATE_WINDOW, now - timestamps[0]) if len(timestamps) else 0.0
+        recent = np.count_nonzero(timestamps >= now - span)
+        rates[(sampler.hx.sensor_id,)] = recent / span if span > 0 else 0.0
+    return rates
+
+
+SAMPLE_RATE = REGISTRY.gauge('sampler_sample_rate',
+                             f"Samples per second over the last {RATE_WINDOW:g} s",
+                             ['sensor'], function=_sample_rates)
+READ_ERRORS = REGISTRY.counter('sampler_read_errors_total', "Failed reads in the sampler thread",
+                               ['sensor'])
+DEGRADED = REGISTRY.gauge('sampler_degraded', "1 while the sensor delivers no samples",
+                          ['sensor'],
+                          function=lambda: {(sampler.hx.sensor_id,): float(sampler.degraded)
+                                            for sampler in list(_samplers)})
+RESETS = REGISTRY.counter('sampler_resets_total', "Resets of a degraded sensor", ['sensor'])
+
+
+class SampleRing:
+    """Fixed-size ring of (timestamp, raw int32) samples.
+
+    There is a single writer (the sampler thread) and any number of readers.
+    The writer never waits on readers: it fills the slot and then publishes
+    it by bumping count.  Readers copy only the window they ask for and retry
+    if the writer lapped that window while they were copying.  The slot the
+    writer fills next holds the oldest sample, so readers see at most the
+    newest capacity - 1 samples.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 2:
+            raise ValueError("SampleRing capacity must be >= 2")
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.int32)
+        # Total number of samples ever appended.
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity - 1)
+
+    def append(self, timestamp, value):
+        index = self.count % self.capacity
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        self.count += 1
+
+    def _copy(self, start, size):
+        first = start % self.capacity
+        if first + size <= self.capacity:
+            return (self.timestamps[first:first + size].copy(),
+                    self.values[first:first + size].copy())
+        split = self.capacity - first
+        return (np.concatenate((self.timestamps[first:], self.timestamps[:size - split])),
+                np.concatenate((self.values[first:], self.values[:size - split])))
+
+    def latest(self, n=None):
+        """Return (timestamps, values) copies of the most recent n samples, oldest first."""
+        while True:
+            end = self.count
+            size = min(end, self.capacity - 1)
+            if n is not None:
+                size = min(n, size)
+            start = end - size
+            timestamps, values = self._copy(start, size)
+            # The window is consistent unless the writer started on its
+            # oldest slot meanwhile.
+            if self.count - start < self.capacity:
+                return timestamps, values
+
+    def read(self, start, end):
+        """Return (timestamps, values) copies of the samples numbered start to
+        end - 1 (counting from the first sample ever appended; end <= count).
+        Samples already overwritten are left out, so fewer than end - start
+        may come back: always the newest of them."""
+        while True:
+            first = max(start, self.count - (self.capacity - 1))
+            size = max(0, end - first)
+            timestamps, values = self._copy(first, size)
+            if self.count - first < self.capacity:
+                return timestamps, values
+
+    def last(self):
+        """Return the most recent (timestamp, value), or None if nothing was sampled yet."""
+        timestamps, values = self.latest(1)
+        if not len(values):
+            return None
+        return float(timestamps[0]), int(values[0])
+
+
+class Sampler(threading.Thread):
+    """Thread that reads an HX711 continuously into a SampleRing.
+
+    Every sample is also passed to the update(value, timestamp) method of
+    each estimator (e.g. window_stats.SlidingWindowStats), which run in this
+    thread; timestamp is the sample's time in epoch seconds, so estimators
+    keep time by their samples, also when they are replayed.  ring
+    replaces the SampleRing of `capacity` samples the sampler creates.
+    """
+
+    # Pause after a failed read so a broken sensor doesn't spin the thread.
+    ERROR_BACKOFF = 0.1
+    # Reads in a row failing with CorruptSampleError that degrade the sensor.
+    CORRUPT_LIMIT = 3
+    # Seconds between resets of a degraded sensor, doubling from min to max.
+    RESET_BACKOFF_MIN = 1.0
+    RESET_BACKOFF_MAX = 60.0
+
+    def __init__(self, hx, capacity=DEFAULT_CAPACITY, name=None, estimators=(), ring=None):
+        super().__init__(name=name or f"sampler-{hx.DOUT}", daemon=True)
+        self.hx = hx
+        self.ring = ring if ring is not None else SampleRing(capacity)
+        self.estimators = list(estimators)
+        self.degraded = False
+        self.read_errors = 0
+        self.resets = 0
+        self._next_reset = 0.0
+        self._reset_backoff = self.RESET_BACKOFF_MIN
+        # Conversions to drop after a reset: the first one is at the default gain.
+        self._discard = 0
+        self._corrupt = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        _samplers.add(self)
+        logger.info(f"Sampler started on DOUT={self.hx.DOUT}")
+        self._sample()
+        _samplers.discard(self)
+        logger.info(f"Sampler stopped on DOUT={self.hx.DOUT}")
+
+    def _sample(self):
+        while not self._stop_event.is_set():
+            try:
+                value = self.hx.read()
+            except ReadTimeoutError as e:
+                self.read_errors += 1
+                READ_ERRORS.labels(self.hx.sensor_id).inc()
+                self._timed_out(e)
+                continue
+            except CorruptSampleError as e:
+                self.read_errors += 1
+                READ_ERRORS.labels(self.hx.sensor_id).inc()
+                self._corrupt += 1
+                if self._corrupt >= self.CORRUPT_LIMIT:
+                    self._timed_out(e)
+                else:
+                    logger.error(f"Sampler read error on DOUT={self.hx.DOUT}: {e}")
+                # Corrupt reads come back at once, unlike timeouts.
+                self._stop_event.wait(self.ERROR_BACKOFF)
+                continue
+            except Exception as e:
+                logger.error(f"Sampler read error on DOUT={self.hx.DOUT}: {e}")
+                self.read_errors += 1
+                READ_ERRORS.labels(self.hx.sensor_id).inc()
+                self._stop_event.wait(self.ERROR_BACKOFF)
+                continue
+            self._corrupt = 0
+            if self._discard:
+                self._discard -= 1
+                continue
+            if self.degraded:
+                self.degraded = False
+                self._reset_backoff = self.RESET_BACKOFF_MIN
+                logger.info(f"Sensor on DOUT={self.hx.DOUT} recovered")
+            self.ring.append(time.monotonic(), value)
+            timestamp = time.time()
+            for estimator in self.estimators:
+                estimator.update(value, timestamp)
+
+    def _timed_out(self, error):
+        now = time.monotonic()
+        if not self.degraded:
+            self.degraded = True
+            self._next_reset = now
+            logger.error(f"Sensor on DOUT={self.hx.DOUT} degraded: {error}")
+        if now < self._next_reset:
+            return
+        self._next_reset = now + self._reset_backoff
+        self._reset_backoff = min(self._reset_backoff * 2, self.RESET_BACKOFF_MAX)
+        try:
+            self.hx.reset()
+        except Exception as e:
+            logger.error(f"Reset of the HX711 on DOUT={self.hx.DOUT} failed: {e}")
+            return
+        self.resets += 1
+        self._discard = 1
+        RESETS.labels(self.hx.sensor_id).inc()
+        logger.warning(f"Reset the HX711 on DOUT={self.hx.DOUT}, next attempt in "
+                       f"{self._next_reset - now:.0f} s")
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def wait_for_samples(self, n, timeout=None):
+        """Block until n samples newer than this call are in the ring; returns them.
+        Raises hx711.ReadTimeoutError after timeout seconds, or as soon as the
+        sensor is degraded."""
+        target = self.ring.count + n
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.ring.count < target:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise ReadTimeoutError(f"Sampler on DOUT={self.hx.DOUT} produced "
+                                   f"{n - (target - self.ring.count)} of {n} samples")
+            if not self.is_alive():
+                raise RuntimeError(f"Sampler on DOUT={self.hx.DOUT} is not running")
+            if self.degraded:
+                raise ReadTimeoutError(f"Sensor on DOUT={self.hx.DOUT} is degraded, no samples")
+            time.sleep(0.01)
+        return self.ring.latest(n)
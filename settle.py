@@ -0,0 +1,75 @@
+"""Adaptive settle detection.
+
+Instead of always averaging a fixed number of readings, keep sampling only
+until the last `window` values are stable -- their standard deviation and
+their drift (least-squares slope times the window length) are both within
+`threshold` -- or until a sample cap or deadline is hit.  A settled load is
+then weighed in a few samples while a swinging one gets as many as allowed.
+"""
+import math
+import time
+from collections import deque, namedtuple
+
+# value: mean of the final window; stable: whether it settled before the
+# caps; samples: number of readings used; elapsed: seconds spent.
+SettledReading = namedtuple('SettledReading', 'value stable samples elapsed')
+
+
+def window_stability(values):
+    """Return (mean, stddev, drift) of a sequence of readings."""
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return mean, 0.0, 0.0
+    stddev = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    # Slope of a least-squares line through (i, values[i]).
+    centre = (n - 1) / 2
+    slope = (sum((i - centre) * (v - mean) for i, v in enumerate(values))
+             / sum((i - centre) ** 2 for i in range(n)))
+    return mean, stddev, slope * (n - 1)
+
+
+def is_settled(values, threshold):
+    _, stddev, drift = window_stability(values)
+    return stddev <= threshold and abs(drift) <= threshold
+
+
+class SettleDetector:
+    """Feed readings with add() until it returns True, then take result()."""
+
+    def __init__(self, threshold, window=5, max_samples=50, timeout=None):
+        if window < 2:
+            raise ValueError("window must be >= 2")
+        if max_samples < window:
+            raise ValueError("max_samples must be >= window")
+        self.threshold = threshold
+        self.window = window
+        self.max_samples = max_samples
+        self.timeout = timeout
+        self.values = deque(maxlen=window)
+        self.samples = 0
+        self.stable = False
+        self.started = time.monotonic()
+
+    def add(self, value):
+        self.values.append(value)
+        self.samples += 1
+        if len(self.values) == self.window and is_settled(self.values, self.threshold):
+            self.stable = True
+        return self.done()
+
+    def done(self):
+        return (self.stable or self.samples >= self.max_samples
+                or (self.timeout is not None and time.monotonic() - self.started >= self.timeout))
+
+    def result(self):
+        value = sum(self.values) / len(self.values) if self.values else 0
+        return SettledReading(value, self.stable, self.samples, time.monotonic() - self.started)
+
+
+def read_until_settled(read, threshold, window=5, max_samples=50, timeout=None):
+    """Call read() until its values settle; returns a SettledReading."""
+    detector = SettleDetector(threshold, window, max_samples, timeout)
+    while not detector.add(read()):
+        pass
+    return detector.result()
@@ -0,0 +1,162 @@
+"""Parallel startup of all configured sensors.
+
+Every sensor is brought up in its own thread, so constructing, resetting and
+taring four HX711s takes about as long as doing it for one.  Per sensor:
+
+    construct   create the WeightSensor (programs the gain with one read)
+    reset       power the chip down and up again
+    settle      wait for the first conversion after the reset and discard
+                it: it was taken at the power-on default gain
+    tare        use the stored offset if it is recent, otherwise tare
+
+Nothing sleeps for a fixed time; every wait is a wait for DOUT to go low.
+Only the waits overlap: the threads share one HX711 clock lock, so one at a
+time bit-bangs a conversion out.  The tare, which needs most of the reads,
+is done afterwards from a single thread: a MultiHX711 reads aligned frames
+from all sensors at the same gain, so no thread competes with the clocking
+for the CPU and holds SCK high long enough to power a chip down.  Sensors
+whose lockstep tare fails are tared one by one.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import CALIBRATION_OFFSET_MAX_AGE
+from multi_hx711 import MultiHX711
+from utils import logger
+from weight_sensor import GAIN_PULSES, WeightSensor
+
+PHASES = ('construct', 'reset', 'settle', 'tare')
+
+
+class StartupReport:
+    """Seconds spent in each phase per sensor, and the overall wall time."""
+
+    def __init__(self):
+        self.phases = {}
+        # sensor_id -> True if tared, False if a stored offset was used
+        self.tared = {}
+        self.errors = {}
+        self.total = 0.0
+
+    def log(self):
+        for sensor_id in sorted(self.phases):
+            timings = ', '.join(f"{phase} {seconds * 1000:.0f} ms"
+                                for phase, seconds in self.phases[sensor_id].items())
+            if sensor_id in self.errors:
+                state = f"failed: {self.errors[sensor_id]}"
+            else:
+                state = "tared" if self.tared[sensor_id] else "stored offset"
+            logger.info(f"Sensor {sensor_id} startup: {timings} ({state})")
+        logger.info(f"Startup of {len(self.phases)} sensors took {self.total * 1000:.0f} ms")
+
+
+def _start_sensor(sensor_id, pins, calibration, max_offset_age, tare_times, report,
+                  sensor_kwargs):
+    phases = report.phases[sensor_id] = {}
+    dout_pin, pd_sck_pin = pins
+
+    started = time.perf_counter()
+    sensor = WeightSensor(dout_pin, pd_sck_pin, sensor_id=sensor_id, **sensor_kwargs)
+    phases['construct'] = time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        sensor.hx.reset()
+        phases['reset'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        sensor.hx.read()
+        phases['settle'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if calibration is not None:
+            sensor.apply_calibration(calibration)
+        tared = calibration is None or not sensor.use_stored_offset(calibration, max_offset_age)
+        phases['tare'] = time.perf_counter() - started
+    except BaseException:
+        sensor.hx.close()
+        raise
+    report.tared[sensor_id] = tared
+    return sensor
+
+
+def _tare_lockstep(sensors, tare_times, report):
+    """Tare sensors ({sensor_id: WeightSensor}, all at the same gain) from
+    the same MultiHX711 frames; returns the ids of those that failed."""
+    first = next(iter(sensors.values())).hx
+    gain = {pulses: gain for gain, pulses in GAIN_PULSES.items()}[first.GAIN]
+    started = time.perf_counter()
+    multi = None
+    try:
+        # Polling: the sensors' own HX711s keep the DOUT edge detection.
+        multi = MultiHX711({sensor_id: (sensor.dout_pin, sensor.pd_sck_pin)
+                            for sensor_id, sensor in sensors.items()},
+                           gain=gain, gpio=first.gpio, ready_mode='poll',
+                           max_retries=first.max_retries, max_slew=first.max_slew,
+                           read_timeout=first.read_timeout)
+        offsets = multi.tare(tare_times)
+    except Exception as e:
+        logger.warning(f"Lockstep tare of sensors {sorted(sensors)} failed ({e}), "
+                       f"taring them one by one")
+        return list(sensors)
+    finally:
+        if multi is not None:
+            multi.close()
+    elapsed = time.perf_counter() - started
+    for sensor_id, offset in zip(multi.sensor_ids, offsets):
+        sensor = sensors[sensor_id]
+        sensor.hx.lastVal = multi.channel(sensor_id).lastVal
+        sensor.tare_to(offset)
+        report.phases[sensor_id]['tare'] += elapsed
+    return []
+
+
+def start_sensors(sensor_configs, calibrations=None, max_offset_age=CALIBRATION_OFFSET_MAX_AGE,
+                  tare_times=15, **sensor_kwargs):
+    """Create, reset and zero a WeightSensor per entry of sensor_configs
+    ({sensor_id: (DT, SCK)}) concurrently.
+
+    calibrations: {sensor_id: SensorCalibration} as loaded by
+    calibration_store; sensors without one are tared and left uncalibrated.
+    Extra keyword arguments go to WeightSensor.  Returns (sensors, report):
+    the sensors that started, by id, and a StartupReport.  A sensor that
+    fails is left out and its exception recorded in report.errors.
+    """
+    calibrations = calibrations or {}
+    sensor_kwargs.setdefault('clock_lock', threading.Lock())
+    report = StartupReport()
+    started_all = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(sensor_configs),
+                            thread_name_prefix='startup') as pool:
+        futures = {sensor_id: pool.submit(_start_sensor, sensor_id, pins,
+                                          calibrations.get(sensor_id), max_offset_age,
+                                          tare_times, report, sensor_kwargs)
+                   for sensor_id, pins in sensor_configs.items()}
+
+    sensors = {}
+    for sensor_id, future in futures.items():
+        try:
+            sensors[sensor_id] = future.result()
+        except Exception as e:
+            report.errors[sensor_id] = e
+            logger.error(f"Sensor {sensor_id} failed to start: {e}")
+
+    by_gain = {}
+    for sensor_id, sensor in sensors.items():
+        if report.tared[sensor_id]:
+            by_gain.setdefault(sensor.hx.GAIN, {})[sensor_id] = sensor
+    failed = []
+    for group in by_gain.values():
+        failed += _tare_lockstep(group, tare_times, report)
+    for sensor_id in failed:
+        started = time.perf_counter()
+        try:
+            sensors[sensor_id].tare(tare_times)
+        except Exception as e:
+            sensors.pop(sensor_id).hx.close()
+            report.errors[sensor_id] = e
+            logger.error(f"Sensor {sensor_id} failed to start: {e}")
+        report.phases[sensor_id]['tare'] += time.perf_counter() - started
+    report.total = time.perf_counter() - started_all
+    return sensors, report
@@ -0,0 +1,85 @@
+"""Validation and retry of HX711 reads, against the simulated chip."""
+import pytest
+
+from gpio_backend import SimulatedBackend
+from hx711 import (HX711, INVALID_CODES, CorruptSampleError, ReadTimeoutError,
+                   check_conversion)
+
+PINS = {1: (5, 12)}
+
+
+def make_hx711(values, **kwargs):
+    """An HX711 whose chip converts the given values in turn; the first one
+    is taken by the gain-setting read of the constructor.  The chip never
+    powers down, so a preempted clock pulse cannot add conversions."""
+    values = iter(values)
+    backend = SimulatedBackend.for_sensors(PINS, rate=80, source=lambda *_: next(values),
+                                           power_down_us=None)
+    hx = HX711(*PINS[1], gpio=backend, ready_mode='poll', **kwargs)
+    return hx, backend.chips[0]
+
+
+@pytest.mark.parametrize('code', sorted(INVALID_CODES))
+def test_invalid_codes_are_rejected(code):
+    # As clocked out (unsigned) and after sign extension.
+    signed = code - (1 << 24) if code & 0x800000 else code
+    for value in (code, signed):
+        assert check_conversion(value, True, None, None, None) == INVALID_CODES[code]
+
+
+def test_dout_low_is_rejected():
+    assert check_conversion(1000, False, None, None, None) == 'dout_low'
+    assert check_conversion(1000, True, None, None, None) is None
+
+
+def test_slew_needs_a_previous_value_and_a_limit():
+    assert check_conversion(5000, True, 1000, None, 100) == 'slew'
+    assert check_conversion(5000, True, None, None, 100) is None
+    assert check_conversion(5000, True, 1000, None, None) is None
+    assert check_conversion(1050, True, 1000, None, 100) is None
+
+
+def test_slew_suspect_is_confirmed_by_the_next_value():
+    assert check_conversion(5030, True, 1000, 5000, 100) is None
+    assert check_conversion(9000, True, 1000, 5000, 100) == 'slew'
+
+
+def test_read_retries_past_a_saturated_conversion():
+    hx, _ = make_hx711([100, 0x7fffff, 200])
+    assert hx.read() == 200
+    assert hx.rejected['saturated'] == 1
+    assert hx.retries == 1
+    hx.close()
+
+
+def test_read_rejects_a_single_spike():
+    hx, _ = make_hx711([100, 110, 90000, 120], max_slew=1000)
+    assert hx.read() == 110
+    assert hx.read() == 120
+    assert hx.rejected['slew'] == 1
+    hx.close()
+
+
+def test_read_follows_a_confirmed_step():
+    hx, _ = make_hx711([100, 110, 90000, 90010], max_slew=1000)
+    assert hx.read() == 110
+    assert hx.read() == 90010
+    assert hx.rejected['slew'] == 1
+    hx.close()
+
+
+def test_read_gives_up_after_max_retries():
+    hx, _ = make_hx711([100] + [-1] * 10, max_retries=2)
+    with pytest.raises(CorruptSampleError):
+        hx.read()
+    assert hx.rejected['all_ones'] == 3
+    assert hx.retries == 2
+    hx.close()
+
+
+def test_read_times_out_on_a_silent_chip():
+    hx, chip = make_hx711([100] * 10, read_timeout=0.05)
+    chip.powered = False
+    with pytest.raises(ReadTimeoutError):
+        hx.read()
+    hx.close()
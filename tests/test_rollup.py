@@ -0,0 +1,98 @@
+"""Saving and loading rollups: snapshot, journal replay and damaged files."""
+import os
+import time
+
+import numpy as np
+
+from config import ROLLUP_FILE
+from rollup import FIELDS, JOURNAL_HEADER, JOURNAL_SUFFIX, RollupStore
+from weight_sensing_system import load_rollups
+
+TIERS = ((1, 600), (60, 7200))
+
+
+def add(store, start, seconds, sensors=(1, 2), rate=10):
+    timestamps = start + np.arange(seconds * rate) / rate
+    for sensor in sensors:
+        store.add_block(sensor, timestamps, np.sin(timestamps) * 100 + sensor)
+
+
+def assert_same(loaded, expected):
+    assert loaded.sensors == expected.sensors
+    for sensor in expected.sensors:
+        for tier, other in zip(loaded._sensors[sensor], expected._sensors[sensor]):
+            for field in FIELDS:
+                assert np.array_equal(getattr(tier, field), getattr(other, field)), field
+
+
+def test_journal_replays_onto_the_snapshot(tmp_path):
+    path = str(tmp_path / ROLLUP_FILE)
+    now = time.time()
+    store = RollupStore(TIERS)
+    add(store, now - 300, 100)
+    store.save(path)
+    snapshot_size = os.path.getsize(path)
+
+    add(store, now - 200, 100)
+    add(store, now - 100, 50, sensors=(3,))
+    store.save(path)
+    # Only the journal grew.
+    assert os.path.getsize(path) == snapshot_size
+    assert os.path.getsize(path + JOURNAL_SUFFIX) > JOURNAL_HEADER.size
+
+    loaded = RollupStore.load(path, TIERS)
+    assert_same(loaded, store)
+    rollup = loaded.query(1, now - 300, now, resolution=1)
+    assert rollup.count.sum() == 2000
+
+
+def test_journal_of_another_snapshot_is_ignored(tmp_path):
+    path = str(tmp_path / ROLLUP_FILE)
+    now = time.time()
+    old = RollupStore(TIERS)
+    add(old, now - 300, 100)
+    old.save(path)
+    add(old, now - 200, 100)
+    old.save(path)
+    with open(path + JOURNAL_SUFFIX, 'rb') as f:
+        stale_journal = f.read()
+
+    new = RollupStore(TIERS)
+    add(new, now - 100, 50)
+    new.save(path)
+    # A crash between replacing the snapshot and its journal.
+    with open(path + JOURNAL_SUFFIX, 'wb') as f:
+        f.write(stale_journal)
+
+    assert_same(RollupStore.load(path, TIERS), new)
+
+
+def test_truncated_journal_keeps_complete_records(tmp_path):
+    path = str(tmp_path / ROLLUP_FILE)
+    now = time.time()
+    store = RollupStore(TIERS)
+    add(store, now - 300, 100)
+    store.save(path)
+    add(store, now - 200, 100)
+    store.save(path)
+    journal = path + JOURNAL_SUFFIX
+    os.truncate(journal, os.path.getsize(journal) - 10)
+
+    loaded = RollupStore.load(path, TIERS)
+    # All but the last record made it: sensor 2's last changed minute bucket.
+    assert loaded.query(1, now - 300, now, resolution=60).count.sum() == 2000
+    assert loaded.query(2, now - 300, now, resolution=1).count.sum() == 2000
+    assert loaded.query(2, now - 300, now, resolution=60).count.sum() < 2000
+    # The next save starts over with a snapshot and an empty journal.
+    loaded.save(path)
+    assert os.path.getsize(journal) == JOURNAL_HEADER.size
+    assert_same(RollupStore.load(path, TIERS), loaded)
+
+
+def test_missing_empty_or_corrupt_file_starts_empty(tmp_path):
+    assert load_rollups(str(tmp_path)).sensors == []
+    path = tmp_path / ROLLUP_FILE
+    path.write_bytes(b'')
+    assert load_rollups(str(tmp_path)).sensors == []
+    path.write_bytes(b'PK\x03\x04' + b'\0' * 100)
+    assert load_rollups(str(tmp_path)).sensors == []
@@ -0,0 +1,92 @@
+"""Sample log segments: rotation, damaged segments and range reads."""
+import os
+
+import numpy as np
+
+from sample_log import (HEADER_SIZE, RECORD_DTYPE, SampleLogWriter, iter_range, last_timestamp,
+                        read_log, read_range, segment_paths)
+
+START = 1.7e9
+
+
+def write_log(directory, count=1000, rate=100.0, sensors=(1, 2), **kwargs):
+    """count samples per sensor, rate per second, starting at START."""
+    writer = SampleLogWriter(str(directory), **kwargs)
+    for i in range(count):
+        for sensor in sensors:
+            writer.append(START + i / rate, sensor, i, i / 10.0)
+        if i % 100 == 99:
+            writer.flush()
+    writer.close()
+    return writer
+
+
+def test_segments_rotate_at_segment_bytes(tmp_path):
+    write_log(tmp_path, segment_bytes=100 * RECORD_DTYPE.itemsize, batch_size=50)
+    assert len(segment_paths(str(tmp_path))) > 1
+    records = read_log(str(tmp_path))
+    assert len(records) == 2000
+    assert np.all(np.diff(records['timestamp']) >= 0)
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    write_log(tmp_path, count=10)
+    path = segment_paths(str(tmp_path))[-1]
+    with open(path, 'ab') as f:
+        f.write(b'\x01' * (RECORD_DTYPE.itemsize // 2))
+    assert len(read_log(str(tmp_path))) == 20
+    assert last_timestamp(str(tmp_path)) == START + 9 / 100.0
+
+
+def test_segment_without_header_is_empty(tmp_path):
+    write_log(tmp_path, count=10)
+    short = tmp_path / 'samples-9999999999999998.hxl'
+    short.write_bytes(b'HXL')
+    zeros = tmp_path / 'samples-9999999999999999.hxl'
+    zeros.write_bytes(b'\0' * (HEADER_SIZE + 2 * RECORD_DTYPE.itemsize))
+    assert len(read_log(str(tmp_path))) == 20
+    assert last_timestamp(str(tmp_path)) == START + 9 / 100.0
+
+    # The writer picks up after them instead of failing.
+    writer = SampleLogWriter(str(tmp_path))
+    writer.append(START + 1, 1, 5, 0.5)
+    writer.close()
+    assert len(read_log(str(tmp_path))) == 21
+
+
+def test_unreadable_segment_is_skipped_by_range_reads(tmp_path):
+    write_log(tmp_path, count=10)
+    (tmp_path / 'samples-0000000000000001.hxl').write_bytes(b'XXXX' + b'\0' * 40)
+    assert len(read_range(str(tmp_path))) == 20
+
+
+def test_range_reads(tmp_path):
+    write_log(tmp_path, segment_bytes=100 * RECORD_DTYPE.itemsize, batch_size=50)
+    directory = str(tmp_path)
+    start, end = START + 2.5, START + 7.25
+    records = read_range(directory, start, end)
+    assert len(records) == 2 * 475
+    assert records['timestamp'].min() >= start
+    assert records['timestamp'].max() < end
+
+    only = read_range(directory, start, end, sensors=[2])
+    assert len(only) == 475
+    assert set(only['sensor'].tolist()) == {2}
+
+    chunks = list(iter_range(directory, start, end, chunk_size=64))
+    assert all(len(chunk) <= 64 for chunk in chunks)
+    assert np.array_equal(np.concatenate(chunks), records)
+
+    assert len(read_range(directory, START + 100, START + 200)) == 0
+    assert len(read_range(directory, None, START + 1)) == 200
+
+
+def test_timestamps_never_decrease(tmp_path):
+    writer = SampleLogWriter(str(tmp_path))
+    writer.append(START + 1, 1, 0, 0.0)
+    writer.append(START, 1, 0, 0.0)
+    writer.append_block(np.array([START - 5, START + 2]), 1, [0, 0], [0.0, 0.0])
+    writer.close()
+    timestamps = read_log(str(tmp_path))['timestamp']
+    assert timestamps.tolist() == [START + 1, START + 1, START + 1, START + 2]
+    assert os.path.getsize(segment_paths(str(tmp_path))[0]) == HEADER_SIZE + 4 * RECORD_DTYPE.itemsize
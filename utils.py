@@ -1,24 +1,53 @@
 import time
-import RPi.GPIO as GPIO
 import logging
 
+from gpio_backend import get_default_backend
+from metrics import REGISTRY
+
+LOG_RECORDS = REGISTRY.counter('log_records_total', "Log records handled", ['level'])
+LOG_SECONDS = REGISTRY.histogram('log_handle_seconds', "Time spent formatting and writing log records")
+FILTER_SECONDS = REGISTRY.histogram('weight_filter_seconds',
+                                    "Time spent filtering readings in get_stable_reading")
+
+def _timed_handle(handle):
+    def timed(record):
+        if not REGISTRY.enabled:
+            return handle(record)
+        started = time.perf_counter()
+        try:
+            return handle(record)
+        finally:
+            LOG_SECONDS.observe(time.perf_counter() - started)
+            LOG_RECORDS.labels(record.levelname).inc()
+    timed.timed = True
+    return timed
+
 def setup_logging():
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Measure logging overhead at the handlers, where the formatting and I/O happen.
+    for handler in logging.getLogger().handlers:
+        if not getattr(handler.handle, 'timed', False):
+            handler.handle = _timed_handle(handler.handle)
     return logging.getLogger('weight_sensing_system')
 
 logger = setup_logging()
 
 def setup_gpio():
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
+    get_default_backend().setwarnings(False)
 
-def get_stable_reading(hx, num_readings=10, delay=0.1):
+def get_stable_reading(hx, num_readings=10, delay=0.1, weight_filter=None, read=None):
+    # read: returns one weight, hx.get_weight(5) by default.
+    if read is None:
+        read = lambda: hx.get_weight(5)
     readings = []
     for _ in range(num_readings):
         try:
-            value = hx.get_weight(5)
+            value = read()
             if value != 0:  # Avoid adding zero readings
                 readings.append(value)
+        except TimeoutError:
+            # Past a deadline the remaining readings would time out too.
+            raise
         except Exception as e:
             logger.error(f"Error in individual reading: {e}")
         time.sleep(delay)
@@ -27,8 +56,15 @@ def get_stable_reading(hx, num_readings=10, delay=0.1):
         logger.warning("No valid readings obtained")
         return 0
     
-    return sum(readings) / len(readings)
+    started = time.perf_counter()
+    if weight_filter is not None:
+        value = float(weight_filter(readings))
+    else:
+        value = sum(readings) / len(readings)
+    if REGISTRY.enabled:
+        FILTER_SECONDS.observe(time.perf_counter() - started)
+    return value
 
 def graceful_shutdown():
-    GPIO.cleanup()
+    get_default_backend().cleanup()
     logger.info("GPIO cleaned up")
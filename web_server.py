@@ -0,0 +1,360 @@
+"""asyncio HTTP server for remote monitoring.
+
+Request handlers never touch the GPIO: a publisher task takes a snapshot of
+every sensor's sampler ring every `interval` seconds, encodes it to JSON
+once, and both serves it and pushes it to Server-Sent Events clients.  With
+an aggregator.PlatformAggregator, each snapshot also carries the platform
+frames aggregated since the previous one, so /events streams them at the
+combined sample rate of all corners.
+
+    GET /          latest snapshot of every sensor as JSON (also /weight)
+    GET /events    Server-Sent Events stream of snapshots
+    GET /load-events  Server-Sent Events stream of load_events.LoadEvents
+    GET /history?sensor=&start=&end=&resolution=
+                   min/max/mean/last buckets of one sensor from rollup.RollupStore
+    GET /samples?start=&end=&sensor=&format=csv|raw
+                   records of the sample log in [start, end), streamed
+    GET /metrics   counters and latency histograms, Prometheus text format
+
+Each SSE client has its own bounded queue; a client that reads too slowly
+loses its oldest pending snapshots instead of slowing anyone else down.
+"""
+import asyncio
+import json
+import math
+import time
+from urllib.parse import parse_qs
+
+from config import WEB_SERVER_PORT, WEB_PUBLISH_INTERVAL, WEB_CLIENT_QUEUE
+from metrics import REGISTRY
+from sample_log import RECORD_DTYPE, iter_range
+from utils import logger
+
+REQUEST_TIMEOUT = 10.0
+MAX_REQUEST_BYTES = 8192
+# Records read from the sample log per chunk of a /samples response.
+SAMPLES_CHUNK = 8192
+
+ROUTES = ('/', '/weight', '/events', '/load-events', '/history', '/samples', '/metrics')
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+HTTP_REQUESTS = REGISTRY.counter('http_requests_total', "HTTP requests by path and status",
+                                 ['path', 'status'])
+HTTP_SECONDS = REGISTRY.histogram('http_request_seconds',
+                                  "Time to answer an HTTP request (streams excluded)", ['path'])
+SNAPSHOT_SECONDS = REGISTRY.histogram('http_snapshot_seconds', "Time to take and encode a snapshot")
+SSE_CLIENTS = REGISTRY.gauge('http_sse_clients', "Connected Server-Sent Events clients")
+SSE_DROPPED = REGISTRY.counter('http_sse_dropped_total',
+                               "Snapshots dropped because a client read too slowly")
+
+
+class WebServer:
+    def __init__(self, sensors, port=WEB_SERVER_PORT, host='0.0.0.0',
+                 interval=WEB_PUBLISH_INTERVAL, client_queue=WEB_CLIENT_QUEUE, load_events=None,
+                 rollups=None, sample_log=None, platform=None):
+        # sensors: a WeightSensor, or a dict of sensor id -> WeightSensor
+        if not isinstance(sensors, dict):
+            sensors = {1: sensors}
+        self.sensors = sensors
+        # load_events.EventBus streamed on /load-events (None: 404)
+        self.load_events = load_events
+        # rollup.RollupStore served on /history (None: 404)
+        self.rollups = rollups
+        # Sample log directory served on /samples (None: 404)
+        self.sample_log = sample_log
+        # aggregator.PlatformAggregator whose frames go into every snapshot
+        self.platform = platform
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self.client_queue = client_queue
+
+        self.snapshot = b'{}'
+        self.clients = set()
+        self.requests = 0
+        self.dropped = 0
+        self._server = None
+        self._publisher = None
+        # Ring counts of the platform's sensors and the timestamp of the last
+        # frame at the previous snapshot.
+        self._platform_counts = None
+        self._platform_last = None
+
+    def take_snapshot(self):
+        sensors = {}
+        for sensor_id, sensor in self.sensors.items():
+            sensors[str(sensor_id)] = sensor.snapshot()
+        snapshot = {'timestamp': time.time(), 'sensors': sensors}
+        if self.platform is not None:
+            snapshot['platform'] = self.platform_snapshot()
+        return json.dumps(snapshot).encode()
+
+    def platform_snapshot(self):
+        """Platform frames since the previous snapshot (only the latest one
+        in the first), None while a sensor is degraded or before every
+        sensor has a sample.  Timestamps are epoch seconds; x and y are
+        null while the total is below the aggregator's min_total."""
+        if any(sensor.degraded for sensor in self.platform.sensors):
+            return None
+        counts = [sensor.sampler.ring.count for sensor in self.platform.sensors]
+        if self._platform_counts is None:
+            n = 1
+        else:
+            # A frame per new sample of any sensor, plus one earlier sample
+            # of each to fill in the frames.
+            n = max(count - seen for count, seen in zip(counts, self._platform_counts)) + 1
+        self._platform_counts = counts
+        result = self.platform.window(n)
+        if self._platform_last is not None:
+            result = result._make(field[result.timestamps > self._platform_last]
+                                  for field in result)
+        if not len(result.timestamps):
+            return None
+        self._platform_last = float(result.timestamps[-1])
+        # The rings hold time.monotonic() timestamps.
+        epoch = time.time() - time.monotonic()
+        return {
+            'timestamps': (result.timestamps + epoch).tolist(),
+            'total': result.total.tolist(),
+            'x': [None if math.isnan(x) else x for x in result.x.tolist()],
+            'y': [None if math.isnan(y) else y for y in result.y.tolist()],
+            'loads': result.loads.tolist(),
+        }
+
+    async def publish(self):
+        while True:
+            started = time.perf_counter()
+            try:
+                self.snapshot = self.take_snapshot()
+            except Exception as e:
+                logger.error(f"Error taking sensor snapshot: {e}")
+            else:
+                if REGISTRY.enabled:
+                    SNAPSHOT_SECONDS.observe(time.perf_counter() - started)
+                event = b'data: ' + self.snapshot + b'\n\n'
+                for queue in self.clients:
+                    if queue.full():
+                        queue.get_nowait()
+                        self.dropped += 1
+                        SSE_DROPPED.inc()
+                    queue.put_nowait(event)
+            await asyncio.sleep(self.interval)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError):
+            writer.close()
+            return
+        self.requests += 1
+        started = time.perf_counter()
+
+        try:
+            method, path, _ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        except ValueError:
+            await self.respond(writer, 400, b'Bad Request', 'text/plain')
+            return
+        path, _, query = path.partition('?')
+
+        try:
+            status = await self.route(writer, method, path, query)
+        except Exception:
+            logger.exception(f"Error handling {method} {path}")
+            if writer.is_closing():
+                # Part of a response went out already: all that is left is to hang up.
+                return
+            status = await self.respond(writer, 500, b'Internal Server Error', 'text/plain')
+        if status is None:
+            # A stream, counted when it started.
+            return
+
+        if REGISTRY.enabled:
+            # Unknown paths share one series so scanners can't grow the label set.
+            label = path if path in ROUTES else 'other'
+            HTTP_REQUESTS.labels(label, status).inc()
+            HTTP_SECONDS.labels(label).observe(time.perf_counter() - started)
+
+    async def route(self, writer, method, path, query):
+        """Answer a request; returns the status, None for a stream."""
+        if method != 'GET':
+            status = await self.respond(writer, 405, b'Method Not Allowed', 'text/plain')
+        elif path in ('/', '/weight'):
+            status = await self.respond(writer, 200, self.snapshot, 'application/json')
+        elif path == '/metrics':
+            status = await self.respond(writer, 200, REGISTRY.render().encode(),
+                                        METRICS_CONTENT_TYPE)
+        elif path == '/events':
+            if REGISTRY.enabled:
+                HTTP_REQUESTS.labels(path, 200).inc()
+            await self.stream(writer)
+            return None
+        elif path == '/history' and self.rollups is not None:
+            status = await self.history(writer, parse_qs(query))
+        elif path == '/samples' and self.sample_log is not None:
+            status = await self.samples(writer, parse_qs(query))
+        elif path == '/load-events' and self.load_events is not None:
+            if REGISTRY.enabled:
+                HTTP_REQUESTS.labels(path, 200).inc()
+            await self.stream_load_events(writer)
+            return None
+        else:
+            status = await self.respond(writer, 404, b'Not Found', 'text/plain')
+        return status
+
+    async def respond(self, writer, status, body, content_type):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}[status]
+        header = (f"HTTP/1.1 {status} {reason}\r\n"
+                  f"Content-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\n"
+                  "Access-Control-Allow-Origin: *\r\n"
+                  "Connection: close\r\n\r\n").encode()
+        try:
+            writer.write(header + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+        return status
+
+    async def history(self, writer, params):
+        try:
+            sensor = int(params['sensor'][0])
+            end = float(params['end'][0]) if 'end' in params else time.time()
+            start = float(params['start'][0]) if 'start' in params else end - 3600
+            resolution = float(params['resolution'][0]) if 'resolution' in params else None
+        except (KeyError, ValueError):
+            return await self.respond(writer, 400, b'Bad Request', 'text/plain')
+        if (not math.isfinite(start) or not math.isfinite(end) or start >= end
+                or (resolution is not None and not (math.isfinite(resolution) and resolution > 0))):
+            return await self.respond(writer, 400, b'Bad Request', 'text/plain')
+        try:
+            rollup = self.rollups.query(sensor, start, end, resolution)
+        except KeyError:
+            return await self.respond(writer, 404, b'Not Found', 'text/plain')
+        except (ValueError, OverflowError):
+            # Finite, but too far from now to be a bucket id.
+            return await self.respond(writer, 400, b'Bad Request', 'text/plain')
+        body = {field: value.tolist() if hasattr(value, 'tolist') else value
+                for field, value in rollup._asdict().items()}
+        body['sensor'] = sensor
+        return await self.respond(writer, 200, json.dumps(body).encode(), 'application/json')
+
+    async def samples(self, writer, params):
+        try:
+            end = float(params['end'][0]) if 'end' in params else time.time()
+            start = float(params['start'][0]) if 'start' in params else end - 60
+            sensors = [int(sensor) for sensor in params['sensor']] if 'sensor' in params else None
+            raw = params.get('format', ['csv'])[0] == 'raw'
+        except ValueError:
+            return await self.respond(writer, 400, b'Bad Request', 'text/plain')
+        chunks = iter_range(self.sample_log, start, end, sensors, SAMPLES_CHUNK)
+        loop = asyncio.get_running_loop()
+        content_type = 'application/octet-stream' if raw else 'text/csv'
+        # Reading and encoding happen off the event loop.  The first chunk is
+        # read before the status line, so a log that cannot be read at all
+        # gets a 500 instead of an empty or truncated 200.
+        try:
+            body = await loop.run_in_executor(None, self._samples_chunk, chunks, raw)
+        except Exception:
+            chunks.close()
+            logger.exception(f"Cannot read the sample log in {self.sample_log}")
+            return await self.respond(writer, 500, b'Internal Server Error', 'text/plain')
+        try:
+            # No Content-Length: the body ends when the connection closes.
+            writer.write(f"HTTP/1.1 200 OK\r\n"
+                         f"Content-Type: {content_type}\r\n"
+                         "Access-Control-Allow-Origin: *\r\n"
+                         "Connection: close\r\n\r\n".encode())
+            if not raw:
+                writer.write((','.join(RECORD_DTYPE.names) + '\n').encode())
+            while body is not None:
+                writer.write(body)
+                await writer.drain()
+                body = await loop.run_in_executor(None, self._samples_chunk, chunks, raw)
+        except ConnectionError:
+            pass
+        finally:
+            chunks.close()
+            writer.close()
+        return 200
+
+    @staticmethod
+    def _samples_chunk(chunks, raw):
+        records = next(chunks, None)
+        if records is None:
+            return None
+        if raw:
+            return records.tobytes()
+        return ''.join(f"{t!r},{s},{f},{r},{w!r}\n"
+                       for t, s, f, r, w in records.tolist()).encode()
+
+    def _stream_header(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\n"
+                     b"Connection: keep-alive\r\n\r\n")
+
+    async def stream(self, writer):
+        queue = asyncio.Queue(self.client_queue)
+        queue.put_nowait(b'data: ' + self.snapshot + b'\n\n')
+        self.clients.add(queue)
+        SSE_CLIENTS.inc()
+        try:
+            self._stream_header(writer)
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(queue)
+            SSE_CLIENTS.dec()
+            writer.close()
+
+    async def stream_load_events(self, writer):
+        SSE_CLIENTS.inc()
+        events = self.load_events.subscribe()
+        try:
+            self._stream_header(writer)
+            await writer.drain()
+            async for event in events:
+                writer.write(f"event: {event.kind}\ndata: {json.dumps(event._asdict())}\n\n".encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            await events.aclose()
+            SSE_CLIENTS.dec()
+            writer.close()
+
+    async def start(self):
+        self.snapshot = self.take_snapshot()
+        self._publisher = asyncio.ensure_future(self.publish())
+        self._server = await asyncio.start_server(self.handle, self.host, self.port,
+                                                  limit=MAX_REQUEST_BYTES)
+        logger.info(f"Web server listening on port {self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._publisher is not None:
+            self._publisher.cancel()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def start_web_server(sensors, port=WEB_SERVER_PORT, load_events=None, rollups=None,
+                     sample_log=None, platform=None):
+    """Run the web server in the calling thread until the process exits."""
+    asyncio.run(WebServer(sensors, port, load_events=load_events, rollups=rollups,
+                          sample_log=sample_log, platform=platform).serve_forever())
@@ -0,0 +1,112 @@
+"""Single-flight cache for expensive measurements.
+
+Concurrent callers share one in-flight measurement instead of each running
+their own, and a finished result is reused while it is younger than the
+caller's max_age (counted from when the measurement finished).  A caller
+asking for a fresh value gets a measurement that started after its call.
+compute(timeout) is given the timeout of the caller that starts the
+measurement; callers joining it wait at most their own.
+"""
+import threading
+import time
+
+from metrics import REGISTRY
+
+REQUESTS = REGISTRY.counter('weight_cache_requests_total',
+                            "Cache lookups by result: hit, miss (measured) or coalesced",
+                            ['result'])
+HITS = REQUESTS.labels('hit')
+MISSES = REQUESTS.labels('miss')
+COALESCED = REQUESTS.labels('coalesced')
+
+
+class _Flight:
+    def __init__(self, started):
+        self.started = started
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class WeightCache:
+    def __init__(self, compute, max_age=0.0):
+        self.compute = compute
+        self.max_age = max_age
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._inflight = None
+        self._value = None
+        # Start and end time of the measurement that produced _value.
+        self._started = None
+        self._measured = None
+
+    def get(self, max_age=None, fresh=False, timeout=None):
+        """Return a value no older than max_age seconds (default self.max_age),
+        or one measured entirely after this call if fresh is set.  Raises
+        TimeoutError if there is none after timeout seconds (None: no limit)."""
+        if max_age is None:
+            max_age = self.max_age
+        called = time.monotonic()
+        deadline = None if timeout is None else called + timeout
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self._measured is not None and (self._started >= called if fresh
+                                                   else now - self._measured <= max_age):
+                    self.hits += 1
+                    if REGISTRY.enabled:
+                        HITS.inc()
+                    return self._value
+
+                flight = self._inflight
+                if flight is None:
+                    flight = self._inflight = _Flight(now)
+                    self.misses += 1
+                    if REGISTRY.enabled:
+                        MISSES.inc()
+                    leader = True
+                elif fresh and flight.started < called:
+                    # Started before we asked: wait for it, then measure again.
+                    leader = None
+                else:
+                    self.coalesced += 1
+                    if REGISTRY.enabled:
+                        COALESCED.inc()
+                    leader = False
+
+            if leader:
+                return self._run(flight, None if deadline is None else deadline - now)
+            if not flight.done.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                raise TimeoutError("Timed out waiting for a measurement in progress")
+            if leader is False:
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+
+    def _run(self, flight, timeout):
+        try:
+            flight.value = self.compute(timeout)
+        except Exception as e:
+            flight.error = e
+        with self._lock:
+            if flight.error is None:
+                self._value = flight.value
+                self._started = flight.started
+                self._measured = time.monotonic()
+            self._inflight = None
+        flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def invalidate(self):
+        with self._lock:
+            self._measured = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
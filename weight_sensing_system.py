@@ -1,48 +1,266 @@
+import os
 import time
-import pickle
-from config import DATA_SAVE_INTERVAL, DATA_FILE, WEB_SERVER_PORT
+import numpy as np
+from config import (DATA_SAVE_INTERVAL, DATA_DIR, DATA_FSYNC_INTERVAL, DATA_SEGMENT_BYTES,
+                    DATA_SEGMENT_SECONDS, SAMPLE_BUFFER_SIZE,
+                    WEIGHT_WINDOW, STATS_WINDOW, GPIO_BACKEND, SETTLE_THRESHOLD, SETTLE_WINDOW,
+                    SETTLE_MAX_SAMPLES, SETTLE_TIMEOUT, WEIGHT_CACHE_MAX_AGE, METRICS_ENABLED,
+                    CALIBRATION_FILE, SENSOR_CONFIGS, AUTO_ZERO_ENABLED, AUTO_ZERO_BAND,
+                    AUTO_ZERO_RATE, AUTO_ZERO_WINDOW, AUTO_ZERO_MIN_STEP, AUTO_ZERO_SAVE_INTERVAL,
+                    ACQUISITION_PROCESS, ACQUISITION_CPU, ACQUISITION_PRIORITY,
+                    READ_MAX_RETRIES, READ_MAX_SLEW, READ_TIMEOUT, PLATFORM_POSITIONS,
+                    PLATFORM_COUPLING, LOAD_EVENTS_ENABLED, LOAD_EVENTS_DRIFT,
+                    LOAD_EVENTS_THRESHOLD, LOAD_EVENTS_MIN_DELTA, LOAD_EVENTS_SETTLE_WINDOW,
+                    LOAD_CELL_CAPACITY, RECORD_FILE, RECORD_SECONDS, ROLLUP_FILE,
+                    ROLLUP_SAVE_INTERVAL)
+from acquisition import AcquisitionProcess
+from aggregator import PlatformAggregator
+from calibration_store import CalibrationError, load_calibration, save_calibration
+from gpio_backend import create_backend, set_default_backend
+from load_events import EventBus
+from metrics import REGISTRY
+from recording import StreamRecorder
+from rollup import RollupStore
+from sample_log import SampleLogWriter
 from utils import setup_gpio, logger, graceful_shutdown
-from weight_sensor import WeightSensor
+from startup import start_sensors
 import threading
-import csv
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import json
+from web_server import start_web_server
+
+DROPPED = REGISTRY.counter('data_saver_dropped_total',
+                           "Samples overwritten in the ring before the DataSaver logged them",
+                           ['sensor'])
+
+class DataSaver(threading.Thread):
+    """Moves the samples of every sensor from its sampler ring into the
+    binary sample log, one batch every DATA_SAVE_INTERVAL seconds.  With a
+    rollup.RollupStore, the weights are added to it as well, and it is saved
+    as ROLLUP_FILE in the log directory every ROLLUP_SAVE_INTERVAL seconds."""
+
+    def __init__(self, sensors, directory=DATA_DIR, interval=DATA_SAVE_INTERVAL, rollups=None):
+        super().__init__(name='data-saver', daemon=True)
+        # sensors: a WeightSensor, or a dict of sensor id -> WeightSensor
+        if not isinstance(sensors, dict):
+            sensors = {1: sensors}
+        for sensor_id, sensor in sensors.items():
+            if sensor.sampler is None:
+                raise ValueError(f"DataSaver needs background sampling on sensor {sensor_id}")
+        self.sensors = sensors
+        self.interval = interval
+        self.writer = SampleLogWriter(directory, DATA_SEGMENT_BYTES, DATA_SEGMENT_SECONDS,
+                                      DATA_FSYNC_INTERVAL)
+        self.saved = {sensor_id: sensor.sampler.ring.count for sensor_id, sensor in sensors.items()}
+        self.dropped = 0
+        self.rollups = rollups
+        self.rollup_path = os.path.join(directory, ROLLUP_FILE)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        logger.info(f"DataSaver started, logging samples to {self.writer.directory}")
+        last_rollup_save = time.monotonic()
+        while not self._stop_event.wait(self.interval):
+            self.save()
+            if self.rollups is not None and time.monotonic() - last_rollup_save >= ROLLUP_SAVE_INTERVAL:
+                self.save_rollups()
+                last_rollup_save = time.monotonic()
+        self.save()
+        self.writer.close()
+        if self.rollups is not None:
+            self.save_rollups()
+        logger.info(f"DataSaver stopped after {self.writer.records_written} records")
+
+    def save(self):
+        # Ring timestamps are monotonic clock readings, the log stores wall time.
+        wall_offset = time.time() - time.monotonic()
+        blocks = []
+        for sensor_id, sensor in self.sensors.items():
+            ring = sensor.sampler.ring
+            count = ring.count
+            timestamps, raws = ring.read(self.saved[sensor_id], count)
+            lost = count - self.saved[sensor_id] - len(raws)
+            self.saved[sensor_id] = count
+            if lost:
+                self.dropped += lost
+                DROPPED.labels(sensor_id).inc(lost)
+                logger.warning(f"DataSaver fell behind, {lost} samples of "
+                               f"sensor {sensor_id} were lost")
+            if len(raws):
+                blocks.append((sensor_id, timestamps + wall_offset, raws,
+                               sensor.raw_to_weight(raws)))
+        if not blocks:
+            return
+        try:
+            if self.rollups is not None:
+                for sensor_id, timestamps, _, weights in blocks:
+                    self.rollups.add_block(sensor_id, timestamps, weights)
+            # One block in timestamp order: the log keeps its timestamps
+            # non-decreasing, so sensors logged one after another would get
+            # the last timestamp of the one before.
+            timestamps = np.concatenate([block[1] for block in blocks])
+            order = np.argsort(timestamps, kind='stable')
+            sensor_ids = np.concatenate([np.full(len(block[2]), block[0], dtype=np.uint16)
+                                         for block in blocks])
+            self.writer.append_block(timestamps[order], sensor_ids[order],
+                                     np.concatenate([block[2] for block in blocks])[order],
+                                     np.concatenate([block[3] for block in blocks])[order])
+            self.writer.flush()
+        except OSError as e:
+            logger.error(f"Error saving samples: {e}")
+
+    def save_rollups(self):
+        try:
+            self.rollups.save(self.rollup_path)
+        except OSError as e:
+            logger.error(f"Error saving rollups: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def load_rollups(directory=DATA_DIR):
+    """The RollupStore saved in a log directory, or an empty one."""
+    path = os.path.join(directory, ROLLUP_FILE)
+    try:
+        rollups = RollupStore.load(path)
+        logger.info(f"Rollups of sensors {rollups.sensors} loaded")
+        return rollups
+    except FileNotFoundError:
+        return RollupStore()
+    except Exception as e:
+        # Also EOFError for an empty file, zipfile.BadZipFile for a truncated one.
+        logger.warning(f"Could not load the rollups from {path}, starting empty: {e}")
+        return RollupStore()
+
+
+def save_offsets(sensors, sensor_ids, calibrations):
+    """Store the current offset of the given sensors in CALIBRATION_FILE."""
+    if not sensor_ids:
+        return
+    for sensor_id in sensor_ids:
+        calibrations[sensor_id] = sensors[sensor_id].calibration_record(
+            sensor_id, calibrations[sensor_id].temperature)
+    try:
+        save_calibration(calibrations, CALIBRATION_FILE)
+        logger.info(f"Offsets of sensors {sorted(sensor_ids)} saved")
+    except OSError as e:
+        logger.warning(f"Could not store the new offsets: {e}")
 
-# ... (keep the DataSaver and SimpleHTTPRequestHandler classes as they were) ...
 
 def main():
     try:
+        REGISTRY.enabled = METRICS_ENABLED
+        set_default_backend(create_backend(GPIO_BACKEND))
         setup_gpio()
         logger.info("GPIO setup completed")
 
-        weight_sensor = WeightSensor(dout_pin=5, pd_sck_pin=6)
-        weight_sensor.setup()
-
         try:
-            with open('calibration_data.pkl', 'rb') as f:
-                calibration_data = pickle.load(f)
-            reference_unit = calibration_data['reference_unit']
-            if reference_unit == 0:
-                raise ValueError("Invalid reference unit in calibration data")
-            weight_sensor.set_reference_unit(reference_unit)
-            logger.info(f"Calibration data loaded successfully. Reference unit: {reference_unit}")
-        except (FileNotFoundError, KeyError, ValueError) as e:
+            calibrations = load_calibration(CALIBRATION_FILE)
+            missing = sorted(set(SENSOR_CONFIGS) - set(calibrations))
+            if missing:
+                raise KeyError(f"no calibration for sensors {missing}")
+            logger.info("Calibration data loaded successfully. Reference units: " +
+                        ", ".join(f"{sensor_id}: {calibrations[sensor_id].reference_unit}"
+                                  for sensor_id in SENSOR_CONFIGS))
+        except (FileNotFoundError, KeyError, CalibrationError) as e:
             logger.error(f"Error loading calibration data: {e}")
             logger.warning("Please run the calibration process before using the system.")
             return
 
-        data_saver = DataSaver(weight_sensor)
+        sensors, report = start_sensors(SENSOR_CONFIGS, calibrations,
+                                        cache_max_age=WEIGHT_CACHE_MAX_AGE,
+                                        max_retries=READ_MAX_RETRIES, max_slew=READ_MAX_SLEW,
+                                        read_timeout=READ_TIMEOUT)
+        report.log()
+        if not sensors:
+            logger.error("No sensor started")
+            return
+
+        # Keep the new offsets so the next start can skip the tare.
+        save_offsets(sensors, [sensor_id for sensor_id in sensors if report.tared[sensor_id]],
+                     calibrations)
+
+        acquisition = None
+        if ACQUISITION_PROCESS:
+            # From here on only the acquisition process reads the chips.
+            for sensor in sensors.values():
+                sensor.hx.close()
+            acquisition = AcquisitionProcess(
+                {sensor_id: SENSOR_CONFIGS[sensor_id] for sensor_id in sensors},
+                SAMPLE_BUFFER_SIZE, gains={sensor_id: calibrations[sensor_id].gain
+                                           for sensor_id in sensors},
+                max_retries=READ_MAX_RETRIES, max_slew=READ_MAX_SLEW, read_timeout=READ_TIMEOUT,
+                cpu=ACQUISITION_CPU, priority=ACQUISITION_PRIORITY)
+            acquisition.start()
+
+        # Sensors whose offset auto-zero moved since the last save.
+        drifted = set()
+        load_events = EventBus()
+        load_events.add_callback(lambda event: logger.info(
+            f"Sensor {event.sensor}: {event.kind} {event.delta:+.2f} g, now {event.weight:.2f} g"))
+        for sensor_id, sensor in sensors.items():
+            sensor.start_sampling(SAMPLE_BUFFER_SIZE, WEIGHT_WINDOW, STATS_WINDOW,
+                                  acquisition=acquisition)
+            if AUTO_ZERO_ENABLED:
+                sensor.start_auto_zero(AUTO_ZERO_BAND, AUTO_ZERO_RATE, SETTLE_THRESHOLD,
+                                       AUTO_ZERO_WINDOW, AUTO_ZERO_MIN_STEP, sensor_id,
+                                       on_event=lambda event: drifted.add(event.sensor))
+            if LOAD_EVENTS_ENABLED:
+                sensor.start_load_events(load_events, sensor_id, drift=LOAD_EVENTS_DRIFT,
+                                         threshold=LOAD_EVENTS_THRESHOLD,
+                                         min_delta=LOAD_EVENTS_MIN_DELTA,
+                                         settle_window=LOAD_EVENTS_SETTLE_WINDOW,
+                                         settle_threshold=SETTLE_THRESHOLD,
+                                         capacity=LOAD_CELL_CAPACITY)
+        last_offset_save = time.monotonic()
+
+        platform = None
+        if len(sensors) == len(SENSOR_CONFIGS):
+            platform = PlatformAggregator(sensors, PLATFORM_POSITIONS, PLATFORM_COUPLING)
+        else:
+            logger.warning("Not every sensor started, no platform totals")
+
+        rollups = load_rollups()
+        data_saver = DataSaver(sensors, rollups=rollups)
         data_saver.start()
+        if RECORD_FILE is not None:
+            recorder = StreamRecorder(sensors, RECORD_FILE, duration=RECORD_SECONDS)
+            recorder.start()
 
-        web_server_thread = threading.Thread(target=start_web_server, args=(weight_sensor,))
+        web_server_thread = threading.Thread(target=start_web_server, args=(sensors,),
+                                             kwargs={'load_events': load_events,
+                                                     'rollups': rollups,
+                                                     'sample_log': DATA_DIR,
+                                                     'platform': platform})
         web_server_thread.daemon = True
         web_server_thread.start()
 
         logger.info("Real-time weight sensing system started")
 
         while True:
-            weight = weight_sensor.get_weight()
-            logger.info(f"Current weight: {weight:.2f} g")
+            for sensor_id, sensor in sensors.items():
+                # A degraded sensor is being reset by its sampler; don't wait for it.
+                if sensor.degraded:
+                    logger.warning(f"Sensor {sensor_id} degraded, no weight")
+                    continue
+                try:
+                    reading = sensor.get_settled_weight(SETTLE_THRESHOLD, SETTLE_WINDOW,
+                                                        SETTLE_MAX_SAMPLES, SETTLE_TIMEOUT)
+                except TimeoutError as e:
+                    logger.error(f"Sensor {sensor_id}: {e}")
+                    continue
+                state = "stable" if reading.stable else "settling"
+                logger.info(f"Sensor {sensor_id} weight: {reading.value:.2f} g ({state})")
+            if platform is not None and not any(sensor.degraded for sensor in sensors.values()):
+                frame = platform.latest()
+                if frame is not None:
+                    logger.info(f"Platform total: {frame.total:.2f} g, center of mass "
+                                f"({frame.x:.1f}, {frame.y:.1f}) mm")
+            if drifted and time.monotonic() - last_offset_save >= AUTO_ZERO_SAVE_INTERVAL:
+                save_offsets(sensors, list(drifted), calibrations)
+                drifted.clear()
+                last_offset_save = time.monotonic()
             time.sleep(1)
 
     except KeyboardInterrupt:
@@ -52,8 +270,18 @@ def main():
     finally:
         if 'data_saver' in locals():
             data_saver.stop()
-        if 'weight_sensor' in locals():
-            weight_sensor.cleanup()
+        if 'recorder' in locals():
+            recorder.stop()
+        if 'sensors' in locals():
+            # Stop every sampler before the GPIO is released.
+            for sensor in sensors.values():
+                sensor.stop_sampling()
+            if locals().get('acquisition') is not None:
+                acquisition.close()
+            if locals().get('drifted'):
+                save_offsets(sensors, list(drifted), calibrations)
+            for sensor in sensors.values():
+                sensor.cleanup()
         graceful_shutdown()
 
 if __name__ == "__main__":
@@ -1,53 +1,404 @@
 import time
-import RPi.GPIO as GPIO
-from hx711 import HX711
+from auto_zero import AutoZeroTracker
+from calibration_store import SensorCalibration
+from config import CALIBRATION_OFFSET_MAX_AGE
+from filters import Mean
+from hx711 import HX711, ReadTimeoutError, deadline_after, time_left
+from load_events import LoadChangeDetector
+from metrics import REGISTRY
+from sampler import Sampler, DEFAULT_CAPACITY
+from settle import SettleDetector, SettledReading, is_settled, read_until_settled
+from weight_cache import WeightCache
+from window_stats import SlidingWindowStats
 from utils import logger, get_stable_reading
 
+GET_WEIGHT_SECONDS = REGISTRY.histogram('weight_get_seconds', "Latency of WeightSensor.get_weight",
+                                        ['sensor'])
+GET_WEIGHT_ERRORS = REGISTRY.counter('weight_get_errors_total', "get_weight calls that failed",
+                                     ['sensor'])
+TARE_SECONDS = REGISTRY.histogram('weight_tare_seconds', "Duration of WeightSensor.tare", ['sensor'])
+
+# HX711 gain -> number of trailing clock pulses (HX711.GAIN)
+GAIN_PULSES = {128: 1, 64: 3, 32: 2}
+
 class WeightSensor:
-    def __init__(self, dout_pin=5, pd_sck_pin=6):
-        self.hx = HX711(dout_pin, pd_sck_pin)
+    def __init__(self, dout_pin=5, pd_sck_pin=6, gpio=None, ready_mode='interrupt',
+                 weight_filter=None, cache_max_age=0.0, max_retries=3, max_slew=None,
+                 read_timeout=1.0, clock_lock=None, sensor_id=None):
+        # max_retries, max_slew: validation of every conversion; read_timeout:
+        # seconds a read may wait for the chip; clock_lock: shared with the
+        # HX711s read concurrently with this one; sensor_id: metrics label
+        # (default: the DOUT pin); see hx711.HX711.
+        self.hx = HX711(dout_pin, pd_sck_pin, gpio=gpio, ready_mode=ready_mode,
+                        max_retries=max_retries, max_slew=max_slew, read_timeout=read_timeout,
+                        clock_lock=clock_lock, sensor_id=sensor_id)
+        self.sensor_id = self.hx.sensor_id
         self.hx.set_reading_format("MSB", "MSB")
         self.weight = 0
         self.reference_unit = 1
+        # Multi-point CalibrationModel; replaces reference_unit when set.
+        self.calibration = None
+        # Epoch seconds of the calibration and of the current offset (0: unknown).
+        self.calibrated_at = 0.0
+        self.tared_at = 0.0
         self.dout_pin = dout_pin
         self.pd_sck_pin = pd_sck_pin
+        self.sampler = None
+        self.stats = None
+        self.auto_zero = None
+        self.load_events = None
+        self.window = 10
+        # Reduces a block of raw samples to one value, see filters.py.
+        self.weight_filter = weight_filter if weight_filter is not None else Mean()
+        # Concurrent get_weight callers share one measurement, and results are
+        # reused for cache_max_age seconds.
+        self.cache = WeightCache(self._measure_weight, cache_max_age)
         logger.info(f"WeightSensor initialized with pins: DOUT={dout_pin}, PD_SCK={pd_sck_pin}")
 
-    def setup(self):
+    def setup(self, calibration=None, max_offset_age=CALIBRATION_OFFSET_MAX_AGE):
+        """Reset the HX711 and zero it; returns whether a tare was done.
+
+        A stored SensorCalibration is applied first, and its offset is used
+        instead of taring when it is younger than max_offset_age seconds.
+        """
         self.hx.reset()
+        if calibration is not None:
+            self.apply_calibration(calibration)
+            if self.use_stored_offset(calibration, max_offset_age):
+                logger.info("WeightSensor setup completed")
+                return False
         self.tare()
         logger.info("WeightSensor setup completed")
+        return True
+
+    def use_stored_offset(self, calibration, max_offset_age=CALIBRATION_OFFSET_MAX_AGE):
+        """Take the offset of a SensorCalibration if it is younger than
+        max_offset_age seconds; returns whether it was taken."""
+        age = calibration.offset_age()
+        if age is None or not 0 <= age <= max_offset_age:
+            return False
+        self.hx.set_offset(calibration.offset)
+        self.tared_at = calibration.tared_at
+        self.cache.invalidate()
+        logger.info(f"Using stored offset {calibration.offset:.1f} from "
+                    f"{age / 60:.0f} min ago, startup tare skipped")
+        return True
+
+    def apply_calibration(self, calibration):
+        """Use the gain, reference unit and model of a SensorCalibration."""
+        if GAIN_PULSES[calibration.gain] != self.hx.GAIN:
+            self.hx.set_gain(calibration.gain)
+        self.set_reference_unit(calibration.reference_unit)
+        self.set_calibration(calibration.calibration_model())
+        self.calibrated_at = calibration.calibrated_at
+
+    def calibration_record(self, sensor_id, temperature=None):
+        """The current calibration and offset as a SensorCalibration."""
+        gain = {pulses: gain for gain, pulses in GAIN_PULSES.items()}[self.hx.GAIN]
+        return SensorCalibration(
+            sensor_id, float(self.hx.OFFSET), float(self.reference_unit), gain,
+            'B' if gain == 32 else 'A', temperature, self.calibrated_at, self.tared_at,
+            self.calibration.to_dict() if self.calibration is not None else None)
+
+    def start_sampling(self, capacity=DEFAULT_CAPACITY, window=10, stats_window=None, trim=0.2,
+                       acquisition=None):
+        """Read the HX711 continuously in the background; get_weight then filters
+        the last `window` samples instead of reading the chip itself.
+
+        With stats_window, a SlidingWindowStats over that many samples is kept
+        up to date by the sampler and get_weight returns its trimmed mean,
+        which costs the same whatever the window size.
+
+        With a started acquisition.AcquisitionProcess, the samples come from
+        its shared ring instead (capacity is then the acquisition's).  Close
+        self.hx before starting the process; this sensor must not read the
+        chip any more.
+        """
+        if self.sampler is not None:
+            return
+        self.window = window
+        estimators = []
+        if stats_window:
+            self.stats = SlidingWindowStats(stats_window, trim)
+            estimators.append(self.stats)
+        if acquisition is not None:
+            self.sampler = acquisition.sampler(self.hx, estimators)
+        else:
+            self.sampler = Sampler(self.hx, capacity, estimators=estimators)
+        self.sampler.start()
+        logger.info(f"Background sampling started (buffer={self.sampler.ring.capacity}, "
+                    f"window={window}, stats_window={stats_window}"
+                    f"{', acquisition process' if acquisition is not None else ''})")
+
+    def stop_sampling(self):
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        self.sampler = None
+        self.stats = None
+        self.auto_zero = None
+        self.load_events = None
+        logger.info("Background sampling stopped")
+
+    def start_auto_zero(self, zero_band=2.0, max_rate=0.5, threshold=1.0, window=20,
+                        min_step=0.05, name=None, on_event=None):
+        """Track the zero from the sampled stream while the scale is empty and
+        stable, see auto_zero.AutoZeroTracker.  Needs background sampling."""
+        if self.sampler is None:
+            raise RuntimeError("Auto-zero needs background sampling, call start_sampling() first")
+        if self.auto_zero is None:
+            self.auto_zero = AutoZeroTracker(self, zero_band, max_rate, threshold, window,
+                                             min_step, name, on_event)
+            self.sampler.estimators.append(self.auto_zero)
+            logger.info(f"Auto-zero tracking started (band={zero_band} g, rate={max_rate} g/s)")
+        return self.auto_zero
+
+    def start_load_events(self, bus, name=None, alpha=0.3, drift=2.0, threshold=20.0,
+                          min_delta=5.0, settle_window=10, settle_threshold=1.0, capacity=None):
+        """Publish load changes of the sampled stream to bus, see
+        load_events.LoadChangeDetector.  Needs background sampling."""
+        if self.sampler is None:
+            raise RuntimeError("Load events need background sampling, call start_sampling() first")
+        if self.load_events is None:
+            self.load_events = LoadChangeDetector(self, bus, name, alpha, drift, threshold,
+                                                  min_delta, settle_window, settle_threshold,
+                                                  capacity)
+            self.sampler.estimators.append(self.load_events)
+            logger.info(f"Load events started (threshold={threshold} g, min delta={min_delta} g)")
+        return self.load_events
+
+    def get_stats(self):
+        """Median, trimmed mean, mean and standard deviation of the stats window, in weight units."""
+        if self.stats is None:
+            return None
+        count, median, trimmed_mean, mean, variance = self.stats.snapshot
+        if not count:
+            return None
+        if self.calibration is not None:
+            slope = self.calibration.slope(trimmed_mean - self.hx.OFFSET)
+        else:
+            slope = 1 / self.reference_unit
+        return {
+            'count': count,
+            'median': self.raw_to_weight(median),
+            'trimmed_mean': self.raw_to_weight(trimmed_mean),
+            'mean': self.raw_to_weight(mean),
+            'stddev': variance ** 0.5 * abs(slope),
+        }
+
+    @property
+    def degraded(self):
+        """True while the background sampler gets no samples from the chip."""
+        return self.sampler is not None and self.sampler.degraded
 
-    def get_weight(self):
+    def get_weight(self, max_age=None, fresh=False, timeout=None):
+        """Current weight.  A cached value no older than max_age seconds (default
+        cache_max_age) is returned if there is one; with fresh=True the weight
+        is measured after this call.  Callers arriving while a measurement is
+        running share its result.
+
+        Raises TimeoutError (hx711.ReadTimeoutError from the sensor) if there
+        is no weight within timeout seconds, or the sensor is degraded; other
+        errors are logged and give 0.
+        """
+        started = time.perf_counter()
         try:
             if self.reference_unit == 0:
                 raise ValueError("Reference unit is zero. Please calibrate the sensor.")
-            raw_value = get_stable_reading(self.hx)
-            self.weight = raw_value / self.reference_unit
-            logger.debug(f"Current weight: {self.weight:.2f} g (Raw value: {raw_value})")
-            return self.weight
+            return self.cache.get(max_age, fresh, timeout)
+        except TimeoutError as e:
+            if REGISTRY.enabled:
+                GET_WEIGHT_ERRORS.labels(self.sensor_id).inc()
+            logger.error(f"Timed out reading weight: {e}")
+            raise
         except Exception as e:
+            if REGISTRY.enabled:
+                GET_WEIGHT_ERRORS.labels(self.sensor_id).inc()
             logger.error(f"Error reading weight: {e}")
             return 0
+        finally:
+            if REGISTRY.enabled:
+                GET_WEIGHT_SECONDS.labels(self.sensor_id).observe(time.perf_counter() - started)
+
+    def _measure_weight(self, timeout=None):
+        if self.sampler is not None:
+            if self.sampler.degraded:
+                raise ReadTimeoutError(f"Sensor on DOUT={self.dout_pin} is degraded, no recent samples")
+            return self._get_sampled_weight()
+        deadline = deadline_after(timeout)
+        self.weight = get_stable_reading(self.hx, weight_filter=self.weight_filter,
+                                         read=lambda: self._read_weight(5, deadline))
+        logger.debug(f"Current weight: {self.weight:.2f} g")
+        return self.weight
+
+    def counts_to_weight(self, counts):
+        """Convert tare-relative counts (scalar or NumPy array) to grams."""
+        if self.calibration is not None:
+            return self.calibration.apply(counts)
+        return counts / self.reference_unit
+
+    def raw_to_weight(self, raw):
+        """Convert raw readings (scalar or NumPy array) to grams."""
+        return self.counts_to_weight(raw - self.hx.OFFSET)
+
+    def _read_weight(self, times, deadline=None):
+        counts = sum(self.hx.get_value(time_left(deadline)) for _ in range(times)) / times
+        return self.counts_to_weight(counts)
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def _get_sampled_weight(self):
+        raw_value = self._sampled_raw_value()
+        if raw_value is None:
+            logger.warning("No samples available yet")
+            return 0
+        self.weight = self.raw_to_weight(raw_value)
+        logger.debug(f"Current weight: {self.weight:.2f} g (Raw value: {raw_value})")
+        return self.weight
+
+    def _sampled_raw_value(self):
+        if self.stats is not None and self.stats.count:
+            return self.stats.trimmed_mean
+        _, values = self.sampler.ring.latest(self.window)
+        if not len(values):
+            return None
+        return float(self.weight_filter(values))
 
-    def tare(self):
+    def snapshot(self):
+        """Current weight and latest sample from the sampler ring, without touching
+        the HX711.  Returns None if not sampling or nothing was sampled yet."""
+        if self.sampler is None:
+            return None
+        ring = self.sampler.ring
+        last = ring.last()
+        raw_value = self._sampled_raw_value()
+        if last is None or raw_value is None:
+            return None
+        timestamp, raw = last
+        return {
+            'timestamp': time.time() - (time.monotonic() - timestamp),
+            'weight': self.raw_to_weight(raw_value),
+            'raw': raw,
+            'samples': ring.count,
+            'degraded': self.sampler.degraded,
+        }
+
+    def get_settled_weight(self, threshold=1.0, window=5, max_samples=50, timeout=None):
+        """Sample only until the weight is stable to within `threshold` (stddev
+        and drift over `window` samples), or until max_samples/timeout.
+
+        Returns a SettledReading(value, stable, samples, elapsed); running
+        into timeout returns the readings so far with stable=False.  When
+        sampling in the background, already settled recent samples give a
+        result immediately.  Raises hx711.ReadTimeoutError only if the sensor
+        delivers no sample for its read_timeout, or is degraded.
+        """
+        if self.sampler is None:
+            # Every read waits up to read_timeout; timeout only caps settling.
+            reading = read_until_settled(lambda: self._read_weight(1), threshold,
+                                         window, max_samples, timeout)
+        else:
+            reading = self._get_sampled_settled_weight(threshold, window, max_samples, timeout)
+        self.weight = reading.value
+        logger.debug(f"Settled weight: {reading.value:.2f} g (stable={reading.stable}, "
+                     f"samples={reading.samples}, {reading.elapsed * 1000:.0f} ms)")
+        return reading
+
+    def _get_sampled_settled_weight(self, threshold, window, max_samples, timeout):
+        started = time.monotonic()
+        ring = self.sampler.ring
+        first = ring.count
+        while True:
+            _, values = ring.latest(window)
+            weights = self.raw_to_weight(values).tolist()
+            samples = len(weights) + ring.count - first
+            stable = len(weights) == window and is_settled(weights, threshold)
+            elapsed = time.monotonic() - started
+            if stable or samples >= max_samples or (timeout is not None and elapsed >= timeout):
+                value = sum(weights) / len(weights) if weights else 0
+                return SettledReading(value, stable, samples, elapsed)
+            wait = self.hx.read_timeout
+            if timeout is not None:
+                wait = timeout - elapsed if wait is None else min(wait, timeout - elapsed)
+            try:
+                self.sampler.wait_for_samples(1, wait)
+            except ReadTimeoutError:
+                # Running out of settle time is no reason to fail; a silent
+                # or degraded sensor is.
+                last = ring.last()
+                if (self.sampler.degraded or last is None or self.hx.read_timeout is None
+                        or time.monotonic() - last[0] >= self.hx.read_timeout):
+                    raise
+
+    def _sampled_settled_raw(self, times, threshold, timeout):
+        # Like HX711.tare with a threshold, on the samples arriving from now on.
+        deadline = deadline_after(timeout)
+        detector = SettleDetector(threshold, max_samples=max(times, 5))
+        ring = self.sampler.ring
+        seen = ring.count
+        while True:
+            self.sampler.wait_for_samples(1, time_left(deadline))
+            count = ring.count
+            _, values = ring.read(seen, count)
+            seen = count
+            for value in values.tolist():
+                if detector.add(value):
+                    return detector.result().value
+
+    def tare(self, times=15, threshold=None, timeout=None):
+        # threshold (raw counts) stops the tare early once readings settle;
+        # hx711.ReadTimeoutError if the samples take longer than timeout seconds.
         logger.info("Taring the scale...")
-        self.hx.tare()
+        started = time.perf_counter()
+        if self.sampler is None:
+            self.hx.tare(times, threshold, timeout)
+            self.tare_to(self.hx.OFFSET)
+        elif threshold is None:
+            _, values = self.sampler.wait_for_samples(times, timeout)
+            self.tare_to(float(self.weight_filter(values)))
+        else:
+            self.tare_to(float(self._sampled_settled_raw(times, threshold, timeout)))
+        if REGISTRY.enabled:
+            TARE_SECONDS.labels(self.sensor_id).observe(time.perf_counter() - started)
         logger.info("Tare completed")
 
+    def tare_to(self, offset):
+        """Zero at a raw offset measured elsewhere, e.g. from the lockstep
+        frames startup.start_sensors tares all sensors with."""
+        self.hx.set_offset(offset)
+        self.tared_at = time.time()
+        if self.auto_zero is not None:
+            self.auto_zero.reset()
+        if self.load_events is not None:
+            # The zero moved, not the load.
+            self.load_events.reset()
+        self.cache.invalidate()
+
     def set_reference_unit(self, reference_unit):
         if reference_unit == 0:
             logger.error("Cannot set reference unit to zero")
             return
         self.reference_unit = reference_unit
         self.hx.set_reference_unit(reference_unit)
+        self.cache.invalidate()
         logger.info(f"Reference unit set to {reference_unit}")
 
+    def set_calibration(self, calibration):
+        """Use a CalibrationModel (or None to go back to the reference unit)."""
+        self.calibration = calibration
+        self.cache.invalidate()
+        logger.info(f"Calibration set to {calibration}")
+
     def read_raw_value(self):
+        if self.sampler is not None:
+            sample = self.sampler.ring.last()
+            if sample is not None:
+                return sample[1]
         return self.hx.read()
 
     def check_connection(self):
-        if GPIO.input(self.dout_pin) == 0:
+        if self.hx.gpio.input(self.dout_pin) == 0:
             logger.info("HX711 DOUT pin is LOW (as expected when ready)")
             return True
         else:
@@ -55,5 +406,7 @@ class WeightSensor:
             return False
 
     def cleanup(self):
+        self.stop_sampling()
         logger.info("Cleaning up GPIO")
-        GPIO.cleanup()
+        self.hx.close()
+        self.hx.gpio.cleanup()
@@ -0,0 +1,186 @@
+"""Incremental statistics over a sliding window of samples.
+
+SlidingWindowStats keeps the last `window` samples partitioned by rank into
+four heaps: the lowest `trim` share (low), the lower and upper halves of the
+rest (lower, upper) and the highest `trim` share (high).  A new sample and
+the expiry of the oldest one move O(1) elements between neighbouring
+partitions, so an update costs O(log n), and the median, trimmed mean, mean
+and variance are kept up to date for O(1) queries.
+"""
+import heapq
+from collections import deque
+
+
+class _Partition:
+    """Multiset with min, max, size and sum, backed by two lazily pruned heaps."""
+
+    def __init__(self):
+        self.members = set()
+        self.size = 0
+        self.total = 0
+        self._min_heap = []
+        self._max_heap = []
+
+    def add(self, value, seq):
+        self.members.add(seq)
+        self.size += 1
+        self.total += value
+        heapq.heappush(self._min_heap, (value, seq))
+        heapq.heappush(self._max_heap, (-value, seq))
+
+    def remove(self, value, seq):
+        self.members.remove(seq)
+        self.size -= 1
+        self.total -= value
+        # Removed entries stay in the heaps until they surface; rebuild when
+        # they outnumber the live ones so the heaps stay O(window).
+        if len(self._min_heap) > 2 * self.size + 16:
+            self._min_heap = [e for e in self._min_heap if e[1] in self.members]
+            self._max_heap = [e for e in self._max_heap if e[1] in self.members]
+            heapq.heapify(self._min_heap)
+            heapq.heapify(self._max_heap)
+
+    def min(self):
+        heap = self._min_heap
+        while heap[0][1] not in self.members:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def max(self):
+        heap = self._max_heap
+        while heap[0][1] not in self.members:
+            heapq.heappop(heap)
+        value, seq = heap[0]
+        return -value, seq
+
+    def pop_min(self):
+        value, seq = self.min()
+        self.remove(value, seq)
+        return value, seq
+
+    def pop_max(self):
+        value, seq = self.max()
+        self.remove(value, seq)
+        return value, seq
+
+
+class SlidingWindowStats:
+    """Median, trimmed mean, mean and variance of the last `window` samples.
+
+    update() is meant to be called from a single thread (the sampler); the
+    statistics are published together in `snapshot`, a tuple that readers in
+    other threads can take without locking.
+    """
+
+    def __init__(self, window=100, trim=0.2):
+        if window <= 0:
+            raise ValueError("window must be >= 1")
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim must be in [0, 0.5)")
+        self.window = window
+        self.trim = trim
+
+        self._samples = deque()
+        self._where = {}
+        self._seq = 0
+        self._low = _Partition()
+        self._lower = _Partition()
+        self._upper = _Partition()
+        self._high = _Partition()
+        self._sum = 0
+        self._sum_squares = 0
+
+        # (count, median, trimmed_mean, mean, variance)
+        self.snapshot = (0, None, None, None, None)
+
+    @property
+    def count(self):
+        return self.snapshot[0]
+
+    @property
+    def median(self):
+        return self.snapshot[1]
+
+    @property
+    def trimmed_mean(self):
+        return self.snapshot[2]
+
+    @property
+    def mean(self):
+        return self.snapshot[3]
+
+    @property
+    def variance(self):
+        return self.snapshot[4]
+
+    def update(self, value, timestamp=None):
+        value = int(value)
+        self._seq += 1
+        self._insert(value, self._seq)
+        if len(self._samples) > self.window:
+            old_value, old_seq = self._samples.popleft()
+            self._where.pop(old_seq).remove(old_value, old_seq)
+            self._sum -= old_value
+            self._sum_squares -= old_value * old_value
+        self._rebalance()
+        self._publish()
+
+    def extend(self, values):
+        for value in values:
+            self.update(value)
+
+    def _insert(self, value, seq):
+        low, lower, upper, high = self._low, self._lower, self._upper, self._high
+        if low.size and value <= low.max()[0]:
+            partition = low
+        elif high.size and value >= high.min()[0]:
+            partition = high
+        elif lower.size and value <= lower.max()[0]:
+            partition = lower
+        else:
+            partition = upper
+        partition.add(value, seq)
+        self._where[seq] = partition
+        self._samples.append((value, seq))
+        self._sum += value
+        self._sum_squares += value * value
+
+    def _move(self, take, target):
+        value, seq = take()
+        target.add(value, seq)
+        self._where[seq] = target
+
+    def _rebalance(self):
+        low, lower, upper, high = self._low, self._lower, self._upper, self._high
+        n = len(self._samples)
+        k = int(n * self.trim)
+        lower_size = (n - 2 * k + 1) // 2
+
+        # Partitions stay ordered low <= lower <= upper <= high, so elements
+        # only ever move between neighbours (or over an empty one).
+        while low.size > k:
+            self._move(low.pop_max, lower)
+        while low.size < k:
+            source = lower if lower.size else upper if upper.size else high
+            self._move(source.pop_min, low)
+        while high.size > k:
+            self._move(high.pop_min, upper)
+        while high.size < k:
+            source = upper if upper.size else lower
+            self._move(source.pop_max, high)
+        while lower.size > lower_size:
+            self._move(lower.pop_max, upper)
+        while lower.size < lower_size:
+            self._move(upper.pop_min, lower)
+
+    def _publish(self):
+        n = len(self._samples)
+        middle = self._lower.size + self._upper.size
+        if middle % 2:
+            median = float(self._lower.max()[0])
+        else:
+            median = (self._lower.max()[0] + self._upper.min()[0]) / 2.0
+        trimmed_mean = (self._lower.total + self._upper.total) / middle
+        mean = self._sum / n
+        variance = (self._sum_squares - self._sum * self._sum / n) / (n - 1) if n > 1 else 0.0
+        self.snapshot = (n, median, trimmed_mean, mean, variance)